@@ -0,0 +1,594 @@
+"""
+Offline end-to-end benchmark for main.py.
+
+Runs the real pipeline (main.main) against local stand-ins for every external service:
+the YouTube Data API, the yt-dlp audio download, Replicate predictions, Gemini streaming
+and AnkiConnect (a real local HTTP server). Nothing leaves the machine and nothing is billed.
+Each stand-in has a configurable latency and error rate, and the audio, transcript and
+card payload sizes are configurable too.
+
+Every playlist size runs in its own process (fresh caches, singletons and peak RSS) and
+reports videos/hour, p50/p95 latency per pipeline stage, peak RSS and request counts.
+
+--startup instead times the common cron run that finds nothing new (an unchanged playlist)
+in fresh interpreters, and lists the provider SDKs that run imported (there should be none).
+
+Usage:
+    python benchmark.py                          # playlists of 10, 100 and 1000 videos
+    python benchmark.py --sizes 10 --latency replicate=3 --errors gemini=0.05
+    python benchmark.py --json results.json      # also write the results as JSON
+    python benchmark.py --startup --max-startup-s 1.0
+"""
+import argparse
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+try:
+    import resource # Not available on Windows
+except ImportError:
+    resource = None
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# --- Benchmark Defaults ---
+DEFAULT_SIZES = [10, 100, 1000]
+DEFAULT_LATENCY_S = { # Per request
+    'youtube': 0.05,
+    'download': 0.3,
+    'replicate': 1.0, # Time until a prediction succeeds
+    'gemini': 0.8, # Whole stream
+    'anki': 0.01,
+}
+DEFAULT_ERROR_RATES = {service: 0.0 for service in DEFAULT_LATENCY_S}
+STAGES = ('download', 'transcribe', 'generate', 'ingest')
+STARTUP_TIMEOUT_S = 120 # Per --startup process
+# Provider SDKs main.py imports on first use; a run without new videos shouldn't load any of them
+PROVIDER_MODULES = ('yt_dlp', 'replicate', 'google.genai', 'pydub', 'requests')
+
+
+# --- Request Counting ---
+class RequestCounter:
+    """Thread-safe request counts per service."""
+
+    def __init__(self):
+        self._counts = {}
+        self._lock = threading.Lock()
+
+    def add(self, service, count=1):
+        with self._lock:
+            self._counts[service] = self._counts.get(service, 0) + count
+
+    def snapshot(self):
+        with self._lock:
+            return dict(self._counts)
+
+
+class FakeServices:
+    """Shared configuration and bookkeeping of the stand-ins."""
+
+    def __init__(self, latency_s, error_rates, audio_kb, transcript_words, cards_per_video, seed=0):
+        self.latency_s = latency_s
+        self.error_rates = error_rates
+        self.audio_kb = audio_kb
+        self.transcript_words = transcript_words
+        self.cards_per_video = cards_per_video
+        self.requests = RequestCounter()
+        self.seed = seed
+        self._random = random.Random(seed)
+        self._random_lock = threading.Lock()
+
+    def call(self, service, latency_key=None):
+        """Counts a request, sleeps for its latency and returns True if it should fail."""
+        self.requests.add(service)
+        time.sleep(self.latency_s.get(latency_key or service, 0))
+        with self._random_lock:
+            return self._random.random() < self.error_rates.get(service, 0)
+
+
+# --- YouTube Data API Stand-In ---
+class FakeYouTubeRequest:
+    def __init__(self, services, handler):
+        self.services = services
+        self.handler = handler
+        self.headers = {}
+
+    def execute(self):
+        from googleapiclient.errors import HttpError
+        import httplib2
+        if self.services.call('youtube'):
+            raise HttpError(httplib2.Response({'status': 503}), b'{"error": "backendError (benchmark)"}')
+        return self.handler(self.headers)
+
+
+class FakeYouTubeService:
+    """Serves a synthetic playlist to playlistItems().list and videos().list."""
+
+    def __init__(self, services, video_count, seed=0):
+        self.services = services
+        rng = random.Random(seed)
+        self.playlist = [(f"bench{i:05d}", f"Benchmark Lecture {i}", rng.randint(3, 90) * 60) for i in range(video_count)]
+        self.durations = {video_id: duration_s for video_id, _, duration_s in self.playlist}
+
+    def playlistItems(self):
+        return self
+
+    def videos(self):
+        return FakeVideosResource(self)
+
+    def list(self, part=None, playlistId=None, maxResults=50, pageToken=None, **kwargs):
+        start = int(pageToken or 0)
+        def handler(headers):
+            etag = f"etag-{len(self.playlist)}"
+            if headers.get('If-None-Match') == etag:
+                from googleapiclient.errors import HttpError
+                import httplib2
+                raise HttpError(httplib2.Response({'status': 304}), b'')
+            page = self.playlist[start:start + maxResults]
+            response = {
+                'etag': etag,
+                'items': [{'snippet': {'resourceId': {'videoId': video_id}, 'title': title,
+                                       'publishedAt': f"2024-01-01T00:{i // 60 % 60:02d}:{i % 60:02d}Z"}}
+                          for i, (video_id, title, _) in enumerate(page, start)],
+            }
+            if start + maxResults < len(self.playlist):
+                response['nextPageToken'] = str(start + maxResults)
+            return response
+        return FakeYouTubeRequest(self.services, handler)
+
+
+class FakeVideosResource:
+    def __init__(self, youtube):
+        self.youtube = youtube
+
+    def list(self, part=None, id='', maxResults=50, **kwargs):
+        def handler(headers):
+            return {'items': [{'id': video_id,
+                               'contentDetails': {'duration': f"PT{self.youtube.durations[video_id]}S", 'caption': 'false'},
+                               'snippet': {'defaultAudioLanguage': 'en'}}
+                              for video_id in id.split(',') if video_id in self.youtube.durations]}
+        return FakeYouTubeRequest(self.youtube.services, handler)
+
+
+# --- Replicate Stand-In ---
+class FakePrediction:
+    """Mimics replicate's Prediction: reload() flips the status once the latency has passed."""
+
+    def __init__(self, services, model_name):
+        self.services = services
+        self.id = f"pred-{time.monotonic_ns()}-{threading.get_ident()}"
+        self.status = 'starting'
+        self.output = None
+        self.error = None
+        with services._random_lock:
+            self._fails = services._random.random() < services.error_rates.get('replicate', 0)
+        self._done_at = time.monotonic() + services.latency_s.get('replicate', 0)
+
+    def reload(self):
+        self.services.requests.add('replicate')
+        if self.status in ('succeeded', 'failed', 'canceled') or time.monotonic() < self._done_at:
+            return
+        if self._fails:
+            self.status, self.error = 'failed', "CUDA out of memory (benchmark)"
+        else:
+            words = " ".join(f"word{i % 997}" for i in range(self.services.transcript_words))
+            self.status, self.output = 'succeeded', {'transcription': f"This lecture covers {self.id}. {words}."}
+
+    def cancel(self):
+        self.services.requests.add('replicate')
+        self.status = 'canceled'
+
+
+# --- Gemini Stand-In ---
+class FakeGeminiChunk:
+    def __init__(self, text):
+        self.text = text
+
+
+class FakeGeminiError(Exception):
+    code = 503
+
+
+class FakeGeminiClient:
+    """Stands in for genai.Client: models.generate_content_stream yields the flashcard JSON in pieces."""
+
+    def __init__(self, services):
+        self.services = services
+        self.models = self
+
+    def generate_content_stream(self, model, contents, config=None):
+        if self.services.call('gemini'):
+            raise FakeGeminiError("503 UNAVAILABLE (benchmark)")
+        prompt = contents[0].parts[0].text
+        title = prompt.split("\n", 1)[0]
+        # Seeded per title, so each video gets the same category whatever order the workers call in
+        rng = random.Random(f"{self.services.seed}:{title}")
+        payload = json.dumps({
+            'category': rng.choice(["Physics", "History", "Biology"]),
+            'flashcards': [{'front': f"{title}: question {i}?", 'back': f"Answer {i}."} for i in range(self.services.cards_per_video)],
+        })
+        step = max(1, len(payload) // 4)
+        return [FakeGeminiChunk(payload[i:i + step]) for i in range(0, len(payload), step)]
+
+
+# --- AnkiConnect Stand-In ---
+def start_fake_ankiconnect(services):
+    """Starts a local AnkiConnect server in a daemon thread. Returns (server, url)."""
+    decks = {'Default': []}
+    lock = threading.Lock()
+
+    def run_action(action, params):
+        if action == 'multi':
+            return [{'result': run_action(a['action'], a.get('params', {})), 'error': None} for a in params['actions']]
+        if action == 'version':
+            return 6
+        if action == 'modelNames':
+            return ['Basic']
+        if action == 'modelFieldNames':
+            return ['Front', 'Back']
+        if action == 'deckNames':
+            with lock:
+                return list(decks)
+        if action == 'createDeck':
+            with lock:
+                decks.setdefault(params['deck'], [])
+            return 1
+        if action == 'findNotes':
+            return []
+        if action == 'notesInfo':
+            return []
+        if action in ('addNotes', 'canAddNotes'):
+            if action == 'canAddNotes':
+                return [True for _ in params['notes']]
+            with lock:
+                results = []
+                for note in params['notes']:
+                    deck = decks.setdefault(note['deckName'], [])
+                    deck.append(note)
+                    results.append(len(deck))
+                return results
+        return None
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1' # Keep-alive, like Anki's server
+
+        def do_POST(self):
+            body = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))) or b'{}')
+            if services.call('anki'):
+                self.send_response(500)
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return
+            payload = json.dumps({'result': run_action(body.get('action'), body.get('params', {})), 'error': None}).encode()
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(payload)))
+            self.end_headers()
+            self.wfile.write(payload)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="fake-ankiconnect", daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_port}"
+
+
+# --- Single Run (child process) ---
+def _percentile(values, fraction):
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(fraction * (len(ordered) - 1))))]
+
+def _peak_rss_mb():
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1024 * 1024) if sys.platform == 'darwin' else peak / 1024 # Bytes on macOS, KiB on Linux
+
+def run_single(video_count, options):
+    """Runs main.main() once over a synthetic playlist in this process and returns the result dict."""
+    services = FakeServices(options['latency_s'], options['error_rates'], options['audio_kb'],
+                            options['transcript_words'], options['cards_per_video'], seed=options['seed'])
+    anki_server, anki_url = start_fake_ankiconnect(services)
+    data_dir = tempfile.mkdtemp(prefix="flashcard_benchmark_")
+
+    # main.py reads its configuration at import time
+    os.environ.update({
+        'DATA_DIR': data_dir,
+        'YOUTUBE_API_KEY': 'benchmark', 'YOUTUBE_PLAYLIST_ID': 'PLbenchmark',
+        'GEMINI_API_KEY': 'benchmark', 'REPLICATE_API_TOKEN': 'benchmark',
+        'ANKI_CONNECT_URL': anki_url, 'ANKI_NOTE_TYPE': 'Basic', 'ANKI_FIELD_FRONT': 'Front', 'ANKI_FIELD_BACK': 'Back',
+        'TRANSCRIPT_SOURCE': 'audio', # Caption lookups would go through the real yt-dlp
+        'CACHE_ENABLED': 'true' if options['cache'] else 'false',
+        'SYSTEM_PROMPT_FILE': os.path.join(SCRIPT_DIR, 'system_prompt.txt'),
+        'REPLICATE_POLL_INTERVAL_S': str(options['poll_interval_s']),
+    })
+    if not options['real_rate_limits']:
+        os.environ.update({'REPLICATE_MAX_RPM': '1000000', 'GEMINI_MAX_RPM': '1000000', 'YOUTUBE_MAX_RPM': '1000000'})
+    sys.path.insert(0, SCRIPT_DIR)
+    import logging
+    import main
+    main.setup_logging()
+    logging.getLogger().setLevel(logging.INFO if options['verbose'] else logging.ERROR)
+
+    # --- Install the stand-ins ---
+    youtube = FakeYouTubeService(services, video_count, seed=options['seed'])
+    main.get_youtube_service = lambda: youtube
+
+    def fake_download_audio(video_url, output_dir):
+        if services.call('download'):
+            return None
+        path = os.path.join(output_dir, f"ytaudio_{time.monotonic_ns()}_{threading.get_ident()}.mp3")
+        with open(path, 'wb') as f:
+            f.write(os.urandom(1024) * options['audio_kb'])
+        return path
+    main.download_audio = fake_download_audio
+
+    def fake_create_prediction(model_name, model_input):
+        services.requests.add('replicate')
+        audio = model_input.get('audio') or model_input.get('audio_file')
+        if audio is not None:
+            services.requests.add('replicate_upload_bytes', os.fstat(audio.fileno()).st_size)
+        return FakePrediction(services, model_name)
+    main._create_replicate_prediction = fake_create_prediction
+
+    from google import genai
+    genai.Client = lambda api_key=None, **kwargs: FakeGeminiClient(services)
+
+    # --- Time every stage of every video ---
+    stage_latencies = {stage: [] for stage in STAGES}
+    latency_lock = threading.Lock()
+    def timed(stage, func):
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                with latency_lock:
+                    stage_latencies[stage].append(time.perf_counter() - start)
+        return wrapper
+    for stage in STAGES:
+        setattr(main, f"stage_{stage}", timed(stage, getattr(main, f"stage_{stage}")))
+
+    start = time.perf_counter()
+    run_stats = main.main([]) or {}
+    wall_s = time.perf_counter() - start
+    anki_server.shutdown()
+
+    processed = run_stats.get('processed', 0)
+    counts = services.requests.snapshot()
+    return {
+        'videos': video_count,
+        'processed': processed,
+        'failed': run_stats.get('attempted', 0) - processed,
+        'wall_s': round(wall_s, 2),
+        'videos_per_hour': round(processed / wall_s * 3600, 1) if wall_s > 0 else None,
+        'stage_latency_s': {stage: {'p50': _round(_percentile(values, 0.5)), 'p95': _round(_percentile(values, 0.95)), 'count': len(values)}
+                            for stage, values in stage_latencies.items()},
+        'peak_rss_mb': _round(_peak_rss_mb(), 1),
+        'requests': {service: counts.get(service, 0) for service in ('youtube', 'download', 'replicate', 'gemini', 'anki')},
+        'replicate_upload_mb': round(counts.get('replicate_upload_bytes', 0) / (1024 * 1024), 1),
+        'cards_added_to_anki': run_stats.get('anki_added', 0),
+        'pipeline_metrics': main.RUN_METRICS.summary(), # The pipeline's own spans and counters
+    }
+
+def _round(value, digits=3):
+    return round(value, digits) if value is not None else None
+
+
+# --- Startup Benchmark ---
+def _startup_env(data_dir):
+    return dict(os.environ, DATA_DIR=data_dir, YOUTUBE_API_KEY='benchmark', YOUTUBE_PLAYLIST_ID='PLbenchmark',
+                GEMINI_API_KEY='benchmark', REPLICATE_API_TOKEN='benchmark', YOUTUBE_MAX_RPM='1000000')
+
+def run_startup_child(mode, video_count, seed=0):
+    """
+    Child process of --startup. 'seed' records every video of the synthetic playlist as processed
+    (and its ETag); 'run' then times import + main.main() on the unchanged playlist.
+    """
+    start = time.perf_counter()
+    import main
+    import_s = time.perf_counter() - start
+    import logging
+    main.setup_logging()
+    logging.getLogger().setLevel(logging.WARNING)
+
+    services = FakeServices({}, {}, 0, 0, 0, seed=seed)
+    youtube = FakeYouTubeService(services, video_count, seed=seed)
+    build_real_client = main.get_youtube_service
+    def get_youtube_service():
+        build_real_client() # Pay for the real client (no network), then serve the synthetic playlist
+        return youtube
+    main.get_youtube_service = get_youtube_service
+
+    if mode == 'seed':
+        journal = main.StateJournal(main.STATE_DB_FILE)
+        for video_id, title, _ in youtube.playlist:
+            journal.record_stage(video_id, 'ingested', title=title)
+        journal.close()
+        main.main([]) # Stores the playlist ETag
+        return None
+    run_start = time.perf_counter()
+    main.main([])
+    return {
+        'import_s': round(import_s, 3),
+        'main_s': round(time.perf_counter() - run_start, 3),
+        'youtube_requests': services.requests.snapshot().get('youtube', 0),
+        'provider_modules_loaded': [module for module in PROVIDER_MODULES if module in sys.modules],
+    }
+
+def run_startup_benchmark(video_count, repeat, seed=0, timeout_s=None):
+    """Times `repeat` fresh processes running the "no new videos" path. Returns the result dict."""
+    data_dir = tempfile.mkdtemp(prefix="flashcard_startup_")
+    env = _startup_env(data_dir)
+    command = [sys.executable, os.path.abspath(__file__), '--videos', str(video_count), '--seed', str(seed), '--startup-child']
+    timeout_s = timeout_s or STARTUP_TIMEOUT_S
+    try:
+        subprocess.run(command + ['seed'], env=env, stdout=subprocess.DEVNULL, check=True, timeout=timeout_s)
+    except subprocess.TimeoutExpired:
+        raise SystemExit(f"Seeding the startup benchmark timed out after {timeout_s:g}s.")
+    runs = []
+    for _ in range(max(1, repeat)):
+        start = time.perf_counter()
+        try:
+            completed = subprocess.run(command + ['run'], env=env, stdout=subprocess.PIPE, text=True, check=True, timeout=timeout_s)
+        except subprocess.TimeoutExpired:
+            raise SystemExit(f"A startup run timed out after {timeout_s:g}s.")
+        process_s = time.perf_counter() - start
+        line = [line for line in completed.stdout.splitlines() if line.startswith("BENCHMARK_RESULT ")][-1]
+        runs.append(dict(json.loads(line[len("BENCHMARK_RESULT "):]), process_s=round(process_s, 3)))
+    summary = {key: {'p50': _round(_percentile([run[key] for run in runs], 0.5)), 'max': max(run[key] for run in runs)}
+               for key in ('process_s', 'import_s', 'main_s')}
+    return {
+        'videos': video_count,
+        'runs': len(runs),
+        **summary,
+        'youtube_requests': max(run['youtube_requests'] for run in runs),
+        'provider_modules_loaded': sorted({module for run in runs for module in run['provider_modules_loaded']}),
+    }
+
+def print_startup_report(result):
+    print(f"Startup without new videos ({result['videos']}-video playlist, {result['runs']} runs):")
+    for key, label in (('process_s', 'whole process'), ('import_s', 'import main'), ('main_s', 'main()')):
+        print(f"  {label:<14} p50 {result[key]['p50']:.3f}s   max {result[key]['max']:.3f}s")
+    print(f"  YouTube requests per run: {result['youtube_requests']}")
+    print(f"  Provider SDKs loaded: {', '.join(result['provider_modules_loaded']) or 'none'}")
+
+
+# --- Orchestration ---
+def _parse_mapping(text, defaults, name):
+    """Parses 'key=value,key=value' overrides of a {service: float} mapping."""
+    values = dict(defaults)
+    for pair in filter(None, (text or "").split(',')):
+        key, _, value = pair.partition('=')
+        if key.strip() not in defaults:
+            raise SystemExit(f"Unknown service '{key.strip()}' in --{name}. Use: {', '.join(defaults)}")
+        values[key.strip()] = float(value)
+    return values
+
+def child_timeout_s(size, options):
+    """Generous wall-clock budget for one --single run: every video's requests back to back, four times over."""
+    per_video_s = sum(options['latency_s'].values()) + options['poll_interval_s']
+    return 120 + 4 * size * per_video_s
+
+def print_report(results):
+    header = f"{'videos':>7} {'ok':>5} {'wall s':>8} {'videos/h':>9} {'RSS MB':>7}  " + \
+             "  ".join(f"{stage + ' p50/p95 s':>22}" for stage in STAGES) + "  requests"
+    print(header)
+    print("-" * len(header))
+    for result in results:
+        if 'error' in result:
+            print(f"{result['videos']:>7}  failed: {result['error']}")
+            continue
+        stage_columns = "  ".join(f"{_fmt(result['stage_latency_s'][stage]['p50']):>10} / {_fmt(result['stage_latency_s'][stage]['p95']):<9}"
+                                  for stage in STAGES)
+        requests_column = ", ".join(f"{service}={count}" for service, count in result['requests'].items())
+        print(f"{result['videos']:>7} {result['processed']:>5} {result['wall_s']:>8} {_fmt(result['videos_per_hour']):>9} "
+              f"{_fmt(result['peak_rss_mb']):>7}  {stage_columns}  {requests_column}")
+
+def _fmt(value):
+    return "n/a" if value is None else f"{value:g}"
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Offline benchmark of the flashcard pipeline with local stand-ins for all services.")
+    parser.add_argument('--sizes', default=",".join(map(str, DEFAULT_SIZES)),
+                        help="Comma-separated playlist sizes, each run in its own process (default: 10,100,1000).")
+    parser.add_argument('--latency', default="",
+                        help="Per-request latency overrides in seconds, e.g. replicate=3,gemini=2 "
+                             f"(services: {', '.join(DEFAULT_LATENCY_S)}).")
+    parser.add_argument('--errors', default="", help="Per-request error rates, e.g. replicate=0.05,youtube=0.01.")
+    parser.add_argument('--audio-kb', type=int, default=256,
+                        help="Size of each fake audio download (KB). Above MAX_CHUNK_SIZE_MB the real ffmpeg splitter runs.")
+    parser.add_argument('--transcript-words', type=int, default=1500, help="Words per fake transcript.")
+    parser.add_argument('--cards', type=int, default=8, help="Flashcards per fake Gemini response.")
+    parser.add_argument('--poll-interval', type=float, default=0.2, help="REPLICATE_POLL_INTERVAL_S for the run (default 0.2).")
+    parser.add_argument('--cache', action='store_true', help="Leave the on-disk caches enabled (off by default).")
+    parser.add_argument('--real-rate-limits', action='store_true',
+                        help="Keep the configured *_MAX_RPM limits instead of lifting them.")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--timeout', type=float,
+                        help="Seconds before a child run is killed and reported as a timeout "
+                             "(default: derived from the playlist size and latencies; 120 per --startup process).")
+    parser.add_argument('--json', metavar='FILE', help="Also write the results to FILE as JSON.")
+    parser.add_argument('--verbose', action='store_true', help="Show the pipeline's INFO logging.")
+    parser.add_argument('--startup', action='store_true',
+                        help="Benchmark startup instead: fresh processes running a check that finds no new videos.")
+    parser.add_argument('--videos', type=int, default=100, help="Playlist size for --startup (default 100).")
+    parser.add_argument('--repeat', type=int, default=5, help="Processes to time for --startup (default 5).")
+    parser.add_argument('--max-startup-s', type=float,
+                        help="With --startup: exit with status 1 if the median process time exceeds this, "
+                             "or if any provider SDK was imported.")
+    parser.add_argument('--single', type=int, help=argparse.SUPPRESS) # Child process: run one size, print JSON
+    parser.add_argument('--startup-child', choices=('seed', 'run'), help=argparse.SUPPRESS)
+    return parser.parse_args(argv)
+
+def options_from_args(args):
+    return {
+        'latency_s': _parse_mapping(args.latency, DEFAULT_LATENCY_S, 'latency'),
+        'error_rates': _parse_mapping(args.errors, DEFAULT_ERROR_RATES, 'errors'),
+        'audio_kb': args.audio_kb,
+        'transcript_words': args.transcript_words,
+        'cards_per_video': args.cards,
+        'poll_interval_s': args.poll_interval,
+        'cache': args.cache,
+        'real_rate_limits': args.real_rate_limits,
+        'seed': args.seed,
+        'verbose': args.verbose,
+    }
+
+def main(argv=None):
+    args = parse_args(argv)
+    if args.startup_child:
+        result = run_startup_child(args.startup_child, args.videos, seed=args.seed)
+        if result is not None:
+            print("BENCHMARK_RESULT " + json.dumps(result))
+        return
+    if args.startup:
+        result = run_startup_benchmark(args.videos, args.repeat, seed=args.seed, timeout_s=args.timeout)
+        print_startup_report(result)
+        if args.json:
+            with open(args.json, 'w', encoding='utf-8') as f:
+                json.dump(result, f, indent=2)
+        if args.max_startup_s is not None and (result['process_s']['p50'] > args.max_startup_s or result['provider_modules_loaded']):
+            print(f"FAILED: startup budget is {args.max_startup_s:g}s with no provider SDKs loaded.", file=sys.stderr)
+            sys.exit(1)
+        return
+    if args.single is not None:
+        result = run_single(args.single, options_from_args(args))
+        print("BENCHMARK_RESULT " + json.dumps(result))
+        return
+
+    child_args = [arg for arg in (argv if argv is not None else sys.argv[1:])]
+    options = options_from_args(args)
+    results = []
+    for size in [int(size) for size in args.sizes.split(',') if size.strip()]:
+        print(f"Running benchmark with {size} videos...", file=sys.stderr)
+        try:
+            completed = subprocess.run([sys.executable, os.path.abspath(__file__), *child_args, '--single', str(size)],
+                                       stdout=subprocess.PIPE, text=True, timeout=args.timeout or child_timeout_s(size, options))
+        except subprocess.TimeoutExpired:
+            results.append({'videos': size, 'error': 'timeout'})
+            continue
+        lines = [line for line in completed.stdout.splitlines() if line.startswith("BENCHMARK_RESULT ")]
+        if completed.returncode != 0 or not lines:
+            results.append({'videos': size, 'error': f"exit code {completed.returncode}"})
+            continue
+        results.append(json.loads(lines[-1][len("BENCHMARK_RESULT "):]))
+
+    print_report(results)
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -2,23 +2,30 @@
 import json
 import tempfile
 import time
-import yt_dlp
-from googleapiclient.discovery import build
-import replicate
-from replicate.exceptions import ReplicateError
+# The provider SDKs (yt_dlp, googleapiclient.discovery, replicate, google.genai, pydub, requests)
+# are imported where they are first used: a run that finds no new videos only loads the YouTube client.
 from googleapiclient.errors import HttpError
-from google import genai  
-from google.genai import types
 import logging
 import sys
 from dotenv import load_dotenv
 import re # Added for sanitizing filenames
-from google.api_core import exceptions as google_api_core_exceptions
 import base64
-import requests
-from pydub import AudioSegment
-from pydub.exceptions import CouldntDecodeError
 import math
+import queue
+import threading
+import concurrent.futures
+import multiprocessing
+import importlib.util
+import subprocess
+import hashlib
+import argparse
+import signal
+import contextlib
+import sqlite3
+import collections
+import random
+import glob
+import html
 
 
 
@@ -42,15 +49,80 @@ FALLBACK_WHISPERX_MODEL = "victor-upmeet/whisperx:84d2ad2d6194fe98a17d2b60bef1c7
 # Use the new experimental model as primary, flash as fallback
 PRIMARY_GEMINI_MODEL = "gemini-2.5-pro-exp-03-25"
 FALLBACK_GEMINI_MODEL = "gemini-2.0-flash"
+SYSTEM_PROMPT_FILE = os.environ.get('SYSTEM_PROMPT_FILE', 'system_prompt.txt')
+SYSTEM_PROMPT_WATCH = os.environ.get('SYSTEM_PROMPT_WATCH', 'false').lower() == 'true' # Reload the prompt when the file changes
+# Long transcripts are split into sections that are generated concurrently and merged (map-reduce)
+GENERATION_MAP_REDUCE_MIN_TOKENS = int(os.environ.get('GENERATION_MAP_REDUCE_MIN_TOKENS', '24000')) # 0 = always one request
+GENERATION_SECTION_TOKENS = int(os.environ.get('GENERATION_SECTION_TOKENS', '12000')) # Approximate size of a section
+GENERATION_SECTION_CONCURRENCY = int(os.environ.get('GENERATION_SECTION_CONCURRENCY', '4')) # Sections of one video generated at once
 
 # --- Constants ---
-STATE_FILE = os.path.join(DATA_DIR, 'playlist_state.json') # Keep state file in data dir too
+STATE_FILE = os.path.join(DATA_DIR, 'playlist_state.json') # Legacy state file, imported once into STATE_DB_FILE
+STATE_DB_FILE = os.path.join(DATA_DIR, 'pipeline_state.sqlite') # Per-video stage journal
 API_SERVICE_NAME = 'youtube'
 API_VERSION = 'v3'
-MAX_RESULTS_PER_FETCH = 50
+MAX_RESULTS_PER_FETCH = 50 # Playlist items per page (API maximum)
+# Send the ETag of the previous playlist fetch; an unchanged playlist then costs one cheap 304
+PLAYLIST_USE_ETAG = os.environ.get('PLAYLIST_USE_ETAG', 'true').lower() == 'true'
+# Stop paging at the first page with nothing newer than the last fetch (for playlists where new videos go on top)
+PLAYLIST_INCREMENTAL = os.environ.get('PLAYLIST_INCREMENTAL', 'false').lower() == 'true'
 REPLICATE_WHISPER_MODEL = "vaibhavs10/incredibly-fast-whisper:3ab86df6c8f54c11309d4d1f930ac292bad43ace52d10c80d87eb258b3c9f79c"
+# --- Transcript Source ---
+# 'auto' tries the video's YouTube captions first and only downloads + transcribes audio if none fit,
+# 'audio' always transcribes the audio, 'captions' only uses captions (videos without them fail).
+TRANSCRIPT_SOURCE = os.environ.get('TRANSCRIPT_SOURCE', 'auto').lower()
+CAPTION_LANGUAGES = [lang.strip() for lang in os.environ.get('CAPTION_LANGUAGES', 'en').split(',') if lang.strip()] # In order of preference
+CAPTION_ALLOW_AUTO = os.environ.get('CAPTION_ALLOW_AUTO', 'true').lower() == 'true' # Accept YouTube's auto-generated captions?
+CAPTION_MIN_WORDS_PER_MINUTE = float(os.environ.get('CAPTION_MIN_WORDS_PER_MINUTE', '60')) # Sparser tracks are rejected
+
+# --- Audio Profile ---
+# Format download_audio produces: 'mp3' (128k MP3, the original behaviour), 'speech'
+# (16 kHz mono 32k MP3, about 4x smaller; plenty for Whisper) or 'passthrough' (YouTube's native
+# m4a/webm audio stream without any transcoding; the Replicate Whisper models decode it with ffmpeg).
+AUDIO_PROFILE = os.environ.get('AUDIO_PROFILE', 'speech').lower()
+AUDIO_PROFILES = {
+    # name: (yt-dlp format, FFmpegExtractAudio codec/quality or None, extra ffmpeg args, approx. kbps)
+    'mp3': ('bestaudio/best', ('mp3', '128'), [], 128),
+    'speech': ('bestaudio/best', ('mp3', '32'), ['-ar', '16000', '-ac', '1'], 32),
+    'passthrough': ('bestaudio[ext=m4a]/bestaudio[ext=webm]/bestaudio/best', None, [], 130),
+}
+if AUDIO_PROFILE not in AUDIO_PROFILES:
+    raise ValueError(f"Unknown AUDIO_PROFILE '{AUDIO_PROFILE}'. Use one of: {', '.join(AUDIO_PROFILES)}")
+
+# --- Audio Splitting ---
+# Max chunk size in MB (adjust based on observed Replicate limits, maybe 20-24MB)
+MAX_CHUNK_SIZE_MB = 20
+CHUNK_OVERLAP_MS = 5000 # 5 seconds overlap to help catch words split at boundaries
+# 'ffmpeg' cuts the file with stream copy (constant memory, seconds); 'pydub' decodes and re-encodes it (legacy)
+AUDIO_SPLIT_MODE = os.environ.get('AUDIO_SPLIT_MODE', 'ffmpeg').lower()
+FFMPEG_TIMEOUT_S = 300 # Per ffmpeg/ffprobe invocation
+# How many chunks of one (long) audio file are sent to Replicate at the same time
+TRANSCRIBE_CHUNK_CONCURRENCY = int(os.environ.get('TRANSCRIBE_CHUNK_CONCURRENCY', '4'))
+# Replicate predictions are started without blocking and tracked by one poller thread
+REPLICATE_POLL_INTERVAL_S = float(os.environ.get('REPLICATE_POLL_INTERVAL_S', '2'))
+REPLICATE_PREDICTION_TIMEOUT_S = float(os.environ.get('REPLICATE_PREDICTION_TIMEOUT_S', '900')) # Per prediction; cancelled after
+
+# --- Transcription Engine ---
+# 'replicate' uploads the audio to the Replicate Whisper models (the original behaviour), 'local' runs
+# faster-whisper on this machine's CPUs (pip install faster-whisper) with Replicate as fallback, and
+# 'auto' transcribes videos up to LOCAL_TRANSCRIPTION_MAX_MIN locally and longer ones on Replicate.
+TRANSCRIPTION_ENGINE = os.environ.get('TRANSCRIPTION_ENGINE', 'replicate').lower()
+if TRANSCRIPTION_ENGINE not in ('replicate', 'local', 'auto'):
+    raise ValueError(f"Unknown TRANSCRIPTION_ENGINE '{TRANSCRIPTION_ENGINE}'. Use one of: replicate, local, auto")
+LOCAL_TRANSCRIPTION_MAX_MIN = float(os.environ.get('LOCAL_TRANSCRIPTION_MAX_MIN', '20'))
+LOCAL_WHISPER_MODEL = os.environ.get('LOCAL_WHISPER_MODEL', 'small') # faster-whisper model name or path
+LOCAL_WHISPER_COMPUTE_TYPE = os.environ.get('LOCAL_WHISPER_COMPUTE_TYPE', 'int8')
+LOCAL_WHISPER_CPU_THREADS = int(os.environ.get('LOCAL_WHISPER_CPU_THREADS', '4')) # Per worker process
+LOCAL_WHISPER_WORKERS = int(os.environ.get('LOCAL_WHISPER_WORKERS', '0')) # 0 = CPU cores // LOCAL_WHISPER_CPU_THREADS
+
+# --- Transcript Compaction ---
+# Transcripts are cleaned up before they are sent to Gemini (fewer prompt tokens)
+TRANSCRIPT_COMPACTION = os.environ.get('TRANSCRIPT_COMPACTION', 'true').lower() == 'true'
+# Whisper transcribes any language, so no words that mean something elsewhere (German 'er' and 'um', ...)
+TRANSCRIPT_FILLER_WORDS = [word.strip() for word in os.environ.get('TRANSCRIPT_FILLER_WORDS', 'umm,uh,uhh,uhm,erm,hmm,mhm').split(',') if word.strip()]
 # --- JSON Filename Template (will be adapted per category) ---
 JSON_FILENAME_PREFIX = ""
+CARD_DB_FILE = os.path.join(DATA_DIR, 'cards.sqlite') # All generated cards; category JSON files are exported from it
 
 # --- Configuration ----
 ANKI_CONNECT_URL = os.environ.get('ANKI_CONNECT_URL', 'http://127.0.0.1:8765')
@@ -62,64 +134,135 @@ ANKI_FIELD_BACK = os.environ.get('ANKI_FIELD_BACK', 'Back')   # The exact name o
 ANKI_FIELD_SOURCE = os.environ.get('ANKI_FIELD_SOURCE') # Optional: Field name to store video title/URL
 ANKI_TAGS_FROM_CATEGORY = os.environ.get('ANKI_TAGS_FROM_CATEGORY', 'true').lower() == 'true' # Use Gemini category as tag?
 
-# --- Logging Setup ---
+# --- Anki Outbox ---
+# Notes that can't reach Anki are spooled here and flushed in bulk once AnkiConnect is reachable.
+ANKI_SPOOL_FILE = os.path.join(DATA_DIR, 'anki_outbox.sqlite')
+ANKI_DEFERRED_INGEST = os.environ.get('ANKI_DEFERRED_INGEST', 'false').lower() == 'true' # Always spool; flush once at the end of the run
+ANKI_SPOOL_BATCH_SIZE = int(os.environ.get('ANKI_SPOOL_BATCH_SIZE', '500')) # Notes per addNotes request when flushing
+ANKI_SPOOL_MAX_ATTEMPTS = int(os.environ.get('ANKI_SPOOL_MAX_ATTEMPTS', '5')) # Flushes a note may fail before it is dropped
+
+# --- Pipeline Concurrency ---
+# Videos flow through download -> transcribe -> generate -> Anki stages. Each stage
+# has its own worker pool; the stages mostly wait on the network, so tune them independently.
+DOWNLOAD_WORKERS = int(os.environ.get('DOWNLOAD_WORKERS', '3'))
+TRANSCRIBE_WORKERS = int(os.environ.get('TRANSCRIBE_WORKERS', '6'))
+GENERATE_WORKERS = int(os.environ.get('GENERATE_WORKERS', '4'))
+ANKI_WORKERS = int(os.environ.get('ANKI_WORKERS', '1')) # Keep at 1 unless you know AnkiConnect copes with parallel writes
+# Skip decisions made from the batched video metadata (before anything is downloaded)
+SKIP_AGE_RESTRICTED = os.environ.get('SKIP_AGE_RESTRICTED', 'false').lower() == 'true' # Leave false if cookies.txt gets you past age gates
+MAX_VIDEO_DURATION_MIN = float(os.environ.get('MAX_VIDEO_DURATION_MIN', '0')) # 0 = no limit
+ESTIMATED_AUDIO_KBPS = AUDIO_PROFILES[AUDIO_PROFILE][3] # Bitrate of the downloaded audio, for size estimates
+PIPELINE_QUEUE_SIZE = int(os.environ.get('PIPELINE_QUEUE_SIZE', '4')) # Max jobs waiting between two stages (back-pressure)
+VIDEO_MAX_ATTEMPTS = int(os.environ.get('VIDEO_MAX_ATTEMPTS', '5')) # Failed runs of a video before it is no longer retried
+
+# --- Daemon Mode (--daemon) ---
+DAEMON_POLL_INTERVAL_S = float(os.environ.get('DAEMON_POLL_INTERVAL_S', '300'))
+DAEMON_POLL_JITTER_S = float(os.environ.get('DAEMON_POLL_JITTER_S', '30')) # Random extra wait, so instances don't poll in lockstep
+DAEMON_RETRY_FAILED_S = float(os.environ.get('DAEMON_RETRY_FAILED_S', '1800')) # A failed video is retried after this long
+
+# --- Caching ---
+# Set CACHE_ENABLED=false (or pass --no-cache) to neither read nor write the caches below.
+CACHE_ENABLED = os.environ.get('CACHE_ENABLED', 'true').lower() == 'true'
+CACHE_DIR = os.path.join(DATA_DIR, 'cache')
+TRANSCRIPT_CACHE_DIR = os.path.join(CACHE_DIR, 'transcripts')
+TRANSCRIPT_CACHE_MAX_MB = float(os.environ.get('TRANSCRIPT_CACHE_MAX_MB', '200'))
+TRANSCRIPT_CACHE_MAX_AGE_DAYS = float(os.environ.get('TRANSCRIPT_CACHE_MAX_AGE_DAYS', '90'))
+# Also store a hash of the audio and only reuse a transcript made from identical audio.
+# Verification needs the audio, so it is downloaded again (but not re-transcribed).
+TRANSCRIPT_CACHE_VERIFY_AUDIO = os.environ.get('TRANSCRIPT_CACHE_VERIFY_AUDIO', 'false').lower() == 'true'
+TRANSCRIPTION_MODEL_ID = f"{PRIMARY_WHISPER_MODEL}|{FALLBACK_WHISPERX_MODEL}"
+# Downloaded audio is kept (keyed by video ID and format) so a retry skips the download and transcode
+AUDIO_CACHE_DIR = os.path.join(CACHE_DIR, 'audio')
+AUDIO_CACHE_MAX_MB = float(os.environ.get('AUDIO_CACHE_MAX_MB', '2000'))
+AUDIO_CACHE_MAX_AGE_DAYS = float(os.environ.get('AUDIO_CACHE_MAX_AGE_DAYS', '14'))
+AUDIO_CACHE_FORMAT = AUDIO_PROFILE # Format produced by download_audio
+GENERATION_CACHE_DIR = os.path.join(CACHE_DIR, 'gemini')
+GENERATION_CACHE_MAX_ENTRIES = int(os.environ.get('GENERATION_CACHE_MAX_ENTRIES', '500'))
+GEMINI_MODEL_ID = f"{PRIMARY_GEMINI_MODEL}|{FALLBACK_GEMINI_MODEL}"
+
+# --- Rate Limits and Retries ---
+# Requests per minute per model (Replicate, Gemini) or for the whole API (YouTube). Rate-limit
+# errors temporarily lower these; they are only upper bounds.
+PROVIDER_MAX_RPM = {
+    'replicate': float(os.environ.get('REPLICATE_MAX_RPM', '120')),
+    'gemini': float(os.environ.get('GEMINI_MAX_RPM', '30')),
+    'youtube': float(os.environ.get('YOUTUBE_MAX_RPM', '300')),
+}
+RETRY_MAX_ATTEMPTS = int(os.environ.get('RETRY_MAX_ATTEMPTS', '5')) # Per model, for rate limits, 5xx and network errors
+RETRY_BASE_DELAY_S = 2.0
+RETRY_MAX_DELAY_S = 120.0
+CIRCUIT_BREAKER_FAILURES = int(os.environ.get('CIRCUIT_BREAKER_FAILURES', '3')) # Consecutive failures before the primary model is skipped
+CIRCUIT_BREAKER_RESET_S = float(os.environ.get('CIRCUIT_BREAKER_RESET_S', '300')) # How long the fallback is used before retrying the primary
+
+# --- Run Reports and Metrics ---
+RUN_REPORT_DIR = os.environ.get('RUN_REPORT_DIR', os.path.join(DATA_DIR, 'reports')) # One JSON report per run
+RUN_REPORT_KEEP = int(os.environ.get('RUN_REPORT_KEEP', '100')) # Older reports are deleted
+METRICS_TEXTFILE = os.environ.get('METRICS_TEXTFILE', os.path.join(DATA_DIR, 'metrics', 'flashcards.prom')) # Empty = don't write
+
 # --- Logging Setup ---
 # Define log file path within the DATA_DIR
 LOG_FILENAME = 'youtube_flashcard_script.log'
 LOG_FILEPATH = os.path.join(DATA_DIR, LOG_FILENAME)
-
-# Ensure the directory for the log file exists before setting up logging
-try:
-    # Use os.path.dirname to get the directory part of the path
-    log_dir = os.path.dirname(LOG_FILEPATH)
-    if log_dir: # Ensure log_dir is not empty (e.g., if DATA_DIR is '.')
-         os.makedirs(log_dir, exist_ok=True)
-except OSError as e:
-    # If we can't create the directory, we can't log to file.
-    # Print an error to stderr and fall back to basic console logging.
-    print(f"CRITICAL ERROR: Could not create log directory {log_dir}: {e}. File logging disabled.", file=sys.stderr)
-    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
-    # Add a log record about the failure after basicConfig is set
-    logging.critical(f"Failed to create log directory {log_dir}. File logging disabled.")
-    # Depending on severity, you might want to sys.exit(1) here
-else:
-    # If directory exists or was created, proceed with detailed logging setup
-    log_formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(message)s')
-    root_logger = logging.getLogger()
-    root_logger.setLevel(logging.INFO) # Set the minimum level for the logger
-
-    # --- File Handler ---
-    # Use 'a' mode for appending to the log file each run
+_LOGGING_CONFIGURED = False
+
+def setup_logging():
+    """Logs to the console and LOG_FILEPATH. Called by main(); does nothing if logging is already set up."""
+    global _LOGGING_CONFIGURED
+    if _LOGGING_CONFIGURED:
+        return
+    _LOGGING_CONFIGURED = True
+    # Ensure the directory for the log file exists before setting up logging
     try:
-        file_handler = logging.FileHandler(LOG_FILEPATH, mode='a', encoding='utf-8')
-        file_handler.setFormatter(log_formatter)
-        file_handler.setLevel(logging.INFO) # Log INFO level and above to the file
-        root_logger.addHandler(file_handler)
-    except Exception as e:
-        # Handle potential errors opening the file (e.g., permissions)
-        print(f"ERROR: Could not set up file logging handler for {LOG_FILEPATH}: {e}. File logging disabled.", file=sys.stderr)
-        # Fall back to basic console logging if file handler fails
-        logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
-        logging.error(f"Failed to configure file logging handler for {LOG_FILEPATH}. File logging disabled.")
+        # Use os.path.dirname to get the directory part of the path
+        log_dir = os.path.dirname(LOG_FILEPATH)
+        if log_dir: # Ensure log_dir is not empty (e.g., if DATA_DIR is '.')
+             os.makedirs(log_dir, exist_ok=True)
+    except OSError as e:
+        # If we can't create the directory, we can't log to file.
+        # Print an error to stderr and fall back to basic console logging.
+        print(f"CRITICAL ERROR: Could not create log directory {log_dir}: {e}. File logging disabled.", file=sys.stderr)
+        logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(threadName)s - %(levelname)s - %(message)s')
+        # Add a log record about the failure after basicConfig is set
+        logging.critical(f"Failed to create log directory {log_dir}. File logging disabled.")
+        # Depending on severity, you might want to sys.exit(1) here
     else:
-        # --- Console Handler (only add if file handler succeeded or wasn't attempted due to dir error) ---
-        # We still want console output even if file logging setup had an issue,
-        # unless basicConfig already took over. Check if basicConfig was used.
-        if not isinstance(root_logger.handlers[0], logging.StreamHandler) or len(root_logger.handlers) > 1:
-             # Add console handler only if basicConfig didn't already set one up
-             # or if we successfully added the file handler.
-            console_handler = logging.StreamHandler(sys.stdout) # Log to standard output
-            console_handler.setFormatter(log_formatter)
-            console_handler.setLevel(logging.INFO) # Log INFO level and above to the console
-            root_logger.addHandler(console_handler)
-            logging.info(f"Logging configured. Console: INFO+, File: {LOG_FILEPATH} (INFO+)")
-        elif len(root_logger.handlers) == 1 and isinstance(root_logger.handlers[0], logging.FileHandler):
-             # Edge case: File handler added, but basicConfig wasn't called, and we need console too.
-            console_handler = logging.StreamHandler(sys.stdout)
-            console_handler.setFormatter(log_formatter)
-            console_handler.setLevel(logging.INFO)
-            root_logger.addHandler(console_handler)
-            logging.info(f"Logging configured. Console: INFO+, File: {LOG_FILEPATH} (INFO+)")
+        # If directory exists or was created, proceed with detailed logging setup
+        log_formatter = logging.Formatter('%(asctime)s - %(threadName)s - %(levelname)s - %(message)s')
+        root_logger = logging.getLogger()
+        root_logger.setLevel(logging.INFO) # Set the minimum level for the logger
+
+        # --- File Handler ---
+        # Use 'a' mode for appending to the log file each run
+        try:
+            file_handler = logging.FileHandler(LOG_FILEPATH, mode='a', encoding='utf-8')
+            file_handler.setFormatter(log_formatter)
+            file_handler.setLevel(logging.INFO) # Log INFO level and above to the file
+            root_logger.addHandler(file_handler)
+        except Exception as e:
+            # Handle potential errors opening the file (e.g., permissions)
+            print(f"ERROR: Could not set up file logging handler for {LOG_FILEPATH}: {e}. File logging disabled.", file=sys.stderr)
+            # Fall back to basic console logging if file handler fails
+            logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(threadName)s - %(levelname)s - %(message)s')
+            logging.error(f"Failed to configure file logging handler for {LOG_FILEPATH}. File logging disabled.")
+        else:
+            # --- Console Handler (only add if file handler succeeded or wasn't attempted due to dir error) ---
+            # We still want console output even if file logging setup had an issue,
+            # unless basicConfig already took over. Check if basicConfig was used.
+            if not isinstance(root_logger.handlers[0], logging.StreamHandler) or len(root_logger.handlers) > 1:
+                 # Add console handler only if basicConfig didn't already set one up
+                 # or if we successfully added the file handler.
+                console_handler = logging.StreamHandler(sys.stdout) # Log to standard output
+                console_handler.setFormatter(log_formatter)
+                console_handler.setLevel(logging.INFO) # Log INFO level and above to the console
+                root_logger.addHandler(console_handler)
+                logging.info(f"Logging configured. Console: INFO+, File: {LOG_FILEPATH} (INFO+)")
+            elif len(root_logger.handlers) == 1 and isinstance(root_logger.handlers[0], logging.FileHandler):
+                 # Edge case: File handler added, but basicConfig wasn't called, and we need console too.
+                console_handler = logging.StreamHandler(sys.stdout)
+                console_handler.setFormatter(log_formatter)
+                console_handler.setLevel(logging.INFO)
+                root_logger.addHandler(console_handler)
+                logging.info(f"Logging configured. Console: INFO+, File: {LOG_FILEPATH} (INFO+)")
 
 # --- Helper Functions ---
 
@@ -137,9 +280,369 @@ def sanitize_filename(name):
         name = "default_category"
     return name
 
-# --- (load_seen_videos, save_seen_videos, get_youtube_service, fetch_playlist_videos, is_age_restricted, download_audio, get_transcript_replicate remain the same) ---
+def _atomic_write_json(filepath, data, **dump_kwargs):
+    """Writes JSON to a temp file next to filepath and renames it into place."""
+    directory = os.path.dirname(filepath) or '.'
+    os.makedirs(directory, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(prefix='.tmp_', suffix='.json', dir=directory)
+    try:
+        with os.fdopen(fd, 'w', encoding='utf-8') as f:
+            json.dump(data, f, ensure_ascii=False, **dump_kwargs)
+        os.replace(tmp_path, filepath)
+    except BaseException:
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+        raise
+
+def _file_sha256(filepath):
+    """Hashes a file in 1 MB blocks."""
+    digest = hashlib.sha256()
+    with open(filepath, 'rb') as f:
+        for block in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+# --- Rate Limiting and Retries ---
+# Every call to Replicate, Gemini and the YouTube API goes through call_with_retries: a token
+# bucket per provider/model spaces the requests, transient errors are retried with jittered
+# exponential backoff (or the server's Retry-After), and rate-limit errors slow the bucket down
+# for everyone. A circuit breaker per primary model sends work to the fallback model only
+# while the primary keeps failing.
+
+class AdaptiveRateLimiter:
+    """
+    Thread-safe token bucket. Rate-limit errors halve the rate (down to a tenth of the
+    configured one) and can pause the bucket for a Retry-After; successes restore it gradually.
+    """
+
+    def __init__(self, name, max_per_minute):
+        self.name = name
+        self.max_rate = max(max_per_minute, 0.01) / 60.0 # Tokens per second
+        self.min_rate = self.max_rate / 10
+        self.rate = self.max_rate
+        self.burst = max(1.0, self.max_rate * 2) # Up to ~2 seconds worth of requests at once
+        self._tokens = self.burst
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """Blocks until a request may be sent."""
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                if now >= self._paused_until:
+                    self._tokens = min(self.burst, self._tokens + (now - max(self._updated, self._paused_until)) * self.rate)
+                    self._updated = now
+                    if self._tokens >= 1:
+                        self._tokens -= 1
+                        return
+                    wait_s = (1 - self._tokens) / self.rate
+                else:
+                    wait_s = self._paused_until - now
+            time.sleep(wait_s)
+
+    def on_success(self):
+        with self._lock:
+            self.rate = min(self.max_rate, self.rate + self.max_rate / 20)
+
+    def on_rate_limited(self, pause_s=None):
+        with self._lock:
+            self.rate = max(self.min_rate, self.rate / 2)
+            self._tokens = 0.0
+            if pause_s:
+                self._paused_until = max(self._paused_until, time.monotonic() + pause_s)
+        logging.warning(f"Rate limited by {self.name}: slowing to {self.rate * 60:.1f} requests/min"
+                        + (f", pausing {pause_s:.1f}s." if pause_s else "."))
+
+
+class CircuitBreaker:
+    """
+    Opens after CIRCUIT_BREAKER_FAILURES consecutive failures. While open, allow() is False
+    until CIRCUIT_BREAKER_RESET_S have passed; then one trial call is let through (half-open).
+    """
+
+    def __init__(self, name, failure_threshold=None, reset_timeout_s=None):
+        self.name = name
+        self.failure_threshold = failure_threshold or CIRCUIT_BREAKER_FAILURES
+        self.reset_timeout_s = reset_timeout_s or CIRCUIT_BREAKER_RESET_S
+        self._failures = 0
+        self._opened_at = None
+        self._trial_running = False
+        self._lock = threading.Lock()
+
+    def allow(self):
+        with self._lock:
+            if self._opened_at is None:
+                return True
+            if time.monotonic() - self._opened_at >= self.reset_timeout_s and not self._trial_running:
+                self._trial_running = True
+                logging.info(f"Circuit for {self.name} half-open: sending a trial request.")
+                return True
+            return False
+
+    def record_success(self):
+        with self._lock:
+            if self._opened_at is not None:
+                logging.info(f"Circuit for {self.name} closed again.")
+            self._failures = 0
+            self._opened_at = None
+            self._trial_running = False
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            if self._trial_running or (self._opened_at is None and self._failures >= self.failure_threshold):
+                logging.warning(f"Circuit for {self.name} opened after {self._failures} consecutive failures; "
+                                f"using the fallback for {self.reset_timeout_s:.0f}s.")
+                self._opened_at = time.monotonic()
+            self._trial_running = False
+
+
+_RATE_LIMITERS = {}
+_CIRCUIT_BREAKERS = {}
+_RESILIENCE_LOCK = threading.Lock()
+
+def get_rate_limiter(key):
+    """Returns the shared limiter for a 'provider:model' (or 'provider') key."""
+    with _RESILIENCE_LOCK:
+        if key not in _RATE_LIMITERS:
+            provider = key.split(':', 1)[0]
+            _RATE_LIMITERS[key] = AdaptiveRateLimiter(key, PROVIDER_MAX_RPM.get(provider, 60))
+        return _RATE_LIMITERS[key]
+
+def get_circuit_breaker(key):
+    with _RESILIENCE_LOCK:
+        if key not in _CIRCUIT_BREAKERS:
+            _CIRCUIT_BREAKERS[key] = CircuitBreaker(key)
+        return _CIRCUIT_BREAKERS[key]
+
+def _error_status_code(error):
+    """HTTP status of an API error from any of the client libraries, if known."""
+    resp = getattr(error, 'resp', None) # googleapiclient HttpError
+    if resp is not None and str(getattr(resp, 'status', '')).isdigit():
+        return int(resp.status)
+    for attr in ('code', 'status_code', 'status'): # google-genai / google-api-core errors, ReplicateError.status
+        value = getattr(error, attr, None)
+        if isinstance(value, int):
+            return value
+    response = getattr(error, 'response', None) # requests / httpx
+    value = getattr(response, 'status_code', None)
+    return value if isinstance(value, int) else None
+
+def _is_rate_limit_error(error):
+    status = _error_status_code(error)
+    text = str(error).lower()
+    return status == 429 or 'resource_exhausted' in text or 'throttled' in text or 'rate limit' in text or \
+           (status == 403 and ('ratelimitexceeded' in text or 'quotaexceeded' in text))
+
+def _is_transient_error(error):
+    if _is_rate_limit_error(error):
+        return True
+    status = _error_status_code(error)
+    if status is not None:
+        return status == 408 or 500 <= status < 600
+    if isinstance(error, (ConnectionError, TimeoutError)):
+        return True
+    # requests (AnkiConnect) and httpx (Replicate, Gemini) network errors, without importing either here
+    return any(cls.__name__ in ('ConnectionError', 'Timeout', 'TransportError', 'TimeoutException') for cls in type(error).__mro__)
+
+def _retry_after_s(error):
+    """Delay requested by the server (Retry-After header or Gemini's retryDelay), in seconds."""
+    headers = getattr(getattr(error, 'response', None), 'headers', None) or getattr(error, 'resp', None)
+    if headers is not None:
+        value = headers.get('retry-after') or headers.get('Retry-After')
+        if value and str(value).strip().replace('.', '', 1).isdigit():
+            return float(value)
+    match = re.search(r"retryDelay['\"]?\s*:\s*['\"]?(\d+(?:\.\d+)?)s", str(error))
+    return float(match.group(1)) if match else None
+
+def call_with_retries(key, func, *args, **kwargs):
+    """
+    Calls func(*args, **kwargs) through the rate limiter for key ('provider:model'), retrying
+    transient errors up to RETRY_MAX_ATTEMPTS times. Re-raises the last error.
+    """
+    limiter = get_rate_limiter(key)
+    for attempt in range(1, RETRY_MAX_ATTEMPTS + 1):
+        limiter.acquire()
+        try:
+            result = func(*args, **kwargs)
+        except Exception as e:
+            if attempt >= RETRY_MAX_ATTEMPTS or not _is_transient_error(e):
+                raise
+            # Full jitter: anywhere up to the exponential backoff, unless the server said how long to wait
+            delay_s = _retry_after_s(e) or random.uniform(0, min(RETRY_MAX_DELAY_S, RETRY_BASE_DELAY_S * 2 ** attempt))
+            logging.warning(f"{key}: {type(e).__name__}: {str(e)[:200]} - retry {attempt}/{RETRY_MAX_ATTEMPTS - 1} in {delay_s:.1f}s.")
+            RUN_METRICS.incr('retries', provider=key.split(':')[0])
+            if _is_rate_limit_error(e):
+                limiter.on_rate_limited(delay_s) # Holds back every caller sharing this limiter
+            else:
+                time.sleep(delay_s)
+            continue
+        limiter.on_success()
+        return result
+
+
+# --- Instrumentation ---
+# RUN_METRICS collects timed spans (per stage and per external call) and counters for the
+# current run. main() writes them as a JSON report (one file per run, in RUN_REPORT_DIR) and
+# as a Prometheus textfile (METRICS_TEXTFILE, for node_exporter's textfile collector).
+
+class RunMetrics:
+    """
+    Thread-safe spans and counters of one run. Memory stays bounded in a long-running daemon:
+    span counts, errors, totals and maxima cover every span, but the quantiles come from the
+    most recent MAX_SPAN_SAMPLES durations per span, and only the last MAX_VIDEOS videos are kept.
+    """
+
+    MAX_SPAN_SAMPLES = 2048
+    MAX_VIDEOS = 1000
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.started_at = time.time()
+            self._spans = {} # name -> {'count', 'errors', 'total_s', 'max_s', 'recent': deque of duration_s}
+            self._video_spans = collections.OrderedDict() # video ID -> {name: total duration_s}, least recent first
+            self._counters = {} # (name, ((label, value), ...)) -> value
+
+    @contextlib.contextmanager
+    def span(self, name, video_id=None):
+        """Times the enclosed block. Exceptions are recorded as failed spans and re-raised."""
+        start = time.perf_counter()
+        ok = False
+        try:
+            yield
+            ok = True
+        finally:
+            self.record_span(name, time.perf_counter() - start, video_id=video_id, ok=ok)
+
+    def record_span(self, name, duration_s, video_id=None, ok=True):
+        with self._lock:
+            span = self._spans.get(name)
+            if span is None:
+                span = self._spans[name] = {'count': 0, 'errors': 0, 'total_s': 0.0, 'max_s': 0.0,
+                                            'recent': collections.deque(maxlen=self.MAX_SPAN_SAMPLES)}
+            span['count'] += 1
+            span['errors'] += 0 if ok else 1
+            span['total_s'] += duration_s
+            span['max_s'] = max(span['max_s'], duration_s)
+            span['recent'].append(duration_s)
+            if video_id is not None:
+                video = self._video_spans.setdefault(video_id, {})
+                video[name] = video.get(name, 0.0) + duration_s
+                self._video_spans.move_to_end(video_id)
+                while len(self._video_spans) > self.MAX_VIDEOS:
+                    self._video_spans.popitem(last=False)
+
+    def incr(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    @staticmethod
+    def _counter_key(name, labels):
+        return name + ("{" + ",".join(f'{label}="{value}"' for label, value in labels) + "}" if labels else "")
+
+    def summary(self):
+        with self._lock:
+            spans = {name: dict(span, recent=sorted(span['recent'])) for name, span in self._spans.items()}
+            video_spans = {video_id: dict(values) for video_id, values in self._video_spans.items()}
+            counters = dict(self._counters)
+        span_summary = {}
+        for name, span in sorted(spans.items()):
+            durations = span['recent']
+            span_summary[name] = {
+                'count': span['count'],
+                'errors': span['errors'],
+                'total_s': round(span['total_s'], 3),
+                'p50_s': round(durations[int(0.5 * (len(durations) - 1))], 3),
+                'p95_s': round(durations[int(round(0.95 * (len(durations) - 1)))], 3),
+                'max_s': round(span['max_s'], 3),
+            }
+        return {
+            'spans': span_summary,
+            'counters': {self._counter_key(name, labels): value for (name, labels), value in sorted(counters.items())},
+            'videos': {video_id: {name: round(duration, 3) for name, duration in values.items()}
+                       for video_id, values in video_spans.items()},
+        }
+
+    def write_json_report(self, report_dir, run_stats=None):
+        """Writes run_<start time>.json to report_dir (keeping the newest RUN_REPORT_KEEP). Returns its path."""
+        finished_at = time.time()
+        report = {
+            'started_at': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime(self.started_at)),
+            'finished_at': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime(finished_at)),
+            'duration_s': round(finished_at - self.started_at, 3),
+            'run': {key: value for key, value in (run_stats or {}).items() if isinstance(value, (int, float))},
+            **self.summary(),
+        }
+        os.makedirs(report_dir, exist_ok=True)
+        path = os.path.join(report_dir, f"run_{time.strftime('%Y%m%d_%H%M%S', time.localtime(self.started_at))}.json")
+        _atomic_write_json(path, report, indent=2)
+        evict_cache_dir(report_dir, max_entries=RUN_REPORT_KEEP)
+        return path
+
+    def prometheus_text(self, run_stats=None):
+        """The run's metrics in the Prometheus text exposition format."""
+        summary = self.summary()
+        lines = [
+            "# HELP flashcards_last_run_timestamp_seconds Start time of the last playlist check.",
+            "# TYPE flashcards_last_run_timestamp_seconds gauge",
+            f"flashcards_last_run_timestamp_seconds {self.started_at:.3f}",
+            "# HELP flashcards_last_run_duration_seconds Wall-clock duration of the last playlist check.",
+            "# TYPE flashcards_last_run_duration_seconds gauge",
+            f"flashcards_last_run_duration_seconds {time.time() - self.started_at:.3f}",
+        ]
+        for key, value in sorted((run_stats or {}).items()):
+            if isinstance(value, (int, float)) and not isinstance(value, bool):
+                lines += [f"# TYPE flashcards_last_run_{key} gauge", f"flashcards_last_run_{key} {value}"]
+        if summary['spans']:
+            lines += ["# HELP flashcards_span_seconds Duration of pipeline stages and external calls in the last run.",
+                      "# TYPE flashcards_span_seconds summary"]
+            for name, stats in summary['spans'].items():
+                lines += [f'flashcards_span_seconds{{span="{name}",quantile="0.5"}} {stats["p50_s"]}',
+                          f'flashcards_span_seconds{{span="{name}",quantile="0.95"}} {stats["p95_s"]}',
+                          f'flashcards_span_seconds_sum{{span="{name}"}} {stats["total_s"]}',
+                          f'flashcards_span_seconds_count{{span="{name}"}} {stats["count"]}']
+        with self._lock:
+            counters = sorted(self._counters.items())
+        typed = set()
+        for (name, labels), value in counters:
+            if name not in typed:
+                lines.append(f"# TYPE flashcards_last_run_{name} gauge")
+                typed.add(name)
+            lines.append(f"{self._counter_key(f'flashcards_last_run_{name}', labels)} {value}")
+        return "\n".join(lines) + "\n"
+
+    def write_prometheus_textfile(self, path, run_stats=None):
+        """Writes the textfile atomically (the collector may read it at any time)."""
+        directory = os.path.dirname(path) or '.'
+        os.makedirs(directory, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(prefix='.tmp_', suffix='.prom', dir=directory)
+        try:
+            with os.fdopen(fd, 'w', encoding='utf-8') as f:
+                f.write(self.prometheus_text(run_stats))
+            os.replace(tmp_path, path)
+        except BaseException:
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+            raise
+
+
+RUN_METRICS = RunMetrics()
+
+
+# --- Playlist State ---
 def load_seen_videos(filename):
-    """Loads the set of seen video IDs from the state file."""
+    """Loads the set of seen video IDs from the legacy JSON state file."""
     try:
         # Ensure DATA_DIR exists before trying to read
         os.makedirs(os.path.dirname(filename), exist_ok=True)
@@ -155,45 +658,285 @@ def load_seen_videos(filename):
         logging.error(f"Error loading state file '{filename}': {e}")
         return set()
 
-def save_seen_videos(filename, video_ids):
-    """Saves the current set of video IDs to the state file."""
-    try:
-        # Ensure DATA_DIR exists before trying to write
-        os.makedirs(os.path.dirname(filename), exist_ok=True)
-        with open(filename, 'w') as f:
-            json.dump(list(video_ids), f, indent=4)
-        logging.info(f"Successfully saved state to '{filename}'")
-    except Exception as e:
-        logging.error(f"Error saving state file '{filename}': {e}")
+class StateJournal:
+    """
+    Crash-safe record of how far each video got through the pipeline, stored in SQLite.
+
+    Every completed stage (downloaded, transcribed, generated, ingested) is committed as
+    soon as it happens, together with what the next stage needs to resume. A video counts
+    as seen once it reaches 'ingested'. Failed attempts are counted; a video that failed
+    VIDEO_MAX_ATTEMPTS times, or was skipped by a metadata rule, is no longer retried. Lookups hit the database instead of loading
+    the whole history into memory. Safe to share between threads.
+    """
+
+    STAGES = ('queued', 'downloaded', 'transcribed', 'generated', 'ingested')
+
+    def __init__(self, db_path, legacy_state_file=None):
+        os.makedirs(os.path.dirname(db_path) or '.', exist_ok=True)
+        self.db_path = db_path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(db_path, check_same_thread=False, timeout=30)
+        self._conn.row_factory = sqlite3.Row
+        with self._lock, self._conn:
+            self._conn.execute("PRAGMA journal_mode=WAL") # Atomic commits that survive a crash mid-write
+            self._conn.execute("""
+                CREATE TABLE IF NOT EXISTS videos (
+                    video_id TEXT PRIMARY KEY,
+                    title TEXT,
+                    stage TEXT NOT NULL,
+                    stage_rank INTEGER NOT NULL,
+                    updated_at REAL NOT NULL,
+                    audio_file_path TEXT,
+                    transcript TEXT,
+                    generation_json TEXT,
+                    attempts INTEGER NOT NULL DEFAULT 0,
+                    last_error TEXT
+                )""")
+            columns = {row['name'] for row in self._conn.execute("PRAGMA table_info(videos)")}
+            for column, definition in (('attempts', 'INTEGER NOT NULL DEFAULT 0'), ('last_error', 'TEXT')):
+                if column not in columns: # Journal written by an older version
+                    self._conn.execute(f"ALTER TABLE videos ADD COLUMN {column} {definition}")
+            self._conn.execute("CREATE INDEX IF NOT EXISTS idx_videos_stage_rank ON videos (stage_rank)")
+            self._conn.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+        if legacy_state_file:
+            self._import_legacy_state(legacy_state_file)
+
+    def _import_legacy_state(self, legacy_state_file):
+        """One-off import of the old playlist_state.json list of seen IDs."""
+        if not os.path.exists(legacy_state_file) or self.get_meta('legacy_state_imported'):
+            return
+        seen_video_ids = load_seen_videos(legacy_state_file)
+        now = time.time()
+        rank = self.STAGES.index('ingested')
+        with self._lock, self._conn:
+            self._conn.executemany(
+                "INSERT OR IGNORE INTO videos (video_id, stage, stage_rank, updated_at) VALUES (?, 'ingested', ?, ?)",
+                [(video_id, rank, now) for video_id in seen_video_ids])
+            self._conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('legacy_state_imported', ?)", (legacy_state_file,))
+        logging.info(f"Imported {len(seen_video_ids)} seen video IDs from legacy state file '{legacy_state_file}'.")
+
+    def record_stage(self, video_id, stage, title=None, audio_file_path=None, transcript=None, generation_result=None):
+        """
+        Records that a video completed a stage, with the data needed to resume from it.
+        A video never moves back to an earlier stage. Reaching 'ingested' drops the stored payloads.
+        """
+        rank = self.STAGES.index(stage)
+        if stage == 'ingested':
+            audio_file_path = transcript = generation_result = None
+        generation_json = json.dumps(generation_result, ensure_ascii=False) if generation_result is not None else None
+        with self._lock, self._conn:
+            self._conn.execute("""
+                INSERT INTO videos (video_id, title, stage, stage_rank, updated_at, audio_file_path, transcript, generation_json)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+                ON CONFLICT (video_id) DO UPDATE SET
+                    title = COALESCE(excluded.title, videos.title),
+                    stage = excluded.stage,
+                    stage_rank = excluded.stage_rank,
+                    updated_at = excluded.updated_at,
+                    audio_file_path = CASE WHEN excluded.stage = 'ingested' THEN NULL ELSE COALESCE(excluded.audio_file_path, videos.audio_file_path) END,
+                    transcript = CASE WHEN excluded.stage = 'ingested' THEN NULL ELSE COALESCE(excluded.transcript, videos.transcript) END,
+                    generation_json = CASE WHEN excluded.stage = 'ingested' THEN NULL ELSE COALESCE(excluded.generation_json, videos.generation_json) END
+                WHERE excluded.stage_rank >= videos.stage_rank
+                """, (video_id, title, stage, rank, time.time(), audio_file_path, transcript, generation_json))
+
+    def get(self, video_id):
+        """Returns the journal entry of a video as a dict (generation_json decoded to 'generation_result'), or None."""
+        with self._lock:
+            row = self._conn.execute("SELECT * FROM videos WHERE video_id = ?", (video_id,)).fetchone()
+        if row is None:
+            return None
+        entry = dict(row)
+        generation_json = entry.pop('generation_json')
+        entry['generation_result'] = json.loads(generation_json) if generation_json else None
+        return entry
+
+    def filter_unprocessed(self, video_ids):
+        """Returns the subset of video_ids that haven't been ingested yet (or given up on after VIDEO_MAX_ATTEMPTS)."""
+        video_ids = list(video_ids)
+        done = set()
+        rank = self.STAGES.index('ingested')
+        with self._lock:
+            for i in range(0, len(video_ids), 500): # Stay below SQLite's bound-parameter limit
+                batch = video_ids[i:i + 500]
+                placeholders = ",".join("?" * len(batch))
+                rows = self._conn.execute(
+                    f"SELECT video_id FROM videos WHERE (stage_rank >= ? OR attempts >= ?) AND video_id IN ({placeholders})",
+                    [rank, VIDEO_MAX_ATTEMPTS] + batch)
+                done.update(row[0] for row in rows)
+        return set(video_ids) - done
+
+    def pending_videos(self):
+        """
+        Returns {video_id: title} of videos that were queued but haven't been ingested yet,
+        except those that already failed VIDEO_MAX_ATTEMPTS times (dead-lettered).
+        """
+        with self._lock:
+            rows = self._conn.execute("SELECT video_id, title FROM videos WHERE stage_rank < ? AND attempts < ?",
+                                      (self.STAGES.index('ingested'), VIDEO_MAX_ATTEMPTS)).fetchall()
+        return {row['video_id']: row['title'] or "Unknown Title" for row in rows}
+
+    def record_failure(self, video_id, error, title=None):
+        """Counts a failed attempt at a video and stores the error. Returns the number of attempts so far."""
+        with self._lock, self._conn:
+            self._conn.execute("""
+                INSERT INTO videos (video_id, title, stage, stage_rank, updated_at, attempts, last_error)
+                VALUES (?, ?, 'queued', 0, ?, 1, ?)
+                ON CONFLICT (video_id) DO UPDATE SET
+                    title = COALESCE(excluded.title, videos.title),
+                    updated_at = excluded.updated_at,
+                    attempts = videos.attempts + 1,
+                    last_error = excluded.last_error
+                """, (video_id, title, time.time(), str(error)[:1000]))
+            attempts = self._conn.execute("SELECT attempts FROM videos WHERE video_id = ?", (video_id,)).fetchone()[0]
+        if attempts >= VIDEO_MAX_ATTEMPTS:
+            logging.error(f"'{title or video_id}' failed {attempts} times (last error: {str(error)[:200]}). "
+                          f"It won't be retried; delete its row from {self.db_path} to try again.")
+        return attempts
+
+    def record_skip(self, video_id, reason, title=None):
+        """
+        Gives up on a video without trying it (a skip rule matched): it is stored like a video
+        that used up its VIDEO_MAX_ATTEMPTS, so it isn't offered again. Delete its row to retry.
+        """
+        with self._lock, self._conn:
+            self._conn.execute("""
+                INSERT INTO videos (video_id, title, stage, stage_rank, updated_at, attempts, last_error)
+                VALUES (?, ?, 'queued', 0, ?, ?, ?)
+                ON CONFLICT (video_id) DO UPDATE SET
+                    title = COALESCE(excluded.title, videos.title),
+                    updated_at = excluded.updated_at,
+                    attempts = MAX(videos.attempts, excluded.attempts),
+                    last_error = excluded.last_error
+                """, (video_id, title, time.time(), VIDEO_MAX_ATTEMPTS, f"skipped: {reason}"[:1000]))
+
+    def record_playlist_fetch(self, videos, meta=None, listing_complete=False):
+        """
+        Records a playlist fetch in one transaction: every video of videos ({video_id: title}) that
+        isn't in the journal yet is queued, and the meta values (ETag, watermark) are stored. So a
+        crash after the fetch can't leave a new video behind an ETag that says nothing changed.
+        With listing_complete (every page was fetched), unfinished videos that are no longer in the
+        playlist are dropped. Ingested videos are kept, so they stay seen if they are re-added.
+        """
+        now = time.time()
+        with self._lock, self._conn:
+            self._conn.executemany(
+                "INSERT OR IGNORE INTO videos (video_id, title, stage, stage_rank, updated_at) VALUES (?, ?, 'queued', 0, ?)",
+                [(video_id, title, now) for video_id, title in videos.items()])
+            self._conn.executemany("INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)", list((meta or {}).items()))
+            removed = []
+            if listing_complete:
+                unfinished = [row[0] for row in self._conn.execute(
+                    "SELECT video_id FROM videos WHERE stage_rank < ?", (self.STAGES.index('ingested'),))]
+                removed = [video_id for video_id in unfinished if video_id not in videos]
+                self._conn.executemany("DELETE FROM videos WHERE video_id = ?", [(video_id,) for video_id in removed])
+        if removed:
+            logging.info(f"Dropped {len(removed)} unfinished video(s) that are no longer in the playlist from the state journal.")
+
+    def count(self):
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM videos").fetchone()[0]
+
+    def get_meta(self, key, default=None):
+        with self._lock:
+            row = self._conn.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else default
+
+    def set_meta(self, key, value):
+        with self._lock, self._conn:
+            self._conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)", (key, value))
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
 
 def get_youtube_service():
     if not API_KEY:
         logging.error("YOUTUBE_API_KEY environment variable not set.")
         return None
     try:
+        from googleapiclient.discovery import build
         return build(API_SERVICE_NAME, API_VERSION, developerKey=API_KEY)
     except Exception as e:
         logging.error(f"Error building YouTube service: {e}")
         return None
 
-def fetch_playlist_videos(youtube_service, playlist_id):
+def fetch_playlist_videos(youtube_service, playlist_id, journal=None, incremental=None):
+    """
+    Fetches {video_id: title} for a playlist, following nextPageToken across all pages.
+
+    With a journal, the first page is requested with the ETag of the previous fetch; if the
+    playlist is unchanged YouTube answers 304 and an empty dict is returned after a single
+    request. In incremental mode (PLAYLIST_INCREMENTAL), paging stops at the first page that
+    only holds items added at or before the stored publishedAt watermark - this suits playlists
+    where new videos are added to the top. The fetched videos are queued in the journal in the
+    same transaction that stores the new ETag and watermark.
+    """
     if not playlist_id:
         logging.error("YOUTUBE_PLAYLIST_ID environment variable not set.")
         return {}
     if not youtube_service:
         logging.error("YouTube service object is not available.")
         return {}
+    if incremental is None:
+        incremental = PLAYLIST_INCREMENTAL
+    etag_key = f"playlist_etag:{playlist_id}"
+    watermark_key = f"playlist_watermark:{playlist_id}"
+    stored_etag = journal.get_meta(etag_key) if journal and PLAYLIST_USE_ETAG else None
+    watermark = journal.get_meta(watermark_key) if journal else None
+
     current_videos = {}
+    first_page_etag = None
+    newest_published_at = watermark
+    page_token = None
+    pages = 0
+    listing_complete = False # Paged through to the end (not stopped at the watermark)
     try:
-        request = youtube_service.playlistItems().list(part="snippet", playlistId=playlist_id, maxResults=MAX_RESULTS_PER_FETCH)
-        response = request.execute()
-        # TODO: Add pagination logic if playlists might exceed MAX_RESULTS_PER_FETCH
-        for item in response.get('items', []):
-            video_id = item.get('snippet', {}).get('resourceId', {}).get('videoId')
-            video_title = item.get('snippet', {}).get('title')
-            if video_id and video_title:
-                current_videos[video_id] = video_title
-        logging.info(f"Fetched {len(current_videos)} videos from playlist {playlist_id}")
+        while True:
+            request = youtube_service.playlistItems().list(part="snippet", playlistId=playlist_id,
+                                                           maxResults=MAX_RESULTS_PER_FETCH, pageToken=page_token)
+            if pages == 0 and stored_etag:
+                request.headers['If-None-Match'] = stored_etag # Conditional request: 304 if unchanged
+            try:
+                response = call_with_retries('youtube', request.execute)
+            except HttpError as e:
+                if pages == 0 and stored_etag and e.resp.status == 304:
+                    logging.info(f"Playlist {playlist_id} unchanged since last fetch (ETag match).")
+                    return {}
+                raise
+            pages += 1
+            if pages == 1:
+                first_page_etag = response.get('etag')
+
+            page_has_new_items = False
+            for item in response.get('items', []):
+                snippet = item.get('snippet', {})
+                video_id = snippet.get('resourceId', {}).get('videoId')
+                video_title = snippet.get('title')
+                published_at = snippet.get('publishedAt') # When the item was added to the playlist (ISO 8601, sortable)
+                if video_id and video_title:
+                    current_videos[video_id] = video_title
+                if published_at and (watermark is None or published_at > watermark):
+                    page_has_new_items = True
+                    if newest_published_at is None or published_at > newest_published_at:
+                        newest_published_at = published_at
+
+            page_token = response.get('nextPageToken')
+            if not page_token:
+                listing_complete = True
+                break
+            if incremental and watermark and not page_has_new_items:
+                logging.info(f"Reached items older than the watermark {watermark} on page {pages}. Stopping pagination.")
+                break
+
+        logging.info(f"Fetched {len(current_videos)} videos from playlist {playlist_id} ({pages} page(s)).")
+        if journal:
+            meta = {}
+            if first_page_etag:
+                meta[etag_key] = first_page_etag
+            if newest_published_at:
+                meta[watermark_key] = newest_published_at
+            # The ETag and watermark are only stored together with the videos they cover
+            journal.record_playlist_fetch(current_videos, meta, listing_complete=listing_complete)
         return current_videos
     except HttpError as e:
         logging.error(f"An HTTP error {e.resp.status} occurred fetching playlist items: {e.content}")
@@ -202,26 +945,60 @@ def fetch_playlist_videos(youtube_service, playlist_id):
         logging.error(f"An unexpected error occurred fetching playlist items: {e}")
         return {}
 
-def is_age_restricted(youtube_service, video_id):
-    if not youtube_service: return True
-    try:
-        video_request = youtube_service.videos().list(part="contentDetails", id=video_id)
-        video_response = video_request.execute()
-        items = video_response.get('items', [])
-        if not items: return True
-        content_details = items[0].get('contentDetails', {})
-        yt_rating = content_details.get('contentRating', {}).get('ytRating')
-        is_restricted = yt_rating == 'ytAgeRestricted'
-        logging.info(f"Video {video_id} age restricted: {is_restricted}")
-        return is_restricted
-    except HttpError as e:
-        logging.error(f"HTTP error checking age restriction for {video_id}: {e.content}")
-        return True
-    except Exception as e:
-        logging.error(f"Unexpected error checking age restriction for {video_id}: {e}")
-        return True
+_VIDEO_METADATA_CACHE = {} # video_id -> metadata dict, filled by fetch_video_metadata for this run
+_VIDEO_METADATA_LOCK = threading.Lock()
+
+def _parse_iso8601_duration(duration):
+    """Converts a YouTube duration like 'PT1H2M3S' (or 'P1DT2H') to seconds. Returns None if unparseable."""
+    match = re.fullmatch(r'P(?:(\d+)D)?(?:T(?:(\d+)H)?(?:(\d+)M)?(?:(\d+)S)?)?', duration or '')
+    if not match:
+        return None
+    days, hours, minutes, seconds = (int(value or 0) for value in match.groups())
+    return ((days * 24 + hours) * 60 + minutes) * 60 + seconds
+
+def fetch_video_metadata(youtube_service, video_ids):
+    """
+    Returns {video_id: metadata} for the given IDs, using one videos().list call per 50 IDs.
+    Metadata: age_restricted, duration_s, has_captions (manual captions), language and
+    estimated_audio_mb (at ESTIMATED_AUDIO_KBPS). Results are cached for the rest of the run;
+    IDs the API doesn't return (private/deleted) are missing from the result.
+    """
+    video_ids = list(dict.fromkeys(video_ids)) # De-duplicate, keep order
+    with _VIDEO_METADATA_LOCK:
+        missing = [video_id for video_id in video_ids if video_id not in _VIDEO_METADATA_CACHE]
+    if missing and youtube_service:
+        for i in range(0, len(missing), 50): # API maximum per call
+            batch = missing[i:i + 50]
+            try:
+                request = youtube_service.videos().list(part="contentDetails,snippet", id=",".join(batch), maxResults=50)
+                response = call_with_retries('youtube', request.execute)
+            except HttpError as e:
+                logging.error(f"HTTP error fetching metadata for {len(batch)} videos: {e.content}")
+                continue
+            except Exception as e:
+                logging.error(f"Unexpected error fetching metadata for {len(batch)} videos: {e}")
+                continue
+            fetched = dict.fromkeys(batch) # None = not returned by the API; cached too so it isn't re-requested
+            for item in response.get('items', []):
+                content_details = item.get('contentDetails', {})
+                snippet = item.get('snippet', {})
+                duration_s = _parse_iso8601_duration(content_details.get('duration'))
+                fetched[item['id']] = {
+                    'age_restricted': content_details.get('contentRating', {}).get('ytRating') == 'ytAgeRestricted',
+                    'duration_s': duration_s,
+                    'has_captions': content_details.get('caption') == 'true',
+                    'language': snippet.get('defaultAudioLanguage') or snippet.get('defaultLanguage'),
+                    'estimated_audio_mb': duration_s * ESTIMATED_AUDIO_KBPS / 8 / 1024 if duration_s is not None else None,
+                }
+            with _VIDEO_METADATA_LOCK:
+                _VIDEO_METADATA_CACHE.update(fetched)
+        logging.info(f"Fetched metadata for {len(missing)} videos in {math.ceil(len(missing) / 50)} request(s).")
+    with _VIDEO_METADATA_LOCK:
+        return {video_id: _VIDEO_METADATA_CACHE[video_id] for video_id in video_ids
+                if _VIDEO_METADATA_CACHE.get(video_id) is not None}
 
 def download_audio(video_url, output_dir):
+    import yt_dlp
     audio_file_path = None
     # Define the path to your cookie file. Assuming it's in the same directory as the script.
     cookie_file_path = 'cookies.txt'
@@ -232,16 +1009,10 @@ def download_audio(video_url, output_dir):
         logging.info(f"Attempting to download audio for {video_url} to base path: {temp_base}")
 
         # --- yt-dlp Options ---
-        # --- yt-dlp Options ---
+        audio_format, extract_audio, ffmpeg_args, _ = AUDIO_PROFILES[AUDIO_PROFILE]
         ydl_opts = {
-            'format': 'bestaudio/best',
+            'format': audio_format,
             'outtmpl': f'{temp_base}.%(ext)s',
-            'postprocessors': [{
-                'key': 'FFmpegExtractAudio',
-                'preferredcodec': 'mp3',
-                'preferredquality': '128',
-                'nopostoverwrites': False,
-            }],
             'prefer_ffmpeg': True,
             'keepvideo': False,
             # 'quiet': True,        # <--- COMMENT OUT for debugging
@@ -264,7 +1035,20 @@ def download_audio(video_url, output_dir):
         else:
             logging.warning(f"Cookie file not found at '{cookie_file_path}'. Proceeding without cookies...")
 
-        final_audio_path = f"{temp_base}.mp3" # Define the expected final path AFTER conversion
+        # --- Audio Profile: transcode (mp3/speech) or keep the native stream (passthrough) ---
+        if extract_audio:
+            codec, quality = extract_audio
+            ydl_opts['postprocessors'] = [{
+                'key': 'FFmpegExtractAudio',
+                'preferredcodec': codec,
+                'preferredquality': quality,
+                'nopostoverwrites': False,
+            }]
+            if ffmpeg_args:
+                ydl_opts['postprocessor_args'] = {'extractaudio': ffmpeg_args}
+            final_audio_path = f"{temp_base}.{codec}" # Define the expected final path AFTER conversion
+        else:
+            final_audio_path = None # Extension of the native stream is only known after the download
 
         with yt_dlp.YoutubeDL(ydl_opts) as ydl:
             logging.info(f"Starting yt-dlp download for {video_url}")
@@ -272,10 +1056,13 @@ def download_audio(video_url, output_dir):
             error_code = ydl.download([video_url])
 
             if error_code == 0:
-                # Check if the expected MP3 file exists after download and postprocessing
+                if final_audio_path is None:
+                    downloaded = [path for path in glob.glob(glob.escape(temp_base) + ".*") if not path.endswith('.part')]
+                    final_audio_path = downloaded[0] if downloaded else f"{temp_base}.*"
+                # Check if the expected audio file exists after download and postprocessing
                 if os.path.exists(final_audio_path) and os.path.getsize(final_audio_path) > 0:
                     audio_file_path = final_audio_path
-                    logging.info(f"Successfully downloaded and converted audio to {audio_file_path}")
+                    logging.info(f"Successfully downloaded audio ({AUDIO_PROFILE} profile, {os.path.getsize(audio_file_path) / (1024 * 1024):.1f} MB) to {audio_file_path}")
                     return audio_file_path
                 else:
                     # Sometimes the downloaded file might have a different extension temporarily
@@ -286,7 +1073,7 @@ def download_audio(video_url, output_dir):
                     for ext in ['.webm', '.m4a', '.ogg', '.opus']: # Common audio formats yt-dlp might download
                          alt_path = f"{temp_base}{ext}"
                          if os.path.exists(alt_path):
-                              logging.warning(f"Found intermediate file {alt_path}, but MP3 conversion likely failed.")
+                              logging.warning(f"Found intermediate file {alt_path}, but audio conversion likely failed.")
                               # Optionally try to manually convert here, or just report failure
                               found_alternative = True
                               break
@@ -301,13 +1088,13 @@ def download_audio(video_url, output_dir):
         # Specific yt-dlp download errors (like unavailable video, network issues during download)
         logging.error(f"yt-dlp download error for {video_url}: {e}")
         # Clean up potentially partially downloaded files
-        if os.path.exists(f"{temp_base}.mp3.part"): os.remove(f"{temp_base}.mp3.part")
+        for partial_path in glob.glob(glob.escape(temp_base) + ".*.part"): os.remove(partial_path)
         return None
     except Exception as e:
         # Catch other unexpected errors (like issues initializing yt-dlp, filesystem errors)
         logging.error(f"Unexpected error during audio download process for {video_url}: {e}", exc_info=True) # Log traceback
         # Clean up potentially partially downloaded files
-        if os.path.exists(f"{temp_base}.mp3.part"): os.remove(f"{temp_base}.mp3.part")
+        for partial_path in glob.glob(glob.escape(temp_base) + ".*.part"): os.remove(partial_path)
         return None
     finally:
          # Optional: Clean up any leftover intermediate files if the final mp3 wasn't created
@@ -315,6 +1102,102 @@ def download_audio(video_url, output_dir):
          # Be careful not to delete the final mp3 if it *was* created.
          pass
 
+def _caption_track_text(raw_bytes, ext):
+    """Extracts plain text from a json3 or WebVTT caption track."""
+    text = raw_bytes.decode('utf-8', errors='replace')
+    if ext == 'json3':
+        events = json.loads(text).get('events', [])
+        pieces = [seg.get('utf8', '') for event in events for seg in event.get('segs') or []]
+        return re.sub(r'\s+', ' ', "".join(pieces)).strip()
+
+    # WebVTT: drop the header, cue timings and inline tags. Auto-generated tracks repeat the
+    # previous line in every cue (roll-up captions), so consecutive duplicates are skipped.
+    lines = []
+    for line in text.splitlines():
+        line = line.strip()
+        if not line or line == 'WEBVTT' or '-->' in line or line.isdigit() or \
+           line.startswith(('Kind:', 'Language:', 'NOTE', 'STYLE')):
+            continue
+        line = re.sub(r'<[^>]+>', '', line).strip()
+        if line and (not lines or lines[-1] != line):
+            lines.append(line)
+    return re.sub(r'\s+', ' ', " ".join(lines)).strip()
+
+def _pick_caption_track(info):
+    """
+    Picks the best caption track from yt-dlp's info dict following CAPTION_LANGUAGES.
+    Manual subtitles win over automatic captions for the same language.
+    Returns (language, is_automatic, track) or None.
+    """
+    sources = [(False, info.get('subtitles') or {})]
+    if CAPTION_ALLOW_AUTO:
+        sources.append((True, info.get('automatic_captions') or {}))
+    for wanted_lang in CAPTION_LANGUAGES:
+        for is_automatic, tracks_by_lang in sources:
+            for lang, tracks in tracks_by_lang.items():
+                # 'en' also matches regional variants like 'en-US'; auto tracks of the original audio end in '-orig'
+                base_lang = lang[:-len('-orig')] if lang.endswith('-orig') else lang
+                if base_lang != wanted_lang and not base_lang.startswith(f"{wanted_lang}-"):
+                    continue
+                for preferred_ext in ('json3', 'vtt'):
+                    for track in tracks or []:
+                        if track.get('ext') == preferred_ext and track.get('url'):
+                            return lang, is_automatic, track
+    return None
+
+def get_transcript_from_captions(video_url, duration_s=None):
+    """
+    Fetches the video's existing YouTube captions with yt-dlp (no media download).
+    Returns the transcript text, or None if no caption track passes the language and
+    quality settings (CAPTION_LANGUAGES, CAPTION_ALLOW_AUTO, CAPTION_MIN_WORDS_PER_MINUTE).
+    """
+    import yt_dlp
+    ydl_opts = {
+        'skip_download': True,
+        'quiet': True,
+        'no_warnings': True,
+        'noplaylist': True,
+        'user_agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/113.0.0.0 Safari/537.36',
+    }
+    if os.path.exists('cookies.txt'):
+        ydl_opts['cookiefile'] = 'cookies.txt'
+
+    start_time = time.time()
+    try:
+        with yt_dlp.YoutubeDL(ydl_opts) as ydl:
+            info = ydl.extract_info(video_url, download=False)
+            picked = _pick_caption_track(info or {})
+            if not picked:
+                logging.info(f"No suitable caption track for {video_url} (languages: {','.join(CAPTION_LANGUAGES)}).")
+                return None
+            lang, is_automatic, track = picked
+            raw_bytes = ydl.urlopen(track['url']).read()
+    except yt_dlp.utils.DownloadError as e:
+        logging.warning(f"yt-dlp could not read captions for {video_url}: {e}")
+        return None
+    except Exception as e:
+        logging.warning(f"Unexpected error fetching captions for {video_url}: {e}")
+        return None
+
+    try:
+        transcript = _caption_track_text(raw_bytes, track['ext'])
+    except (json.JSONDecodeError, AttributeError) as e:
+        logging.warning(f"Could not parse {track['ext']} caption track for {video_url}: {e}")
+        return None
+
+    # Quality gate: very sparse captions (music, partial tracks) are worse than Whisper
+    word_count = len(transcript.split())
+    duration_s = duration_s or (info or {}).get('duration')
+    if duration_s and word_count / (duration_s / 60) < CAPTION_MIN_WORDS_PER_MINUTE:
+        logging.info(f"Caption track '{lang}' for {video_url} too sparse ({word_count} words in {duration_s / 60:.1f} min). Not using it.")
+        return None
+    if not word_count:
+        return None
+
+    kind = "automatic" if is_automatic else "manual"
+    logging.info(f"Using {kind} '{lang}' captions for {video_url} ({word_count} words, {time.time() - start_time:.2f}s).")
+    return transcript
+
 
 def _parse_replicate_output(output, model_name):
     """Tries to extract transcript from various possible Replicate output structures."""
@@ -365,16 +1248,173 @@ def _parse_replicate_output(output, model_name):
         logging.error(f"Unexpected output format from Replicate model {model_name}: {type(output)}. Output: {output}")
         return None
 
+def _create_replicate_prediction(model_name, model_input):
+    """Starts a prediction for an 'owner/name:version' (or 'owner/name') model without waiting for it."""
+    import replicate
+    model_ref, _, version_id = model_name.partition(':')
+    if version_id:
+        return replicate.predictions.create(version=version_id, input=model_input)
+    return replicate.models.predictions.create(model=model_ref, input=model_input)
+
+
+class ReplicatePredictionError(Exception):
+    """A Replicate prediction ended as 'failed' or 'canceled'."""
+
+    def __init__(self, prediction_id, status, error=None):
+        self.prediction_id = prediction_id
+        self.status = status
+        self.error = error
+        super().__init__(f"Replicate prediction {prediction_id} {status}: {error or 'no error message'}")
+
+
+class ReplicatePredictionPoller:
+    """
+    Tracks in-flight Replicate predictions from a single background thread.
+
+    submit() starts a prediction and returns a Future that resolves to its output. All pending
+    predictions are reloaded every REPLICATE_POLL_INTERVAL_S; one that runs past its deadline
+    (REPLICATE_PREDICTION_TIMEOUT_S) is cancelled and its Future fails with TimeoutError, so a
+    hung prediction only costs its own chunk. The polling replaces replicate.run's blocking wait,
+    but each chunk thread still waits on its Future, so the number of predictions in flight is
+    bounded by TRANSCRIBE_CHUNK_CONCURRENCY x TRANSCRIBE_WORKERS.
+    """
+
+    def __init__(self, poll_interval_s=None, timeout_s=None):
+        self.poll_interval_s = poll_interval_s or REPLICATE_POLL_INTERVAL_S
+        self.timeout_s = timeout_s or REPLICATE_PREDICTION_TIMEOUT_S
+        self._pending = {} # prediction ID -> (prediction, model name, deadline, future)
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._thread = None
+
+    def submit(self, model_name, model_input, timeout_s=None):
+        prediction = _create_replicate_prediction(model_name, model_input)
+        future = concurrent.futures.Future()
+        deadline = time.monotonic() + (timeout_s or self.timeout_s)
+        with self._lock:
+            self._pending[prediction.id] = (prediction, model_name, deadline, future)
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._poll_loop, name="replicate-poller", daemon=True)
+                self._thread.start()
+        self._wakeup.set()
+        logging.info(f"Started Replicate prediction {prediction.id} ({model_name.split(':')[0]}).")
+        return future
+
+    def in_flight(self):
+        with self._lock:
+            return len(self._pending)
+
+    def _resolve(self, prediction_id, result=None, error=None):
+        with self._lock:
+            entry = self._pending.pop(prediction_id, None)
+        if entry is None:
+            return
+        future = entry[3]
+        if error is not None:
+            future.set_exception(error)
+        else:
+            future.set_result(result)
+
+    def _cancel(self, prediction, reason):
+        try:
+            prediction.cancel()
+        except Exception as e:
+            logging.warning(f"Could not cancel Replicate prediction {prediction.id}: {e}")
+        self._resolve(prediction.id, error=TimeoutError(f"Replicate prediction {prediction.id} {reason}"))
+
+    def _poll_loop(self):
+        while True:
+            self._wakeup.wait(self.poll_interval_s)
+            self._wakeup.clear()
+            with self._lock:
+                pending = list(self._pending.items())
+            for prediction_id, (prediction, model_name, deadline, future) in pending:
+                try:
+                    self._poll_one(prediction, model_name, deadline, future)
+                except Exception as e:
+                    # Nothing may kill this thread: every chunk waiting on a Future depends on it
+                    logging.error(f"Unexpected error polling Replicate prediction {prediction_id}: {e}", exc_info=True)
+                    self._resolve(prediction_id, error=e)
+
+    def _poll_one(self, prediction, model_name, deadline, future):
+        if future.cancelled():
+            self._cancel(prediction, "was abandoned")
+            return
+        if time.monotonic() > deadline:
+            logging.warning(f"Replicate prediction {prediction.id} ({model_name.split(':')[0]}) exceeded its deadline; cancelling it.")
+            self._cancel(prediction, "exceeded its deadline")
+            return
+        try:
+            prediction.reload()
+        except Exception as e: # Transient API/network error, try again on the next round
+            logging.debug(f"Polling Replicate prediction {prediction.id} failed: {e}")
+            return
+        if prediction.status == 'succeeded':
+            self._resolve(prediction.id, result=prediction.output)
+        elif prediction.status in ('failed', 'canceled'):
+            self._resolve(prediction.id, error=ReplicatePredictionError(prediction.id, prediction.status, getattr(prediction, 'error', None)))
+
+    def cancel_all(self):
+        """Cancels every prediction still in flight (e.g. at shutdown)."""
+        with self._lock:
+            pending = list(self._pending.values())
+        if pending:
+            logging.info(f"Cancelling {len(pending)} in-flight Replicate predictions.")
+        for prediction, _, _, _ in pending:
+            self._cancel(prediction, "was cancelled at shutdown")
+
+
+_REPLICATE_POLLER = None
+_REPLICATE_POLLER_LOCK = threading.Lock()
+
+def get_replicate_poller():
+    """Returns the process-wide ReplicatePredictionPoller, creating it on first use."""
+    global _REPLICATE_POLLER
+    with _REPLICATE_POLLER_LOCK:
+        if _REPLICATE_POLLER is None:
+            _REPLICATE_POLLER = ReplicatePredictionPoller()
+        return _REPLICATE_POLLER
+
+def _run_replicate_model(model_name, model_input_builder, audio_chunk_path):
+    """
+    Transcribes one chunk with a Replicate model: the prediction is created through the shared
+    rate limiter and retries (reopening the file per attempt), then awaited via the poller.
+    """
+    def submit_once():
+        with open(audio_chunk_path, "rb") as audio_file_chunk:
+            future = get_replicate_poller().submit(model_name, model_input_builder(audio_file_chunk))
+        RUN_METRICS.incr('upload_bytes', os.path.getsize(audio_chunk_path), provider='replicate')
+        return future
+    future = call_with_retries(f"replicate:{model_name}", submit_once)
+    poller = get_replicate_poller()
+    # Backstop in case the poller can't resolve the Future: wait a little past the poller's own deadline
+    wait_s = poller.timeout_s + max(60.0, 5 * poller.poll_interval_s)
+    try:
+        return future.result(timeout=wait_s) # Raises ReplicatePredictionError (failed/canceled) or TimeoutError (deadline)
+    except concurrent.futures.TimeoutError:
+        future.cancel() # The poller cancels the prediction on its next round
+        raise TimeoutError(f"No result from Replicate ({model_name.split(':')[0]}) after {wait_s:.0f}s")
+
 def _run_replicate_on_chunk(audio_chunk_path, attempt_num):
     """Runs Replicate transcription on a single audio chunk path with fallback."""
+    with RUN_METRICS.span('transcribe_chunk'):
+        transcript_chunk = _transcribe_chunk_with_fallback(audio_chunk_path, attempt_num)
+    RUN_METRICS.incr('chunks_transcribed', outcome='ok' if transcript_chunk else 'failed')
+    return transcript_chunk
+
+def _transcribe_chunk_with_fallback(audio_chunk_path, attempt_num):
+    from replicate.exceptions import ReplicateError
     transcript_chunk = None
     start_time_chunk = time.time()
+    primary_breaker = get_circuit_breaker(f"replicate:{PRIMARY_WHISPER_MODEL}")
 
-    # Attempt 1: Primary Model
-    logging.info(f"[Chunk Attempt {attempt_num}] Transcribing chunk {os.path.basename(audio_chunk_path)} with primary model: {PRIMARY_WHISPER_MODEL}")
-    try:
-        with open(audio_chunk_path, "rb") as audio_file_chunk:
-            primary_input = {
+    # Attempt 1: Primary Model (skipped while its circuit breaker is open)
+    if not primary_breaker.allow():
+        logging.info(f"[Chunk Attempt {attempt_num}] Primary model {PRIMARY_WHISPER_MODEL} is failing, using fallback directly.")
+    else:
+        logging.info(f"[Chunk Attempt {attempt_num}] Transcribing chunk {os.path.basename(audio_chunk_path)} with primary model: {PRIMARY_WHISPER_MODEL}")
+        try:
+            primary_input = lambda audio_file_chunk: {
                 "task": "transcribe",
                 "audio": audio_file_chunk,
                 "language": "None",
@@ -382,43 +1422,42 @@ def _run_replicate_on_chunk(audio_chunk_path, attempt_num):
                 "batch_size": 64,
                 "diarise_audio": False
             }
-            # Add a timeout to the replicate run call (e.g., 10 minutes = 600 seconds)
-            # Note: replicate.run doesn't directly support timeout, but you can wrap it or use async with timeout
-            # For simplicity here, we rely on underlying HTTP timeouts or Replicate's own limits.
-            # Consider using replicate.predictions.create() and polling for more control if needed.
-            output = replicate.run(PRIMARY_WHISPER_MODEL, input=primary_input)
-
-        logging.info(f"[Chunk Attempt {attempt_num}] Primary model response received after {time.time() - start_time_chunk:.2f}s.")
-        transcript_chunk = _parse_replicate_output(output, PRIMARY_WHISPER_MODEL)
-        if transcript_chunk:
-             logging.info(f"[Chunk Attempt {attempt_num}] Successfully transcribed chunk with primary model.")
-             return transcript_chunk
-        else:
-             logging.warning(f"[Chunk Attempt {attempt_num}] Primary model ran but yielded no transcript for chunk.")
+            # Waits at most REPLICATE_PREDICTION_TIMEOUT_S; a hung prediction is cancelled and we fall back
+            output = _run_replicate_model(PRIMARY_WHISPER_MODEL, primary_input, audio_chunk_path)
+            primary_breaker.record_success()
 
-    except ReplicateError as e:
-        # Check specifically for 413 or other informative errors if possible
-        logging.warning(f"[Chunk Attempt {attempt_num}] Primary model ({PRIMARY_WHISPER_MODEL}) failed for chunk: {e}. Trying fallback.")
-    except Exception as e:
-        logging.warning(f"[Chunk Attempt {attempt_num}] Unexpected error with primary model for chunk: {e}. Trying fallback.", exc_info=True)
+            logging.info(f"[Chunk Attempt {attempt_num}] Primary model response received after {time.time() - start_time_chunk:.2f}s.")
+            transcript_chunk = _parse_replicate_output(output, PRIMARY_WHISPER_MODEL)
+            if transcript_chunk:
+                 logging.info(f"[Chunk Attempt {attempt_num}] Successfully transcribed chunk with primary model.")
+                 return transcript_chunk
+            else:
+                 logging.warning(f"[Chunk Attempt {attempt_num}] Primary model ran but yielded no transcript for chunk.")
+
+        except (ReplicateError, ReplicatePredictionError, TimeoutError) as e: # API error, failed prediction, deadline
+            # Check specifically for 413 or other informative errors if possible
+            primary_breaker.record_failure()
+            logging.warning(f"[Chunk Attempt {attempt_num}] Primary model ({PRIMARY_WHISPER_MODEL}) failed for chunk: {e}. Trying fallback.")
+        except Exception as e:
+            primary_breaker.record_failure()
+            logging.warning(f"[Chunk Attempt {attempt_num}] Unexpected error with primary model for chunk: {e}. Trying fallback.", exc_info=True)
 
 
     # Attempt 2: Fallback Model (only if primary failed)
     if transcript_chunk is None:
         logging.info(f"[Chunk Attempt {attempt_num}] Attempting fallback model for chunk: {FALLBACK_WHISPERX_MODEL}")
+        RUN_METRICS.incr('fallbacks', provider='replicate')
         fallback_start_time = time.time()
         try:
-            with open(audio_chunk_path, "rb") as audio_file_chunk:
-                fallback_input = {
-                    # Ensure the key is correct for whisperx ('audio_file'?)
-                    "audio_file": audio_file_chunk,
-                    "debug": False,
-                    "batch_size": 64, # Adjust if needed for whisperx
-                    "diarization": False,
-                    # Add other whisperx specific params if needed
-                }
-                # Again, consider timeout mechanisms if runs are very long
-                output = replicate.run(FALLBACK_WHISPERX_MODEL, input=fallback_input)
+            fallback_input = lambda audio_file_chunk: {
+                # Ensure the key is correct for whisperx ('audio_file'?)
+                "audio_file": audio_file_chunk,
+                "debug": False,
+                "batch_size": 64, # Adjust if needed for whisperx
+                "diarization": False,
+                # Add other whisperx specific params if needed
+            }
+            output = _run_replicate_model(FALLBACK_WHISPERX_MODEL, fallback_input, audio_chunk_path)
 
             logging.info(f"[Chunk Attempt {attempt_num}] Fallback model response received after {time.time() - fallback_start_time:.2f}s.")
             transcript_chunk = _parse_replicate_output(output, FALLBACK_WHISPERX_MODEL)
@@ -429,7 +1468,7 @@ def _run_replicate_on_chunk(audio_chunk_path, attempt_num):
                  logging.error(f"[Chunk Attempt {attempt_num}] Fallback model ran but yielded no transcript for chunk.")
                  return None # Failed for this chunk
 
-        except ReplicateError as e:
+        except (ReplicateError, ReplicatePredictionError, TimeoutError) as e:
             logging.error(f"[Chunk Attempt {attempt_num}] Fallback model ({FALLBACK_WHISPERX_MODEL}) also failed for chunk: {e}")
             return None
         except Exception as e:
@@ -439,6 +1478,140 @@ def _run_replicate_on_chunk(audio_chunk_path, attempt_num):
     return transcript_chunk # Return whatever we got (potentially None)
 
 
+def _plan_audio_chunks(duration_ms):
+    """Returns the (start_ms, end_ms) ranges to split an over-sized audio file into, with overlap."""
+    # Aim for chunks of roughly 15 minutes (a size-based estimate would need the bitrate)
+    target_chunk_duration_ms = 15 * 60 * 1000 # 15 minutes
+
+    num_chunks = math.ceil(duration_ms / target_chunk_duration_ms)
+    if num_chunks <= 1: # Should not happen if file_size_mb > MAX_CHUNK_SIZE_MB, but safety check
+         num_chunks = 2 # Force at least two chunks if splitting is triggered
+
+    # Calculate actual chunk length based on desired number of chunks
+    # This distributes the audio more evenly than a fixed duration target
+    actual_chunk_len_ms = math.ceil(duration_ms / num_chunks)
+    logging.info(f"Splitting into {num_chunks} chunks of approx {actual_chunk_len_ms / 1000 / 60:.1f} minutes each.")
+
+    ranges = []
+    for i in range(num_chunks):
+        start_ms = max(0, i * actual_chunk_len_ms - (CHUNK_OVERLAP_MS if i > 0 else 0) ) # Apply overlap after first chunk
+        end_ms = min(duration_ms, (i + 1) * actual_chunk_len_ms)
+        ranges.append((start_ms, end_ms))
+    return ranges
+
+def _check_chunk_size(chunk_index, chunk_filepath):
+    """Warns if an exported chunk is still above MAX_CHUNK_SIZE_MB."""
+    chunk_size_mb = os.path.getsize(chunk_filepath) / (1024 * 1024)
+    if chunk_size_mb > MAX_CHUNK_SIZE_MB * 1.1: # Allow slight overrun
+         logging.warning(f"Chunk {chunk_index+1} size ({chunk_size_mb:.2f} MB) still exceeds limit slightly. Problems may occur.")
+
+def _probe_audio_duration_ms(audio_file_path):
+    """Reads the audio duration from the container metadata with ffprobe (no decoding)."""
+    result = subprocess.run(
+        ["ffprobe", "-v", "error", "-show_entries", "format=duration",
+         "-of", "default=noprint_wrappers=1:nokey=1", audio_file_path],
+        capture_output=True, text=True, timeout=FFMPEG_TIMEOUT_S, check=True,
+    )
+    return int(float(result.stdout.strip()) * 1000)
+
+def _split_audio_ffmpeg(audio_file_path, temp_chunk_dir):
+    """
+    Splits audio into chunk files with ffmpeg stream copy. Cuts land on audio frame
+    boundaries and nothing is decoded or re-encoded, so memory use is constant
+    regardless of the file's duration.
+    Returns ([(chunk_index, chunk_filepath), ...], num_chunks); failed chunks are left out.
+    """
+    duration_ms = _probe_audio_duration_ms(audio_file_path)
+    logging.info(f"Audio duration: {duration_ms / 1000:.2f} seconds")
+    ranges = _plan_audio_chunks(duration_ms)
+    ext = os.path.splitext(audio_file_path)[1] or ".mp3"
+
+    chunk_paths = []
+    for i, (start_ms, end_ms) in enumerate(ranges):
+        chunk_filepath = os.path.join(temp_chunk_dir, f"chunk_{i+1:03d}{ext}")
+        logging.info(f"Cutting chunk {i+1}/{len(ranges)} ({start_ms/1000:.1f}s to {end_ms/1000:.1f}s)")
+        try:
+            # -ss before -i seeks in the input without decoding; -c copy avoids re-encoding
+            subprocess.run(
+                ["ffmpeg", "-v", "error", "-y",
+                 "-ss", f"{start_ms / 1000:.3f}", "-t", f"{(end_ms - start_ms) / 1000:.3f}",
+                 "-i", audio_file_path, "-map", "0:a", "-c", "copy", chunk_filepath],
+                capture_output=True, text=True, timeout=FFMPEG_TIMEOUT_S, check=True,
+            )
+        except subprocess.CalledProcessError as e:
+            logging.error(f"ffmpeg failed to cut chunk {i+1}: {e.stderr.strip()[:500]}")
+            continue # Skip to next chunk, resulting transcript will be partial.
+        except subprocess.TimeoutExpired:
+            logging.error(f"ffmpeg timed out cutting chunk {i+1}.")
+            continue
+        _check_chunk_size(i, chunk_filepath)
+        chunk_paths.append((i, chunk_filepath))
+    return chunk_paths, len(ranges)
+
+def _split_audio_pydub(audio_file_path, temp_chunk_dir):
+    """
+    Splits audio into chunk files by decoding it with pydub and re-encoding every slice.
+    Needs the whole decoded file in RAM; kept for setups where stream copy misbehaves.
+    Returns ([(chunk_index, chunk_filepath), ...], num_chunks); failed chunks are left out.
+    """
+    from pydub import AudioSegment
+    logging.info("Loading audio file with pydub...")
+    audio = AudioSegment.from_file(audio_file_path)
+    duration_ms = len(audio)
+    logging.info(f"Audio duration: {duration_ms / 1000:.2f} seconds")
+    ranges = _plan_audio_chunks(duration_ms)
+
+    chunk_paths = []
+    for i, (start_ms, end_ms) in enumerate(ranges):
+        logging.info(f"Exporting chunk {i+1}/{len(ranges)} ({start_ms/1000:.1f}s to {end_ms/1000:.1f}s)")
+        chunk = audio[start_ms:end_ms]
+        chunk_filepath = os.path.join(temp_chunk_dir, f"chunk_{i+1:03d}.mp3")
+        try:
+            chunk.export(chunk_filepath, format="mp3", bitrate=f"{ESTIMATED_AUDIO_KBPS}k") # Keep the profile's bitrate
+        except Exception as export_err:
+            logging.error(f"Error exporting chunk {i+1}: {export_err}")
+            continue # Skip to next chunk, resulting transcript will be partial.
+        _check_chunk_size(i, chunk_filepath)
+        chunk_paths.append((i, chunk_filepath))
+    return chunk_paths, len(ranges)
+
+def _transcribe_chunks_concurrently(chunk_paths, num_chunks):
+    """
+    Submits all exported chunks to Replicate at once (bounded by TRANSCRIBE_CHUNK_CONCURRENCY)
+    and returns their transcripts in chunk order (None for a chunk that failed). Each chunk keeps its own
+    primary/fallback handling and its file is removed as soon as it is done.
+    """
+    def transcribe_and_cleanup(chunk_index, chunk_filepath):
+        try:
+            return _run_replicate_on_chunk(chunk_filepath, attempt_num=chunk_index + 1)
+        finally:
+            # Clean up the individual chunk file immediately
+            try:
+                os.remove(chunk_filepath)
+            except OSError as e:
+                logging.error(f"Error removing temp chunk {chunk_filepath}: {e}")
+
+    if not chunk_paths:
+        return []
+    max_workers = max(1, min(TRANSCRIBE_CHUNK_CONCURRENCY, len(chunk_paths)))
+    logging.info(f"Transcribing {len(chunk_paths)} chunks with up to {max_workers} in parallel.")
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix=f"{threading.current_thread().name}-chunk") as executor:
+        futures = [executor.submit(transcribe_and_cleanup, chunk_index, chunk_filepath)
+                   for chunk_index, chunk_filepath in chunk_paths]
+
+        all_transcripts = []
+        for (chunk_index, _), future in zip(chunk_paths, futures): # Reassemble in chunk order
+            try:
+                transcript_piece = future.result()
+            except Exception as e:
+                logging.error(f"Unexpected error transcribing chunk {chunk_index + 1}: {e}", exc_info=True)
+                transcript_piece = None
+            all_transcripts.append(transcript_piece or None)
+            if not transcript_piece:
+                logging.warning(f"Transcription failed for chunk {chunk_index + 1}/{num_chunks}. Transcript will be incomplete.")
+    return all_transcripts
+
+
     # --- MODIFIED FUNCTION with Fallback ---
 def get_transcript_replicate(audio_file_path):
     """
@@ -452,11 +1625,6 @@ def get_transcript_replicate(audio_file_path):
         logging.error(f"Audio file not found at {audio_file_path}")
         return None
 
-    # --- Configuration for Splitting ---
-    # Max chunk size in MB (adjust based on observed Replicate limits, maybe 20-24MB)
-    MAX_CHUNK_SIZE_MB = 20
-    CHUNK_OVERLAP_MS = 5000 # 5 seconds overlap to help catch words split at boundaries
-
     file_size_mb = os.path.getsize(audio_file_path) / (1024 * 1024)
     logging.info(f"Audio file size: {file_size_mb:.2f} MB")
 
@@ -468,81 +1636,33 @@ def get_transcript_replicate(audio_file_path):
         return full_transcript # May be None if transcription fails
     else:
         # File is too large, split it
-        logging.info(f"Audio file size exceeds {MAX_CHUNK_SIZE_MB} MB. Splitting into chunks.")
-        all_transcripts = []
-        temp_chunk_dir = os.path.join(os.path.dirname(audio_file_path), "audio_chunks")
-        os.makedirs(temp_chunk_dir, exist_ok=True)
+        logging.info(f"Audio file size exceeds {MAX_CHUNK_SIZE_MB} MB. Splitting into chunks ({AUDIO_SPLIT_MODE} mode).")
+        from pydub.exceptions import CouldntDecodeError
+        # Per-file chunk dir so concurrent transcription workers don't overwrite each other's chunks
+        chunk_parent_dir = None if is_cached_audio(audio_file_path) else os.path.dirname(audio_file_path) # Keep chunks out of the cache
+        temp_chunk_dir = tempfile.mkdtemp(prefix="audio_chunks_", dir=chunk_parent_dir)
 
         try:
-            logging.info("Loading audio file with pydub...")
-            audio = AudioSegment.from_mp3(audio_file_path)
-            duration_ms = len(audio)
-            logging.info(f"Audio duration: {duration_ms / 1000:.2f} seconds")
-
-            # Estimate chunk duration based on size (approximate)
-            # bitrate = (file_size_mb * 1024 * 1024 * 8) / (duration_ms / 1000) # bits/sec
-            # max_duration_ms = (MAX_CHUNK_SIZE_MB * 1024 * 1024 * 8) / bitrate * 1000 if bitrate > 0 else duration_ms
-            # Simpler: Aim for chunks of roughly 15-20 minutes if splitting
-            target_chunk_duration_ms = 15 * 60 * 1000 # 15 minutes
-
-            num_chunks = math.ceil(duration_ms / target_chunk_duration_ms)
-            if num_chunks <= 1: # Should not happen if file_size_mb > MAX_CHUNK_SIZE_MB, but safety check
-                 num_chunks = 2 # Force at least two chunks if splitting is triggered
-
-            # Calculate actual chunk length based on desired number of chunks
-            # This distributes the audio more evenly than a fixed duration target
-            actual_chunk_len_ms = math.ceil(duration_ms / num_chunks)
-
-            logging.info(f"Splitting into {num_chunks} chunks of approx {actual_chunk_len_ms / 1000 / 60:.1f} minutes each.")
-
-            for i in range(num_chunks):
-                start_ms = max(0, i * actual_chunk_len_ms - (CHUNK_OVERLAP_MS if i > 0 else 0) ) # Apply overlap after first chunk
-                end_ms = min(duration_ms, (i + 1) * actual_chunk_len_ms)
-                logging.info(f"Processing chunk {i+1}/{num_chunks} ({start_ms/1000:.1f}s to {end_ms/1000:.1f}s)")
-
-                chunk = audio[start_ms:end_ms]
-                chunk_filename = f"chunk_{i+1:03d}.mp3"
-                chunk_filepath = os.path.join(temp_chunk_dir, chunk_filename)
-
-                try:
-                    logging.info(f"Exporting chunk {i+1} to {chunk_filepath}")
-                    chunk.export(chunk_filepath, format="mp3", bitrate="128k") # Ensure bitrate consistency
-                except Exception as export_err:
-                    logging.error(f"Error exporting chunk {i+1}: {export_err}")
-                    # Decide how to handle: skip chunk? fail all?
-                    # For now, log and continue, resulting transcript will be partial.
-                    continue # Skip to next chunk
-
-                # Check chunk size before sending (optional sanity check)
-                chunk_size_mb = os.path.getsize(chunk_filepath) / (1024 * 1024)
-                if chunk_size_mb > MAX_CHUNK_SIZE_MB * 1.1: # Allow slight overrun
-                     logging.warning(f"Chunk {i+1} size ({chunk_size_mb:.2f} MB) still exceeds limit slightly. Problems may occur.")
-
-                # Transcribe the individual chunk
-                transcript_piece = _run_replicate_on_chunk(chunk_filepath, attempt_num=i+1)
-
-                if transcript_piece:
-                    all_transcripts.append(transcript_piece)
+            with RUN_METRICS.span('split'):
+                if AUDIO_SPLIT_MODE == 'pydub':
+                    chunk_paths, num_chunks = _split_audio_pydub(audio_file_path, temp_chunk_dir)
                 else:
-                    logging.warning(f"Transcription failed for chunk {i+1}. Transcript will be incomplete.")
-                    # Optionally: add a placeholder? "[TRANSCRIPTION FAILED FOR CHUNK]"
-                    # all_transcripts.append("[TRANSCRIPTION FAILED]") # Or just skip
+                    chunk_paths, num_chunks = _split_audio_ffmpeg(audio_file_path, temp_chunk_dir)
 
-                # Clean up the individual chunk file immediately
-                try:
-                    os.remove(chunk_filepath)
-                    # logging.debug(f"Removed temp chunk: {chunk_filepath}")
-                except OSError as e:
-                    logging.error(f"Error removing temp chunk {chunk_filepath}: {e}")
+            all_transcripts = _transcribe_chunks_concurrently(chunk_paths, num_chunks)
 
-            # Combine transcripts
-            final_transcript = " ".join(all_transcripts).strip()
+            # Combine transcripts, removing the text repeated by the chunk overlap
+            final_transcript = stitch_transcript_chunks(all_transcripts)
+            logging.info(f"Stitched {num_chunks} chunk transcripts: ~{estimate_tokens(' '.join(t for t in all_transcripts if t))} tokens -> ~{estimate_tokens(final_transcript)} tokens.")
             logging.info("Finished processing all chunks.")
             return final_transcript if final_transcript else None
 
         except CouldntDecodeError:
             logging.error(f"Pydub could not decode the audio file: {audio_file_path}. Is ffmpeg installed and accessible?", exc_info=True)
             return None
+        except FileNotFoundError as e:
+            logging.error(f"ffmpeg/ffprobe not found while splitting {audio_file_path}: {e}. Is ffmpeg installed and in PATH?")
+            return None
         except Exception as e:
             logging.error(f"An error occurred during audio splitting: {e}", exc_info=True)
             return None
@@ -558,133 +1678,259 @@ def get_transcript_replicate(audio_file_path):
 
 
 
-# --- Gemini Function (MODIFIED with Fallback Logic) ---
-def generate_flashcards_from_transcript(transcript_text, title):
+# --- Transcription Engines ---
+# A TranscriptionEngine turns an audio file into text. stage_transcribe picks the engines for a
+# video with select_transcription_engines() and falls back to the next one if an engine fails.
+
+class TranscriptionEngine:
+    """Interface of a transcription backend."""
+
+    name = None
+    model_id = None # Identifies the model(s) and settings, e.g. for the transcript cache key
+
+    def is_available(self):
+        return True
+
+    def transcribe(self, audio_file_path):
+        """Returns the transcript text, or None on failure (errors are logged)."""
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+
+class ReplicateTranscriptionEngine(TranscriptionEngine):
+    """Uploads the audio (split into chunks if needed) to the Replicate Whisper models, with fallback per chunk."""
+
+    name = 'replicate'
+    model_id = TRANSCRIPTION_MODEL_ID
+
+    def is_available(self):
+        return bool(REPLICATE_API_TOKEN)
+
+    def transcribe(self, audio_file_path):
+        return get_transcript_replicate(audio_file_path)
+
+
+_LOCAL_WHISPER_MODEL = None # faster_whisper.WhisperModel of a local transcription worker process
+
+def _init_local_whisper_worker(model_size, compute_type, cpu_threads):
+    """Process pool initializer: loads the model once per worker process."""
+    global _LOCAL_WHISPER_MODEL
+    from faster_whisper import WhisperModel
+    _LOCAL_WHISPER_MODEL = WhisperModel(model_size, device='cpu', compute_type=compute_type, cpu_threads=cpu_threads)
+
+def _local_whisper_transcribe(audio_file_path):
+    """Runs in a worker process. Returns (transcript, detected language, audio duration in seconds)."""
+    segments, info = _LOCAL_WHISPER_MODEL.transcribe(audio_file_path, vad_filter=True)
+    # segments is a generator: the audio is transcribed while it is consumed
+    transcript = " ".join(segment.text.strip() for segment in segments).strip()
+    return transcript, info.language, info.duration
+
+
+class LocalWhisperTranscriptionEngine(TranscriptionEngine):
     """
-    Generates Anki flashcards using Gemini API with fallback model logic.
-    Tries PRIMARY_GEMINI_MODEL first, falls back to FALLBACK_GEMINI_MODEL on error.
-    Assumes Gemini returns JSON string with 'category' and 'flashcards'.
-    Returns the parsed dictionary or None on error after fallback.
+    faster-whisper (CTranslate2) on this machine's CPUs: no upload, no per-minute cost.
+
+    Transcription runs in a pool of worker processes, each holding one model and using
+    cpu_threads cores, so a machine with N cores transcribes N // cpu_threads files at once.
+    The pool is created on first use and kept for the life of the process (see --daemon).
     """
-    if not GEMINI_API_KEY:
-        logging.error("GEMINI_API_KEY environment variable not set.")
-        return None
-    if not transcript_text or not transcript_text.strip():
-        logging.warning("Transcript text is empty. Skipping flashcard generation.")
-        return None
 
-    logging.info("Initializing Gemini client...")
-    try:
-        client = genai.Client(api_key=GEMINI_API_KEY)
-    except Exception as e:
-        logging.error(f"Failed to initialize Gemini client: {e}")
+    name = 'local'
+
+    def __init__(self, model_size=None, compute_type=None, cpu_threads=None, workers=None):
+        self.model_size = model_size or LOCAL_WHISPER_MODEL
+        self.compute_type = compute_type or LOCAL_WHISPER_COMPUTE_TYPE
+        self.cpu_threads = max(1, cpu_threads or LOCAL_WHISPER_CPU_THREADS)
+        workers = workers or LOCAL_WHISPER_WORKERS
+        self.workers = workers if workers > 0 else max(1, (os.cpu_count() or 1) // self.cpu_threads)
+        self.model_id = f"faster-whisper:{self.model_size}:{self.compute_type}"
+        self._pool = None
+        self._lock = threading.Lock()
+        self._disabled = importlib.util.find_spec('faster_whisper') is None # Checked without importing it
+
+    def is_available(self):
+        return not self._disabled
+
+    def _get_pool(self):
+        with self._lock:
+            if self._pool is None:
+                logging.info(f"Starting {self.workers} local transcription worker(s) ({self.model_id}, {self.cpu_threads} CPU threads each).")
+                # 'spawn': forking a process that runs many threads (and holds SQLite connections) isn't safe
+                self._pool = concurrent.futures.ProcessPoolExecutor(
+                    max_workers=self.workers, mp_context=multiprocessing.get_context('spawn'),
+                    initializer=_init_local_whisper_worker, initargs=(self.model_size, self.compute_type, self.cpu_threads))
+            return self._pool
+
+    def transcribe(self, audio_file_path):
+        start_time = time.time()
+        try:
+            with RUN_METRICS.span('transcribe_local'):
+                transcript, language, duration_s = self._get_pool().submit(_local_whisper_transcribe, audio_file_path).result()
+        except concurrent.futures.BrokenExecutor as e:
+            # The model couldn't be loaded (or a worker died); don't retry it for every video
+            logging.error(f"Local transcription workers failed ({e}). Local transcription is disabled for this run.")
+            self._disabled = True
+            self.close()
+            return None
+        except Exception as e:
+            logging.error(f"Local transcription of {audio_file_path} failed: {e}", exc_info=True)
+            return None
+        elapsed_s = time.time() - start_time
+        logging.info(f"Transcribed {duration_s / 60:.1f} min of audio locally in {elapsed_s:.1f}s "
+                     f"({duration_s / max(elapsed_s, 0.001):.1f}x real time, language '{language}').")
+        return transcript or None
+
+    def close(self):
+        with self._lock:
+            pool, self._pool = self._pool, None
+        if pool is not None:
+            pool.shutdown(wait=False, cancel_futures=True)
+
+
+_TRANSCRIPTION_ENGINES = {}
+_TRANSCRIPTION_ENGINES_LOCK = threading.Lock()
+_TRANSCRIPTION_ENGINE_CLASSES = {'replicate': ReplicateTranscriptionEngine, 'local': LocalWhisperTranscriptionEngine}
+_ENGINES_REPORTED_UNAVAILABLE = set()
+
+def get_transcription_engine(name):
+    """Returns the shared engine instance for 'replicate' or 'local'."""
+    with _TRANSCRIPTION_ENGINES_LOCK:
+        if name not in _TRANSCRIPTION_ENGINES:
+            _TRANSCRIPTION_ENGINES[name] = _TRANSCRIPTION_ENGINE_CLASSES[name]()
+        return _TRANSCRIPTION_ENGINES[name]
+
+def close_transcription_engines():
+    with _TRANSCRIPTION_ENGINES_LOCK:
+        engines = list(_TRANSCRIPTION_ENGINES.values())
+    for engine in engines:
+        engine.close()
+
+def select_transcription_engines(duration_s):
+    """
+    The available engines to try for a video, in order. TRANSCRIPTION_ENGINE 'auto' sends videos
+    up to LOCAL_TRANSCRIPTION_MAX_MIN (or of unknown duration) to the local engine first and longer
+    ones to Replicate first; each falls back to the other.
+    """
+    if TRANSCRIPTION_ENGINE == 'replicate':
+        names = ['replicate']
+    elif TRANSCRIPTION_ENGINE == 'local':
+        names = ['local', 'replicate']
+    elif duration_s is None or duration_s <= LOCAL_TRANSCRIPTION_MAX_MIN * 60:
+        names = ['local', 'replicate']
+    else:
+        names = ['replicate', 'local']
+    engines = [get_transcription_engine(name) for name in names]
+    available = [engine for engine in engines if engine.is_available()]
+    if engines[0] not in available and available and engines[0].name not in _ENGINES_REPORTED_UNAVAILABLE:
+        _ENGINES_REPORTED_UNAVAILABLE.add(engines[0].name) # Warn once, not for every video
+        logging.warning(f"Transcription engine '{engines[0].name}' is not available "
+                        f"({'faster-whisper is not installed' if engines[0].name == 'local' else 'REPLICATE_API_TOKEN not set'}); "
+                        f"using '{available[0].name}'.")
+    return available
+
+def transcribe_audio(audio_file_path, engines):
+    """Transcribes with the first engine that succeeds. Returns the transcript or None."""
+    if not engines:
+        logging.error("No transcription engine available (set REPLICATE_API_TOKEN or install faster-whisper).")
         return None
+    for index, engine in enumerate(engines):
+        if index:
+            logging.warning(f"Falling back to the '{engine.name}' transcription engine.")
+            RUN_METRICS.incr('fallbacks', provider='transcription')
+        transcript = engine.transcribe(audio_file_path)
+        RUN_METRICS.incr('transcriptions', engine=engine.name, outcome='ok' if transcript else 'failed')
+        if transcript:
+            return transcript
+    return None
 
-    # --- Prepare Content (same for both models) ---
-    contents = [
-        types.Content(
-            role="user",
-            parts=[
-                types.Part.from_text(text=f"""Video Title: {title}\n\nVideo Transcript: {transcript_text}"""),
-            ],
-        ),
-    ]
-    try:
-        with open("system_prompt.txt", "r", encoding="utf-8") as file:
-            system_instruction_text = file.read()
-    except FileNotFoundError:
-         logging.error("system_prompt.txt not found!")
-         return None
-    except Exception as e:
-         logging.error(f"Error reading system_prompt.txt: {e}")
-         return None
-
-    generate_content_config = types.GenerateContentConfig(
-        # Request JSON output if supported, otherwise parse text
-        # response_mime_type="application/json",
-        response_mime_type="text/plain",
-        system_instruction=[
-            types.Part.from_text(text=system_instruction_text),
-        ],
-    )
 
-    # --- Attempt with Primary Model ---
-    current_model_name = PRIMARY_GEMINI_MODEL
-    response_stream = None
-    generated_text = ""
+# --- Transcript Compaction ---
+# Chunked transcription repeats the CHUNK_OVERLAP_MS of audio at every chunk boundary, and
+# spoken transcripts are full of filler words. Both cost prompt tokens without adding content.
 
-    logging.info(f"Attempting generation with primary model: {current_model_name}")
-    try:
-        response_stream = client.models.generate_content_stream(
-            model=current_model_name,
-            contents=contents,
-            config=generate_content_config,
-        )
-        logging.info(f"Successfully initiated stream with {current_model_name}.")
+_STITCH_MAX_WORDS_PER_S = 4 # Upper bound of speech rate, to size the overlap in words
+_STITCH_ANCHOR_WORDS = 4 # Words cut off (or garbled) at a chunk edge that the overlap may skip
+_STITCH_WINDOW_WORDS = math.ceil(CHUNK_OVERLAP_MS / 1000 * _STITCH_MAX_WORDS_PER_S) + 2 * _STITCH_ANCHOR_WORDS
+_STITCH_MIN_MATCH_WORDS = 6 # Shorter matches are treated as coincidence
+_FILLER_RE = re.compile(r"(?:,\s*)?(?<![\w'-])(?:" + "|".join(re.escape(word) for word in TRANSCRIPT_FILLER_WORDS) + r")(?![\w'-])(?:,|\.\.\.|…)?",
+                        re.IGNORECASE) if TRANSCRIPT_FILLER_WORDS else None
 
-        # Process the stream if initiated successfully
-        logging.info(f"Receiving stream from {current_model_name}...")
-        for chunk in response_stream:
-            if chunk.text:
-                 generated_text += chunk.text
-        logging.info(f"Finished receiving stream from {current_model_name}.")
-
-    except (google_api_exceptions.NotFound, # Model not found
-            google_api_exceptions.PermissionDenied, # User doesn't have access
-            google_api_exceptions.ResourceExhausted, # Quota issues
-            google_api_exceptions.InternalServerError, # Server-side issues
-            google_api_exceptions.ServiceUnavailable,
-            types.StopCandidateException, # Safety stops etc.
-            types.BrokenResponseError,
-            Exception # Catch broader errors too
-           ) as e:
-        logging.warning(f"Primary model ({current_model_name}) failed: {type(e).__name__}: {e}. Attempting fallback.")
-        response_stream = None # Ensure stream is invalidated
-        generated_text = ""    # Reset generated text
-
-    # --- Attempt with Fallback Model (if primary failed) ---
-    if response_stream is None: # Check if primary attempt failed
-        current_model_name = FALLBACK_GEMINI_MODEL
-        logging.info(f"Attempting generation with fallback model: {current_model_name}")
-        try:
-            response_stream = client.models.generate_content_stream(
-                model=current_model_name,
-                contents=contents,
-                config=generate_content_config,
-            )
-            logging.info(f"Successfully initiated stream with {current_model_name}.")
-
-            # Process the stream if initiated successfully
-            logging.info(f"Receiving stream from {current_model_name}...")
-            for chunk in response_stream:
-                if chunk.text:
-                     generated_text += chunk.text
-            logging.info(f"Finished receiving stream from {current_model_name}.")
-
-        except (google_api_exceptions.NotFound,
-                google_api_exceptions.PermissionDenied,
-                google_api_exceptions.ResourceExhausted,
-                google_api_exceptions.InternalServerError,
-                google_api_exceptions.ServiceUnavailable,
-                types.StopCandidateException,
-                types.BrokenResponseError,
-                Exception
-               ) as e:
-            logging.error(f"Fallback model ({current_model_name}) also failed: {type(e).__name__}: {e}")
-            response_stream = None # Indicate failure
-            generated_text = ""    # Reset generated text
-
-    # --- Process the final result (if any attempt succeeded) ---
-    if not generated_text.strip() and response_stream is not None:
-         # Handle case where stream finished but produced empty text
-         logging.warning(f"Gemini model ({current_model_name}) finished but generated empty text content.")
-         return None
-    elif not generated_text.strip() and response_stream is None:
-         # Handle case where both models failed to even start the stream or errored out
-         logging.error(f"Both primary and fallback models failed to generate content.")
-         return None
-
-    # --- Parse the generated text as JSON (from whichever model succeeded) ---
+def estimate_tokens(text):
+    """Rough token count for prompt-size logging (about 4 characters per token)."""
+    return math.ceil(len(text or "") / 4)
+
+def _stitch_key(word):
+    return re.sub(r"[^\w']", "", word.lower())
+
+def _find_chunk_overlap(tail, head):
+    """
+    Finds the repeated overlap between the end of one chunk transcript (tail) and the start of
+    the next (head), both lists of normalized words. The overlap must end within
+    _STITCH_ANCHOR_WORDS of the tail's end and start within _STITCH_ANCHOR_WORDS of the head's start.
+    Returns (tail_cut, head_start), the tail index where the overlap starts and the head index to
+    continue from, or None if there is no overlap of at least _STITCH_MIN_MATCH_WORDS words.
+    """
+    best = None # (size, tail_cut, head_start)
+    for tail_skip in range(min(_STITCH_ANCHOR_WORDS, len(tail)) + 1):
+        tail_end = len(tail) - tail_skip
+        for head_start in range(min(_STITCH_ANCHOR_WORDS, len(head)) + 1):
+            size = min(tail_end, len(head) - head_start)
+            while size >= _STITCH_MIN_MATCH_WORDS and tail[tail_end - size:tail_end] != head[head_start:head_start + size]:
+                size -= 1
+            if size >= _STITCH_MIN_MATCH_WORDS and (best is None or size > best[0]):
+                best = (size, tail_end - size, head_start)
+    return best[1:] if best else None
+
+def stitch_transcript_chunks(transcripts):
+    """
+    Joins the transcripts of overlapping audio chunks, dropping the text that was transcribed
+    twice. The end of each transcript is aligned with the start of the next on normalized words
+    (see _find_chunk_overlap); if they don't overlap they are simply joined. A None entry marks a
+    chunk that failed: the transcripts on either side of it are joined without stitching.
+    """
+    stitched = []
+    previous_missing = False
+    for transcript in transcripts:
+        words = (transcript or "").split()
+        if not words:
+            previous_missing = True
+            continue
+        if stitched and not previous_missing:
+            tail_start = max(0, len(stitched) - _STITCH_WINDOW_WORDS)
+            tail = [_stitch_key(word) for word in stitched[tail_start:]]
+            head = [_stitch_key(word) for word in words[:_STITCH_WINDOW_WORDS]]
+            overlap = _find_chunk_overlap(tail, head)
+            if overlap:
+                # Keep the previous chunk up to the overlap and continue from the overlap in this one
+                tail_cut, head_start = overlap
+                del stitched[tail_start + tail_cut:]
+                words = words[head_start:]
+            else:
+                logging.debug("No overlap found at chunk boundary, joining transcripts as they are.")
+        stitched.extend(words)
+        previous_missing = False
+    return " ".join(stitched)
+
+def compact_transcript(text):
+    """Strips filler words (TRANSCRIPT_FILLER_WORDS) and normalizes whitespace."""
+    if not text:
+        return text
+    if _FILLER_RE is not None:
+        text = _FILLER_RE.sub(" ", text)
+        text = re.sub(r"([.!?;:,])\s+[.,](?=\s|$)", r"\1", text) # "here. Hmm." left "here. ."
+        text = re.sub(r"\s+([,.!?;:])", r"\1", text) # Space left before punctuation by a removed filler
+        text = re.sub(r"^[\s,.]+", "", text)
+    return re.sub(r"\s+", " ", text).strip()
+
+
+# --- Gemini Function (MODIFIED with Fallback Logic) ---
+def _parse_flashcard_response(generated_text, current_model_name):
+    """
+    Parses Gemini's text output (optionally wrapped in markdown fences) as the flashcard JSON
+    and validates its structure. Returns the parsed dictionary or None.
+    """
     try:
         clean_text = generated_text.strip()
         if clean_text.startswith("```json"):
@@ -729,6 +1975,270 @@ def generate_flashcards_from_transcript(transcript_text, title):
         return None
 
 
+class GenerationService:
+    """
+    Long-lived, thread-safe flashcard generator.
+
+    Owns a single Gemini client for the whole run, so its HTTP connections are reused
+    across videos and worker threads, and keeps the system prompt in memory. With
+    watch_system_prompt the prompt file's mtime is checked on each call and the prompt
+    is reloaded when it changes.
+    """
+
+    def __init__(self, api_key=None, system_prompt_file=None, watch_system_prompt=None):
+        self.api_key = api_key if api_key is not None else GEMINI_API_KEY
+        self.system_prompt_file = system_prompt_file or SYSTEM_PROMPT_FILE
+        self.watch_system_prompt = SYSTEM_PROMPT_WATCH if watch_system_prompt is None else watch_system_prompt
+        self._client = None
+        self._client_lock = threading.Lock()
+        self._prompt_lock = threading.Lock()
+        self._system_prompt = None
+        self._system_prompt_mtime = None
+        self._content_config = None
+
+    def _get_client(self):
+        with self._client_lock:
+            if self._client is None:
+                logging.info("Initializing Gemini client...")
+                from google import genai
+                self._client = genai.Client(api_key=self.api_key)
+            return self._client
+
+    def _get_system_prompt(self):
+        """Returns (system prompt text, GenerateContentConfig), loading the file once (or on change if watched)."""
+        from google.genai import types
+        with self._prompt_lock:
+            if self._system_prompt is None or self.watch_system_prompt:
+                try:
+                    mtime = os.path.getmtime(self.system_prompt_file)
+                    if self._system_prompt is None or mtime != self._system_prompt_mtime:
+                        with open(self.system_prompt_file, "r", encoding="utf-8") as file:
+                            system_instruction_text = file.read()
+                        if self._system_prompt is not None:
+                            logging.info(f"{self.system_prompt_file} changed. Reloaded system prompt.")
+                        self._system_prompt = system_instruction_text
+                        self._system_prompt_mtime = mtime
+                        self._content_config = types.GenerateContentConfig(
+                            # Request JSON output if supported, otherwise parse text
+                            # response_mime_type="application/json",
+                            response_mime_type="text/plain",
+                            system_instruction=[
+                                types.Part.from_text(text=system_instruction_text),
+                            ],
+                        )
+                except FileNotFoundError:
+                    logging.error(f"{self.system_prompt_file} not found!")
+                except Exception as e:
+                    logging.error(f"Error reading {self.system_prompt_file}: {e}")
+            return self._system_prompt, self._content_config
+
+    def _stream_generation(self, client, model_name, contents, generate_content_config):
+        """Runs one streaming generation call and returns the concatenated text."""
+        generated_text = ""
+        response_stream = client.models.generate_content_stream(
+            model=model_name,
+            contents=contents,
+            config=generate_content_config,
+        )
+        logging.info(f"Successfully initiated stream with {model_name}. Receiving stream...")
+        for chunk in response_stream:
+            if chunk.text:
+                 generated_text += chunk.text
+        logging.info(f"Finished receiving stream from {model_name}.")
+        return generated_text
+
+    def generate(self, title, transcript_text):
+        """
+        Generates Anki flashcards for a video, trying PRIMARY_GEMINI_MODEL first and
+        FALLBACK_GEMINI_MODEL on error. Assumes Gemini returns a JSON string with
+        'category' and 'flashcards'. Returns the parsed dictionary or None on error after fallback.
+        """
+        if not self.api_key:
+            logging.error("GEMINI_API_KEY environment variable not set.")
+            return None
+        if not transcript_text or not transcript_text.strip():
+            logging.warning("Transcript text is empty. Skipping flashcard generation.")
+            return None
+
+        system_instruction_text, generate_content_config = self._get_system_prompt()
+        if system_instruction_text is None:
+            return None
+
+        if TRANSCRIPT_COMPACTION:
+            tokens_before = estimate_tokens(transcript_text)
+            transcript_text = compact_transcript(transcript_text)
+            tokens_after = estimate_tokens(transcript_text)
+            RUN_METRICS.incr('tokens_saved_by_compaction', tokens_before - tokens_after)
+            logging.info(f"Transcript for '{title}': ~{tokens_before} tokens, ~{tokens_after} after compaction "
+                         f"({100 * (tokens_before - tokens_after) / max(tokens_before, 1):.1f}% smaller).")
+
+        if GENERATION_MAP_REDUCE_MIN_TOKENS and estimate_tokens(transcript_text) > GENERATION_MAP_REDUCE_MIN_TOKENS:
+            return self._generate_map_reduce(title, transcript_text, system_instruction_text, generate_content_config)
+        return self._generate_once(title, transcript_text, system_instruction_text, generate_content_config)
+
+    def _generate_once(self, title, transcript_text, system_instruction_text, generate_content_config):
+        """One generation request (with the response cache and model fallback). Returns the parsed dictionary or None."""
+        # --- Response Cache ---
+        cache_key = _generation_cache_key(title, transcript_text, system_instruction_text)
+        cached = load_cached_generation(cache_key)
+        if cached is not None:
+            return cached
+
+        try:
+            client = self._get_client()
+        except Exception as e:
+            logging.error(f"Failed to initialize Gemini client: {e}")
+            return None
+
+        # --- Prepare Content (same for both models) ---
+        from google.genai import types
+        contents = [
+            types.Content(
+                role="user",
+                parts=[
+                    types.Part.from_text(text=f"""Video Title: {title}\n\nVideo Transcript: {transcript_text}"""),
+                ],
+            ),
+        ]
+
+        # --- Attempt with Primary Model, then Fallback Model ---
+        generated_text = ""
+        current_model_name = None
+        primary_breaker = get_circuit_breaker(f"gemini:{PRIMARY_GEMINI_MODEL}")
+        for current_model_name in (PRIMARY_GEMINI_MODEL, FALLBACK_GEMINI_MODEL):
+            is_primary = current_model_name == PRIMARY_GEMINI_MODEL
+            if is_primary and not primary_breaker.allow():
+                logging.info(f"Primary model {current_model_name} is failing, using fallback directly.")
+                continue
+            logging.info(f"Attempting generation with {'primary' if is_primary else 'fallback'} model: {current_model_name}")
+            if not is_primary:
+                RUN_METRICS.incr('fallbacks', provider='gemini')
+            try:
+                # Rate limits, 5xx and network errors are retried on the same model first
+                with RUN_METRICS.span('generate'):
+                    generated_text = call_with_retries(f"gemini:{current_model_name}", self._stream_generation,
+                                                       client, current_model_name, contents, generate_content_config)
+                RUN_METRICS.incr('tokens', estimate_tokens(f"{title}\n{transcript_text}"), provider='gemini', direction='input')
+                RUN_METRICS.incr('tokens', estimate_tokens(generated_text), provider='gemini', direction='output')
+                if is_primary:
+                    primary_breaker.record_success()
+            except Exception as e: # Model not found, permission, quota, server errors, safety stops...
+                if is_primary:
+                    primary_breaker.record_failure()
+                    logging.warning(f"Primary model ({current_model_name}) failed: {type(e).__name__}: {e}. Attempting fallback.")
+                else:
+                    logging.error(f"Fallback model ({current_model_name}) also failed: {type(e).__name__}: {e}")
+                    logging.error(f"Both primary and fallback models failed to generate content.")
+                generated_text = ""
+                continue
+            if not generated_text.strip():
+                # Stream finished but produced empty text
+                logging.warning(f"Gemini model ({current_model_name}) finished but generated empty text content.")
+                return None
+            break
+
+        if not generated_text.strip():
+            return None
+
+        # --- Parse the generated text as JSON (from whichever model succeeded) ---
+        parsed_data = _parse_flashcard_response(generated_text, current_model_name)
+        if parsed_data is not None:
+            save_cached_generation(cache_key, current_model_name, generated_text, parsed_data)
+        return parsed_data
+
+    def _generate_map_reduce(self, title, transcript_text, system_instruction_text, generate_content_config):
+        """
+        Generates cards for each section of a long transcript concurrently, then merges them locally:
+        duplicate fronts are dropped and the most common section category is used.
+        Fails (returns None) if any section fails; sections that succeeded stay in the response cache.
+        """
+        sections = split_transcript_sections(transcript_text, GENERATION_SECTION_TOKENS)
+        if len(sections) <= 1:
+            return self._generate_once(title, transcript_text, system_instruction_text, generate_content_config)
+        logging.info(f"Transcript for '{title}' is long (~{estimate_tokens(transcript_text)} tokens); generating {len(sections)} sections "
+                     f"with up to {GENERATION_SECTION_CONCURRENCY} at once.")
+
+        def generate_section(index, section_text):
+            section_title = f"{title} (part {index + 1} of {len(sections)})"
+            return self._generate_once(section_title, section_text, system_instruction_text, generate_content_config)
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, GENERATION_SECTION_CONCURRENCY),
+                                                   thread_name_prefix="generate-section") as executor:
+            section_results = list(executor.map(generate_section, range(len(sections)), sections))
+
+        failed_sections = [i + 1 for i, result in enumerate(section_results) if result is None]
+        if failed_sections:
+            logging.error(f"Generation failed for section(s) {failed_sections} of '{title}'.")
+            return None
+        merged = merge_flashcard_results(section_results)
+        logging.info(f"Merged {sum(len(result['flashcards']) for result in section_results)} cards from {len(sections)} sections "
+                     f"into {len(merged['flashcards'])} (category '{merged['category']}').")
+        return merged
+
+
+_GENERATION_SERVICE = None
+_GENERATION_SERVICE_LOCK = threading.Lock()
+
+def get_generation_service():
+    """Returns the process-wide GenerationService, creating it on first use."""
+    global _GENERATION_SERVICE
+    with _GENERATION_SERVICE_LOCK:
+        if _GENERATION_SERVICE is None:
+            _GENERATION_SERVICE = GenerationService()
+        return _GENERATION_SERVICE
+
+def split_transcript_sections(text, max_tokens):
+    """
+    Splits a transcript into sections of roughly equal size, no larger than about max_tokens,
+    ending at sentence boundaries (or word boundaries for unpunctuated sentences).
+    """
+    max_chars = max(1, max_tokens) * 4 # See estimate_tokens
+    if len(text) <= max_chars:
+        return [text]
+    target_chars = len(text) / math.ceil(len(text) / max_chars) # Balance the sections
+    pieces = []
+    for sentence in re.split(r"(?<=[.!?])\s+", text):
+        if len(sentence) <= max_chars:
+            pieces.append(sentence)
+        else:
+            words = sentence.split()
+            step = max(1, len(words) * max_chars // len(sentence))
+            pieces.extend(" ".join(words[i:i + step]) for i in range(0, len(words), step))
+
+    sections, current, current_len = [], [], 0
+    for piece in pieces:
+        if current and (current_len + len(piece) > max_chars or current_len >= target_chars):
+            sections.append(" ".join(current))
+            current, current_len = [], 0
+        current.append(piece)
+        current_len += len(piece) + 1
+    if current:
+        sections.append(" ".join(current))
+    return sections
+
+def merge_flashcard_results(results):
+    """Merges parsed flashcard results: most common category, cards de-duplicated by normalized front."""
+    category_counts = collections.Counter(result.get('category') for result in results if result.get('category'))
+    category = category_counts.most_common(1)[0][0] if category_counts else 'Default Category'
+    flashcards, seen_fronts = [], set()
+    for result in results:
+        for card in result.get('flashcards') or []:
+            front_key = normalize_front_text(card.get('front')) if isinstance(card, dict) else None
+            if not front_key or front_key in seen_fronts:
+                continue
+            seen_fronts.add(front_key)
+            flashcards.append(card)
+    return {'category': category, 'flashcards': flashcards}
+
+def generate_flashcards_from_transcript(transcript_text, title):
+    """
+    Generates Anki flashcards using Gemini API with fallback model logic.
+    Returns the parsed dictionary or None on error after fallback.
+    Uses the shared GenerationService (one client, system prompt loaded once).
+    """
+    return get_generation_service().generate(title, transcript_text)
+
+
 # --- JSON Card Data Functions (MODIFIED for Category) ---
 def load_json_cards(filepath):
     """Loads card data (list of flashcards) from a specific category JSON file."""
@@ -756,37 +2266,264 @@ def save_json_cards(filepath, cards_list):
     """Saves a list of card data to a specific category JSON file."""
     try:
         # Ensure the directory exists
-        os.makedirs(os.path.dirname(filepath), exist_ok=True)
-        with open(filepath, 'w', encoding='utf-8') as f:
-            # Save *only* the list of cards
-            json.dump(cards_list, f, indent=2, ensure_ascii=False)
+        # Save *only* the list of cards (written to a temp file first, then renamed into place)
+        _atomic_write_json(filepath, cards_list, indent=2)
         logging.info(f"Successfully saved {len(cards_list)} cards to {filepath}")
         return True
     except Exception as e:
         logging.error(f"Error saving card data to {filepath}: {e}")
         return False
 
-def _invoke_ankiconnect(action, **params):
-    """Helper function to make requests to AnkiConnect."""
-    payload = {'action': action, 'version': 6, 'params': params}
-    headers = {'Content-Type': 'application/json'}
-    try:
-        response = requests.post(ANKI_CONNECT_URL, json=payload, headers=headers, timeout=10) # Added timeout
-        response.raise_for_status()  # Raise HTTPError for bad responses (4xx or 5xx)
-        response_json = response.json()
+def normalize_front_text(front):
+    """Normalizes a card front for duplicate detection: no HTML tags, collapsed whitespace, case-folded."""
+    text = re.sub(r'<[^>]+>', ' ', front or '')
+    text = text.replace('&nbsp;', ' ')
+    return re.sub(r'\s+', ' ', text).strip().casefold()
+
+def front_text_hash(front):
+    return hashlib.sha1(normalize_front_text(front).encode('utf-8')).hexdigest()
+
+
+class CardStore:
+    """
+    Indexed SQLite store of all generated cards, replacing the per-category JSON files
+    that were fully re-read and re-written for every video.
+
+    Appends cost O(new cards). Cards are indexed by category, video ID and a hash of the
+    normalized front text; re-adding the same card for the same video is a no-op. The
+    category JSON files can still be produced on demand with export_json (--export-json).
+    Safe to share between threads.
+    """
+
+    def __init__(self, db_path, legacy_json_dir=None):
+        os.makedirs(os.path.dirname(db_path) or '.', exist_ok=True)
+        self.db_path = db_path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(db_path, check_same_thread=False, timeout=30)
+        self._conn.row_factory = sqlite3.Row
+        with self._lock, self._conn:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("""
+                CREATE TABLE IF NOT EXISTS cards (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    category TEXT NOT NULL,
+                    video_id TEXT,
+                    video_title TEXT,
+                    front TEXT NOT NULL,
+                    back TEXT NOT NULL,
+                    front_hash TEXT NOT NULL,
+                    created_at REAL NOT NULL,
+                    UNIQUE (category, video_id, front_hash)
+                )""")
+            self._conn.execute("CREATE INDEX IF NOT EXISTS idx_cards_category ON cards (category)")
+            self._conn.execute("CREATE INDEX IF NOT EXISTS idx_cards_video_id ON cards (video_id)")
+            self._conn.execute("CREATE INDEX IF NOT EXISTS idx_cards_front_hash ON cards (front_hash)")
+            self._conn.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+        if legacy_json_dir:
+            self._import_legacy_json(legacy_json_dir)
+
+    def _import_legacy_json(self, json_dir):
+        """
+        One-off import of the category JSON files written by earlier versions. The cards and the
+        'imported' flag are committed in one transaction, so an interrupted import is redone from scratch.
+        """
+        with self._lock:
+            if self._conn.execute("SELECT 1 FROM meta WHERE key = 'legacy_json_imported'").fetchone():
+                return
+        rows = []
+        if os.path.isdir(json_dir):
+            for filename in sorted(os.listdir(json_dir)):
+                filepath = os.path.join(json_dir, filename)
+                if not filename.endswith('.json') or not filename.startswith(JSON_FILENAME_PREFIX) or \
+                   os.path.abspath(filepath) == os.path.abspath(STATE_FILE) or not os.path.isfile(filepath):
+                    continue
+                category = filename[len(JSON_FILENAME_PREFIX):-len('.json')]
+                cards = [card for card in load_json_cards(filepath)
+                         if isinstance(card, dict) and card.get('front') and card.get('back')]
+                rows.extend(self._card_rows(category, None, None, cards))
+        with self._lock, self._conn:
+            imported = self._insert_rows(rows)
+            self._conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('legacy_json_imported', ?)", (str(time.time()),))
+        if imported:
+            logging.info(f"Imported {imported} cards from category JSON files in '{json_dir}' into {self.db_path}.")
+
+    @staticmethod
+    def _card_rows(category, video_id, video_title, cards):
+        now = time.time()
+        return [(category, video_id, video_title, card['front'], card['back'], front_text_hash(card['front']), now)
+                for card in cards]
+
+    def _insert_rows(self, rows):
+        """Inserts card rows, skipping ones already stored. Call with the lock held, inside a transaction."""
+        before = self._conn.total_changes
+        self._conn.executemany("""
+            INSERT OR IGNORE INTO cards (category, video_id, video_title, front, back, front_hash, created_at)
+            VALUES (?, ?, ?, ?, ?, ?, ?)""", rows)
+        return self._conn.total_changes - before
+
+    def add_cards(self, category, video_id, video_title, cards):
+        """Appends cards ({'front', 'back'} dicts) for a video. Returns how many were new."""
+        rows = self._card_rows(category, video_id, video_title, cards)
+        with self._lock, self._conn:
+            return self._insert_rows(rows)
+
+    def categories(self):
+        with self._lock:
+            return [row[0] for row in self._conn.execute("SELECT DISTINCT category FROM cards ORDER BY category")]
+
+    def cards_for_category(self, category):
+        """Returns the cards of a category in insertion order, in the JSON file format."""
+        with self._lock:
+            rows = self._conn.execute("SELECT front, back FROM cards WHERE category = ? ORDER BY id", (category,)).fetchall()
+        return [{'front': row['front'], 'back': row['back']} for row in rows]
+
+    def count(self, category=None):
+        with self._lock:
+            if category is None:
+                return self._conn.execute("SELECT COUNT(*) FROM cards").fetchone()[0]
+            return self._conn.execute("SELECT COUNT(*) FROM cards WHERE category = ?", (category,)).fetchone()[0]
+
+    def export_json(self, output_dir):
+        """Writes one '<category>.json' list of cards per category (the pre-card-store format)."""
+        exported = 0
+        for category in self.categories():
+            json_card_file = os.path.join(output_dir, f"{JSON_FILENAME_PREFIX}{category}.json")
+            if save_json_cards(json_card_file, self.cards_for_category(category)):
+                exported += 1
+        logging.info(f"Exported {exported} category JSON files to '{output_dir}'.")
+        return exported
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+class AnkiConnectClient:
+    """
+    AnkiConnect client with a persistent keep-alive session.
+
+    Collection info that doesn't change during a run (note types, their fields and the
+    existing decks) is fetched once with a single 'multi' request and cached until
+    invalidate_collection_info, and related actions can be sent together with multi()
+    so they cost one HTTP round-trip.
+    """
+
+    def __init__(self, url=None, timeout=10):
+        self.url = url or ANKI_CONNECT_URL
+        self.timeout = timeout
+        import requests
+        self.session = requests.Session()
+        self.session.headers.update({'Content-Type': 'application/json'})
+        self._lock = threading.Lock()
+        self.model_names = None # Cached for the run by load_collection_info
+        self.model_field_names = {}
+        self._deck_names = None
+
+    def _post(self, action, payload):
+        """Sends one request. Returns the decoded JSON response, or None (error logged)."""
+        import requests
+        response = None
+        try:
+            response = self.session.post(self.url, json=payload, timeout=self.timeout)
+            response.raise_for_status()  # Raise HTTPError for bad responses (4xx or 5xx)
+            return response.json()
+        except requests.exceptions.RequestException as e:
+            logging.error(f"AnkiConnect Connection Error ({action}): {e}")
+            return None
+        except json.JSONDecodeError as e:
+            logging.error(f"AnkiConnect JSON Decode Error ({action}): {e} - Response: {response.text[:200]}") # Log part of response
+            return None
+        except Exception as e: # Catch any other unexpected errors
+             logging.error(f"AnkiConnect Unexpected Error ({action}): {e}")
+             return None
+
+    def invoke(self, action, **params):
+        """Runs a single action. Returns its result, or None on any error (logged)."""
+        response_json = self._post(action, {'action': action, 'version': 6, 'params': params})
+        if response_json is None:
+            return None
         if response_json.get('error'):
             logging.error(f"AnkiConnect Error ({action}): {response_json['error']}")
             return None
         return response_json.get('result')
-    except requests.exceptions.RequestException as e:
-        logging.error(f"AnkiConnect Connection Error ({action}): {e}")
-        return None
-    except json.JSONDecodeError as e:
-        logging.error(f"AnkiConnect JSON Decode Error ({action}): {e} - Response: {response.text[:200]}") # Log part of response
-        return None
-    except Exception as e: # Catch any other unexpected errors
-         logging.error(f"AnkiConnect Unexpected Error ({action}): {e}")
-         return None
+
+    def multi(self, actions):
+        """
+        Runs several (action, params) pairs in one request with AnkiConnect's 'multi' action.
+        Returns a list with one result per action (None for failed actions), or None if the request failed.
+        """
+        names = "+".join(action for action, _ in actions)
+        payload = {'action': 'multi', 'version': 6, 'params': {
+            'actions': [{'action': action, 'version': 6, 'params': params} for action, params in actions]}}
+        response_json = self._post(names, payload)
+        if response_json is None:
+            return None
+        if response_json.get('error') or not isinstance(response_json.get('result'), list):
+            logging.error(f"AnkiConnect Error (multi: {names}): {response_json.get('error')}")
+            return None
+        results = []
+        for (action, _), entry in zip(actions, response_json['result']):
+            if isinstance(entry, dict) and ('result' in entry or 'error' in entry):
+                if entry.get('error'):
+                    logging.error(f"AnkiConnect Error ({action}): {entry['error']}")
+                    # addNotes reports per-note errors but still returns the per-note results
+                    results.append(entry.get('result') if isinstance(entry.get('result'), list) else None)
+                else:
+                    results.append(entry.get('result'))
+            else:
+                results.append(entry)
+        return results
+
+    def load_collection_info(self):
+        """Fetches note types, the fields of ANKI_NOTE_TYPE and the deck names once per run."""
+        with self._lock:
+            if self.model_names is not None:
+                return True
+        results = self.multi([
+            ('modelNames', {}),
+            ('modelFieldNames', {'modelName': ANKI_NOTE_TYPE}),
+            ('deckNames', {}),
+        ])
+        if results is None or results[0] is None or results[2] is None:
+            logging.error("Failed to get note types and decks from Anki.")
+            return False
+        with self._lock:
+            self.model_names = results[0]
+            if results[1] is not None:
+                self.model_field_names[ANKI_NOTE_TYPE] = results[1]
+            self._deck_names = set(results[2])
+        return True
+
+    def invalidate_collection_info(self):
+        """Makes the next load_collection_info fetch note types and decks again (they may have changed in Anki)."""
+        with self._lock:
+            self.model_names = None
+            self.model_field_names = {}
+            self._deck_names = None
+
+    def has_deck(self, deck_name):
+        with self._lock:
+            return self._deck_names is not None and deck_name in self._deck_names
+
+    def remember_deck(self, deck_name):
+        with self._lock:
+            if self._deck_names is not None:
+                self._deck_names.add(deck_name)
+
+
+_ANKI_CLIENT = None
+_ANKI_CLIENT_LOCK = threading.Lock()
+
+def get_anki_client():
+    """Returns the process-wide AnkiConnectClient, creating it on first use."""
+    global _ANKI_CLIENT
+    with _ANKI_CLIENT_LOCK:
+        if _ANKI_CLIENT is None:
+            _ANKI_CLIENT = AnkiConnectClient()
+        return _ANKI_CLIENT
+
+def _invoke_ankiconnect(action, **params):
+    """Helper function to make requests to AnkiConnect (through the shared keep-alive client)."""
+    return get_anki_client().invoke(action, **params)
 
 
 def check_ankiconnect_connection():
@@ -800,51 +2537,112 @@ def check_ankiconnect_connection():
         logging.error("AnkiConnect connection failed. Ensure Anki is running with AnkiConnect enabled.")
         return False
 
-def create_anki_deck(deck_name):
-    """Creates an Anki deck if it doesn't exist."""
-    logging.info(f"Ensuring Anki deck exists: '{deck_name}'")
-    result = _invoke_ankiconnect('createDeck', deck=deck_name)
-    if result is None:
-         # Error logged in _invoke_ankiconnect
-         return False
-    # createDeck returns null both on success and if the deck already exists
-    # We consider both cases a success for our purpose here.
-    logging.info(f"Deck '{deck_name}' ready.")
-    return True
 
+class AnkiDuplicateIndex:
+    """
+    Local index of the first-field values of ANKI_NOTE_TYPE notes, per deck.
 
-def add_cards_to_anki(flashcards, deck_name, source_title, raw_category_for_tagging):
-    """Adds a list of flashcard dictionaries to the specified Anki deck."""
-    if not flashcards:
-        logging.info("No flashcards provided to add to Anki.")
-        return 0, 0, 0 # Added, Duplicates, Failed
+    Mirrors AnkiConnect's duplicate check (same note type, same first field, within the
+    deck) so duplicates can be filtered out before addNotes instead of being classified
+    with a canAddNotes round-trip each. A deck is seeded in bulk with findNotes + notesInfo
+    the first time it is used and kept in sync as notes are added. Thread-safe.
+    """
 
-    if not deck_name:
-        logging.warning("No deck name specified, using default.")
-        deck_name = ANKI_DEFAULT_DECK_NAME
+    NOTES_INFO_BATCH_SIZE = 500
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._keys_by_deck = {} # deck name -> set of first-field hashes
+
+    @staticmethod
+    def first_field_text(value):
+        """
+        A first-field value normalised like Anki's duplicate check: comments, style and script blocks
+        and tags removed (image tags leave their file name), entities decoded, outer whitespace stripped.
+        Inner whitespace and case are kept.
+        """
+        text = re.sub(r'(?is)<img[^>]*?src=["\']?([^"\'>\s]+)["\']?[^>]*>', r' \1 ', value or '')
+        text = re.sub(r'(?s)<!--.*?-->', '', text)
+        text = re.sub(r'(?is)<(style|script)\b.*?</\1>', '', text)
+        text = re.sub(r'(?s)<.*?>', '', text)
+        return html.unescape(text.replace('&nbsp;', ' ')).strip()
+
+    @staticmethod
+    def first_field_key(value):
+        """Hash of a first-field value, see first_field_text."""
+        return hashlib.sha1(AnkiDuplicateIndex.first_field_text(value).encode('utf-8')).hexdigest()
+
+    @staticmethod
+    def _deck_query(deck_name):
+        # Only this deck, not its sub-decks; escape Anki search wildcards and quotes
+        escaped = re.sub(r'([\\"*_])', r'\\\1', deck_name)
+        return f'"deck:{escaped}" -"deck:{escaped}::*" "note:{ANKI_NOTE_TYPE}"'
+
+    def ensure_seeded(self, deck_name):
+        """Loads the existing notes of a deck once. Returns False if AnkiConnect couldn't be queried."""
+        with self._lock:
+            if deck_name in self._keys_by_deck:
+                return True
+        note_ids = _invoke_ankiconnect('findNotes', query=self._deck_query(deck_name))
+        if note_ids is None:
+            logging.warning(f"Could not seed duplicate index for deck '{deck_name}' (findNotes failed).")
+            return False
+        keys = set()
+        for i in range(0, len(note_ids), self.NOTES_INFO_BATCH_SIZE):
+            notes_info = _invoke_ankiconnect('notesInfo', notes=note_ids[i:i + self.NOTES_INFO_BATCH_SIZE])
+            if notes_info is None:
+                logging.warning(f"Could not seed duplicate index for deck '{deck_name}' (notesInfo failed).")
+                return False
+            for note in notes_info:
+                fields = (note or {}).get('fields') or {}
+                if not fields:
+                    continue
+                first_field = min(fields.values(), key=lambda field: field.get('order', 0))
+                keys.add(self.first_field_key(first_field.get('value')))
+        with self._lock:
+            self._keys_by_deck.setdefault(deck_name, set()).update(keys)
+        logging.info(f"Seeded duplicate index for deck '{deck_name}' with {len(keys)} notes.")
+        return True
 
-    # --- Ensure Deck Exists ---
-    if not create_anki_deck(deck_name):
-        logging.error(f"Cannot add cards because deck '{deck_name}' could not be created or verified.")
-        return 0, 0, len(flashcards) # All failed
+    def forget(self, deck_name=None):
+        """Drops the index of a deck (or of every deck), so it is seeded from Anki again on next use."""
+        with self._lock:
+            if deck_name is None:
+                self._keys_by_deck.clear()
+            else:
+                self._keys_by_deck.pop(deck_name, None)
 
-    # --- Verify Note Type Exists ---
-    logging.debug(f"Verifying Anki Note Type '{ANKI_NOTE_TYPE}' exists...")
-    model_names = _invoke_ankiconnect('modelNames')
-    if model_names is None:
-        logging.error("Failed to get model names from Anki. Cannot verify Note Type.")
-        return 0, 0, len(flashcards) # All failed
-    if ANKI_NOTE_TYPE not in model_names:
-        logging.error(f"Anki Note Type '{ANKI_NOTE_TYPE}' not found in Anki. Please ensure it exists.")
-        logging.error(f"Required fields: '{ANKI_FIELD_FRONT}', '{ANKI_FIELD_BACK}'" + (f", '{ANKI_FIELD_SOURCE}'" if ANKI_FIELD_SOURCE else ""))
-        return 0, 0, len(flashcards) # All failed
-    logging.debug(f"Note Type '{ANKI_NOTE_TYPE}' confirmed.")
+    def mark_empty(self, deck_name):
+        """Marks a deck that is about to be created as seeded (it has no notes yet)."""
+        with self._lock:
+            self._keys_by_deck.setdefault(deck_name, set())
 
-    # --- Prepare and Add Notes ---
-    added_count, duplicate_count, failed_count = 0, 0, 0
-    notes_to_add = []
+    def contains(self, deck_name, front):
+        with self._lock:
+            return self.first_field_key(front) in self._keys_by_deck.get(deck_name, ())
 
-    logging.info(f"Preparing {len(flashcards)} notes for Anki deck '{deck_name}'...")
+    def add(self, deck_name, front):
+        with self._lock:
+            self._keys_by_deck.setdefault(deck_name, set()).add(self.first_field_key(front))
+
+
+_ANKI_DUPLICATE_INDEX = AnkiDuplicateIndex()
+
+
+def refresh_anki_caches(deck_name=None):
+    """
+    Forgets the cached note types, deck list and duplicate index (of one deck, or all), e.g. after
+    Anki rejected notes or between daemon polls: decks and notes may have been changed in Anki.
+    """
+    if _ANKI_CLIENT is not None:
+        _ANKI_CLIENT.invalidate_collection_info()
+    _ANKI_DUPLICATE_INDEX.forget(deck_name)
+
+
+def _build_anki_notes(flashcards, deck_name, source_title, raw_category_for_tagging):
+    """Turns flashcard dicts into AnkiConnect note payloads. Returns (notes, invalid_card_count)."""
+    notes = []
+    invalid_count = 0
 
     # Prepare tags based on category (if enabled)
     anki_tags = []
@@ -860,11 +2658,10 @@ def add_cards_to_anki(flashcards, deck_name, source_title, raw_category_for_tagg
         else:
             logging.info("Not adding tag from category (Category was default or sanitized to empty).")
 
-
     for index, card in enumerate(flashcards):
         if not isinstance(card, dict) or not card.get('front') or not card.get('back'):
             logging.warning(f"Skipping invalid card data structure at index {index}: {str(card)[:100]}")
-            failed_count += 1
+            invalid_count += 1
             continue
 
         # --- Build Note Fields ---
@@ -889,49 +2686,165 @@ def add_cards_to_anki(flashcards, deck_name, source_title, raw_category_for_tagg
             },
             'tags': anki_tags # Add tags prepared earlier
         }
-        notes_to_add.append(note)
+        notes.append(note)
+    return notes, invalid_count
+
+
+def _check_anki_note_type(anki_client):
+    """Verifies ANKI_NOTE_TYPE and its fields exist (from the run's cached collection info)."""
+    logging.debug(f"Verifying Anki Note Type '{ANKI_NOTE_TYPE}' exists...")
+    if not anki_client.load_collection_info():
+        logging.error("Failed to get model names from Anki. Cannot verify Note Type.")
+        return False
+    required_fields = [ANKI_FIELD_FRONT, ANKI_FIELD_BACK] + ([ANKI_FIELD_SOURCE] if ANKI_FIELD_SOURCE else [])
+    if ANKI_NOTE_TYPE not in (anki_client.model_names or ()): # None if another thread just refreshed the caches
+        logging.error(f"Anki Note Type '{ANKI_NOTE_TYPE}' not found in Anki. Please ensure it exists.")
+        logging.error("Required fields: " + ", ".join(f"'{field}'" for field in required_fields))
+        return False
+    known_fields = anki_client.model_field_names.get(ANKI_NOTE_TYPE)
+    missing_fields = [field for field in required_fields if known_fields is not None and field not in known_fields]
+    if missing_fields:
+        logging.error(f"Anki Note Type '{ANKI_NOTE_TYPE}' has no field(s) " + ", ".join(f"'{field}'" for field in missing_fields) + f". Its fields are: {known_fields}")
+        return False
+    logging.debug(f"Note Type '{ANKI_NOTE_TYPE}' confirmed.")
+    return True
+
+
+def add_notes_to_anki(notes, deck_name):
+    """
+    Adds prepared note payloads (see _build_anki_notes) to one Anki deck.
+    Returns a list with one outcome per note: 'added', 'duplicate', 'failed' (Anki rejected the note)
+    or 'unsent' (Anki couldn't be reached, or the note type couldn't be verified).
+    Once the run's collection info is cached and the deck's duplicate index is seeded,
+    this is a single AnkiConnect request (createDeck, if needed, and addNotes in one 'multi').
+    """
+    with RUN_METRICS.span('anki_ingest'):
+        outcomes = _add_notes_to_deck(notes, deck_name)
+    for outcome, count in collections.Counter(outcomes).items():
+        RUN_METRICS.incr('anki_notes', count, outcome=outcome)
+    return outcomes
+
+def _add_notes_to_deck(notes, deck_name):
+    outcomes = ['unsent'] * len(notes)
+    if not notes:
+        return outcomes
+
+    anki_client = get_anki_client()
+    if not _check_anki_note_type(anki_client):
+        return outcomes # Nothing was sent
+
+    # --- Ensure Deck Exists ---
+    # A deck that isn't in the cached deck list is created in the same request as the notes
+    deck_exists = anki_client.has_deck(deck_name)
+    if not deck_exists:
+        _ANKI_DUPLICATE_INDEX.mark_empty(deck_name) # A brand-new deck has no notes to seed from
+
+    # --- Filter Duplicates Locally ---
+    # AnkiConnect's duplicate check would reject these anyway; dropping them here saves the
+    # upload and lets a null addNotes result mean a real failure.
+    to_send = list(range(len(notes))) # Indexes of the notes to upload
+    index_seeded = _ANKI_DUPLICATE_INDEX.ensure_seeded(deck_name)
+    if index_seeded:
+        to_send = []
+        batch_keys = set()
+        for i, note in enumerate(notes):
+            front = note['fields'][ANKI_FIELD_FRONT]
+            key = AnkiDuplicateIndex.first_field_key(front)
+            if key in batch_keys or _ANKI_DUPLICATE_INDEX.contains(deck_name, front):
+                outcomes[i] = 'duplicate'
+            else:
+                batch_keys.add(key)
+                to_send.append(i)
+        skipped = len(notes) - len(to_send)
+        if skipped:
+            logging.info(f"Skipping {skipped} notes already present in deck '{deck_name}'.")
 
     # --- Use addNotes for potentially better performance ---
-    if notes_to_add:
+    if to_send:
+        notes_to_add = [notes[i] for i in to_send]
         logging.info(f"Attempting to add {len(notes_to_add)} notes to Anki deck '{deck_name}' using addNotes...")
-        results = _invoke_ankiconnect('addNotes', notes=notes_to_add)
+        actions = [] if deck_exists else [('createDeck', {'deck': deck_name})]
+        actions.append(('addNotes', {'notes': notes_to_add}))
+        multi_results = anki_client.multi(actions)
+        if multi_results is None:
+            return outcomes # Error logged in AnkiConnectClient; the notes stay 'unsent'
+        for i in to_send:
+            outcomes[i] = 'failed' # Until addNotes says otherwise
+        results = multi_results[-1]
+        if not deck_exists:
+            if multi_results[0] is None:
+                logging.error(f"Deck '{deck_name}' could not be created.")
+                refresh_anki_caches(deck_name)
+            else:
+                anki_client.remember_deck(deck_name)
+                logging.info(f"Deck '{deck_name}' ready.")
 
         if results is None:
-             # Error logged in _invoke_ankiconnect
-             logging.error("Failed to add batch of notes to Anki.")
-             failed_count = len(notes_to_add) # Assume all failed if the batch call failed
+             # Error logged in AnkiConnectClient
+             logging.error("Failed to add batch of notes to Anki.") # All stay 'failed'
         elif isinstance(results, list):
             # Check results for each note: null means error/duplicate, note_id means success
             if len(results) != len(notes_to_add):
                  logging.warning(f"AnkiConnect 'addNotes' returned {len(results)} results, but {len(notes_to_add)} notes were sent. Counts may be inaccurate.")
                  # Fallback to assuming failure for discrepancy, though this is unlikely
-                 failed_count = len(notes_to_add)
-
             else:
-                for i, result in enumerate(results):
+                rejected = [] # Indexes (into notes) of notes for which addNotes returned null
+                for i, result in zip(to_send, results):
                     if result is None:
-                        # Could be duplicate or other error. We can't easily distinguish with addNotes result.
-                        # Let's try canAddNotes to check for duplicates specifically for the 'None' results.
-                        # This adds overhead but gives better counts.
-                        can_add_check = _invoke_ankiconnect('canAddNotes', notes=[notes_to_add[i]])
-                        if can_add_check is not None and isinstance(can_add_check, list) and not can_add_check[0]:
-                            # If canAddNotes returns [False], likely a duplicate
-                             duplicate_count += 1
-                             # logging.debug(f"Note {i+1} likely duplicate (addNotes returned null, canAddNotes returned false).")
-                        else:
-                             # If canAddNotes check failed or returned True (unexpected), count as failed add.
-                             failed_count += 1
-                             logging.warning(f"Note {i+1} failed to add (addNotes returned null, canAddNotes check inconclusive or indicated failure).")
+                        rejected.append(i)
                     elif isinstance(result, (int, float)):
                         # Success, result is the note ID
-                        added_count += 1
+                        outcomes[i] = 'added'
+                        _ANKI_DUPLICATE_INDEX.add(deck_name, notes[i]['fields'][ANKI_FIELD_FRONT])
                     else:
                         # Unexpected result format
                         logging.warning(f"Unexpected result for note {i+1} from addNotes: {result}. Counting as failed.")
-                        failed_count += 1
+
+                if rejected and index_seeded:
+                    # Duplicates were filtered out above, so these are real failures - or the cached
+                    # deck list and index are stale (deck deleted, notes edited in Anki): reload them next time
+                    logging.warning(f"{len(rejected)} notes failed to add (addNotes returned null for notes not in the duplicate index).")
+                    refresh_anki_caches(deck_name)
+                elif rejected:
+                    # No index: classify all rejected notes with a single canAddNotes call
+                    can_add_check = _invoke_ankiconnect('canAddNotes', notes=[notes[i] for i in rejected])
+                    if isinstance(can_add_check, list) and len(can_add_check) == len(rejected):
+                        for i, can_add in zip(rejected, can_add_check):
+                            if not can_add:
+                                outcomes[i] = 'duplicate' # canAddNotes false -> likely a duplicate
+                    else:
+                        logging.warning(f"{len(rejected)} notes failed to add (addNotes returned null, canAddNotes check inconclusive).")
         else:
              logging.error(f"Unexpected response type from AnkiConnect 'addNotes': {type(results)}. Assuming all failed.")
-             failed_count = len(notes_to_add)
+
+    return outcomes
+
+
+def add_cards_to_anki(flashcards, deck_name, source_title, raw_category_for_tagging, outbox=None, video_id=None):
+    """
+    Adds a list of flashcard dictionaries to the specified Anki deck.
+    If an outbox is given, notes that could not be added are spooled to it for a later flush.
+    """
+    if not flashcards:
+        logging.info("No flashcards provided to add to Anki.")
+        return 0, 0, 0 # Added, Duplicates, Failed
+
+    if not deck_name:
+        logging.warning("No deck name specified, using default.")
+        deck_name = ANKI_DEFAULT_DECK_NAME
+
+    # --- Prepare and Add Notes ---
+    logging.info(f"Preparing {len(flashcards)} notes for Anki deck '{deck_name}'...")
+    notes, invalid_count = _build_anki_notes(flashcards, deck_name, source_title, raw_category_for_tagging)
+    outcomes = add_notes_to_anki(notes, deck_name)
+    added_count = outcomes.count('added')
+    duplicate_count = outcomes.count('duplicate')
+    failed_count = outcomes.count('failed') + outcomes.count('unsent') + invalid_count
+
+    if outbox is not None and ('failed' in outcomes or 'unsent' in outcomes):
+        failed_notes = [note for note, outcome in zip(notes, outcomes) if outcome in ('failed', 'unsent')]
+        spooled = outbox.enqueue(failed_notes, video_id=video_id)
+        logging.warning(f"Spooled {spooled} failed notes to the Anki outbox for a later retry.")
 
     # --- Final Summary Log for Anki Addition ---
     log_level = logging.INFO if added_count > 0 else logging.WARNING
@@ -939,225 +2852,897 @@ def add_cards_to_anki(flashcards, deck_name, source_title, raw_category_for_tagg
     return added_count, duplicate_count, failed_count
 
 
-# --- Main Execution ---
-# Make sure these imports are at the top of your file
-import requests
-import re # Should already be there
-# ... other imports ...
+class AnkiOutbox:
+    """
+    SQLite spool of notes waiting to be added to Anki.
+
+    Notes are appended while Anki is unreachable (or always, with ANKI_DEFERRED_INGEST)
+    and flushed to AnkiConnect in large per-deck batches once it is reachable. Each note is
+    spooled once per deck (keyed by its first field), and every batch is checkpointed by
+    deleting the notes Anki accepted or already had, so an interrupted flush is simply
+    resumed by the next one. Notes Anki rejects count an attempt; after ANKI_SPOOL_MAX_ATTEMPTS
+    they are moved to the dead_letters table, so they can't hold up the rest of the outbox.
+    Safe to share between threads.
+    """
 
-# --- Main Execution ---
-# --- Main Execution ---
-if __name__ == "__main__":
-    logging.info("Starting YouTube Playlist Check...")
-    script_start_time = time.time()
+    def __init__(self, db_path):
+        os.makedirs(os.path.dirname(db_path) or '.', exist_ok=True)
+        self.db_path = db_path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(db_path, check_same_thread=False, timeout=30)
+        self._conn.row_factory = sqlite3.Row
+        with self._lock, self._conn:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("""
+                CREATE TABLE IF NOT EXISTS outbox (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    deck_name TEXT NOT NULL,
+                    note_key TEXT NOT NULL,
+                    note_json TEXT NOT NULL,
+                    video_id TEXT,
+                    created_at REAL NOT NULL,
+                    attempts INTEGER NOT NULL DEFAULT 0,
+                    UNIQUE (deck_name, note_key)
+                )""")
+            self._conn.execute("""
+                CREATE TABLE IF NOT EXISTS dead_letters (
+                    id INTEGER PRIMARY KEY,
+                    deck_name TEXT NOT NULL,
+                    note_json TEXT NOT NULL,
+                    video_id TEXT,
+                    created_at REAL NOT NULL,
+                    attempts INTEGER NOT NULL,
+                    dead_at REAL NOT NULL
+                )""")
+
+    def enqueue(self, notes, video_id=None):
+        """Spools note payloads (see _build_anki_notes). Returns how many were new."""
+        now = time.time()
+        rows = [(note['deckName'], AnkiDuplicateIndex.first_field_key(note['fields'][ANKI_FIELD_FRONT]),
+                 json.dumps(note, ensure_ascii=False), video_id, now) for note in notes]
+        with self._lock, self._conn:
+            before = self._conn.total_changes
+            self._conn.executemany("""
+                INSERT OR IGNORE INTO outbox (deck_name, note_key, note_json, video_id, created_at)
+                VALUES (?, ?, ?, ?, ?)""", rows)
+            return self._conn.total_changes - before
+
+    def pending_count(self):
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM outbox").fetchone()[0]
+
+    def _checkpoint(self, rows, outcomes):
+        """Removes delivered notes; rejected ones stay until they reach ANKI_SPOOL_MAX_ATTEMPTS, then they are dead-lettered."""
+        delivered = [(row['id'],) for row, outcome in zip(rows, outcomes) if outcome in ('added', 'duplicate')]
+        rejected = [(row['id'],) for row, outcome in zip(rows, outcomes) if outcome == 'failed']
+        with self._lock, self._conn:
+            self._conn.executemany("DELETE FROM outbox WHERE id = ?", delivered)
+            self._conn.executemany("UPDATE outbox SET attempts = attempts + 1 WHERE id = ?", rejected)
+            self._conn.execute("""
+                INSERT INTO dead_letters (id, deck_name, note_json, video_id, created_at, attempts, dead_at)
+                SELECT id, deck_name, note_json, video_id, created_at, attempts, ? FROM outbox WHERE attempts >= ?""",
+                (time.time(), ANKI_SPOOL_MAX_ATTEMPTS))
+            dead = self._conn.execute("DELETE FROM outbox WHERE attempts >= ?", (ANKI_SPOOL_MAX_ATTEMPTS,)).rowcount
+        if dead:
+            logging.warning(f"Moved {dead} notes that Anki rejected {ANKI_SPOOL_MAX_ATTEMPTS} times to the dead_letters table of {self.db_path}.")
+
+    def flush(self, batch_size=None):
+        """
+        Sends all spooled notes to Anki, one deck and batch at a time. Notes Anki rejects are
+        checkpointed and the flush moves on; it only stops early if Anki can't be reached.
+        Returns (added, duplicates, failed).
+        """
+        batch_size = batch_size or ANKI_SPOOL_BATCH_SIZE
+        totals = {'added': 0, 'duplicate': 0, 'failed': 0}
+        with self._lock:
+            decks = [row[0] for row in self._conn.execute("SELECT DISTINCT deck_name FROM outbox ORDER BY deck_name")]
+        for deck_name in decks:
+            last_id = 0
+            while True:
+                with self._lock:
+                    rows = self._conn.execute(
+                        "SELECT id, note_json FROM outbox WHERE deck_name = ? AND id > ? ORDER BY id LIMIT ?",
+                        (deck_name, last_id, batch_size)).fetchall()
+                if not rows:
+                    break
+                last_id = rows[-1]['id']
+                logging.info(f"Flushing {len(rows)} spooled notes to Anki deck '{deck_name}'...")
+                outcomes = add_notes_to_anki([json.loads(row['note_json']) for row in rows], deck_name)
+                if 'unsent' in outcomes:
+                    # Anki went away (or the note type is missing); leave the batch as it is for the next flush
+                    totals['failed'] += outcomes.count('unsent')
+                    logging.warning(f"Anki outbox flush stopped: AnkiConnect could not be reached. {self.pending_count()} notes remain spooled.")
+                    return totals['added'], totals['duplicate'], totals['failed']
+                self._checkpoint(rows, outcomes)
+                for outcome in outcomes:
+                    totals[outcome] += 1
+        logging.info(f"Anki outbox flushed: Added={totals['added']}, Duplicates={totals['duplicate']}, Failed={totals['failed']}, Still spooled={self.pending_count()}.")
+        return totals['added'], totals['duplicate'], totals['failed']
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+# --- On-Disk Caches ---
+# Cache entries are small JSON files. Reading an entry bumps its mtime, so evicting the
+# oldest mtimes first gives LRU behaviour.
+
+def evict_cache_dir(cache_dir, max_bytes=None, max_age_s=None, max_entries=None):
+    """Removes expired entries, then least recently used ones until the directory fits the limits."""
+    try:
+        entries = []
+        for entry in os.scandir(cache_dir):
+            if entry.is_file():
+                stat = entry.stat()
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+    except FileNotFoundError:
+        return 0
+    entries.sort() # Oldest (least recently used) first
+
+    now = time.time()
+    total_bytes = sum(size for _, size, _ in entries)
+    remaining = len(entries)
+    removed = 0
+    for mtime, size, path in entries:
+        expired = max_age_s is not None and now - mtime > max_age_s
+        too_big = max_bytes is not None and total_bytes > max_bytes
+        too_many = max_entries is not None and remaining > max_entries
+        if not (expired or too_big or too_many):
+            continue
+        try:
+            os.remove(path)
+        except OSError as e:
+            logging.warning(f"Could not evict cache entry {path}: {e}")
+            continue
+        total_bytes -= size
+        remaining -= 1
+        removed += 1
+    if removed:
+        logging.info(f"Evicted {removed} entries from cache {cache_dir} ({remaining} left, {total_bytes / (1024 * 1024):.1f} MB).")
+    return removed
+
+def _read_cache_entry(path):
+    """Returns the JSON content of a cache entry (marking it as recently used), or None."""
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            data = json.load(f)
+        os.utime(path) # Bump mtime for LRU eviction
+        return data
+    except FileNotFoundError:
+        return None
+    except (json.JSONDecodeError, OSError) as e:
+        logging.warning(f"Ignoring unreadable cache entry {path}: {e}")
+        return None
 
-    # ... (initial checks remain the same) ...
+def _transcript_cache_path(video_id, model_id=None):
+    # Keyed by video ID plus the transcription model(s), so switching models doesn't reuse stale text
+    model_key = hashlib.sha256((model_id or TRANSCRIPTION_MODEL_ID).encode('utf-8')).hexdigest()[:12]
+    return os.path.join(TRANSCRIPT_CACHE_DIR, f"{sanitize_filename(video_id)}_{model_key}.json")
 
-    # --- NEW: Check AnkiConnect Connection Early ---
-    anki_available = check_ankiconnect_connection()
-    if not anki_available:
-        logging.warning("AnkiConnect not available. Flashcards will be saved to JSON but not added to Anki.")
-    # --------------------------------------------
+def load_cached_transcript(video_id, audio_file_path=None, model_id=None):
+    """
+    Returns the cached transcript for a video (made by model_id, default: the Replicate models), or None on a miss.
+    If audio_file_path is given and the entry recorded an audio hash, the hash must match.
+    """
+    if not CACHE_ENABLED:
+        return None
+    entry = _read_cache_entry(_transcript_cache_path(video_id, model_id))
+    if not entry or not entry.get('transcript'):
+        return None
+    if audio_file_path and entry.get('audio_sha256'):
+        if _file_sha256(audio_file_path) != entry['audio_sha256']:
+            logging.info(f"Cached transcript for {video_id} was made from different audio. Ignoring it.")
+            return None
+    logging.info(f"Using cached transcript for {video_id} ({len(entry['transcript'])} chars).")
+    RUN_METRICS.incr('cache_hits', cache='transcript')
+    return entry['transcript']
+
+def save_cached_transcript(video_id, transcript, audio_file_path=None, model_id=None):
+    """Stores a transcript in the cache, with the audio hash if TRANSCRIPT_CACHE_VERIFY_AUDIO is on."""
+    if not CACHE_ENABLED or not transcript:
+        return
+    entry = {
+        'video_id': video_id,
+        'model': model_id or TRANSCRIPTION_MODEL_ID,
+        'audio_sha256': _file_sha256(audio_file_path) if TRANSCRIPT_CACHE_VERIFY_AUDIO and audio_file_path else None,
+        'created_at': time.time(),
+        'transcript': transcript,
+    }
+    try:
+        _atomic_write_json(_transcript_cache_path(video_id, model_id), entry)
+    except Exception as e:
+        logging.warning(f"Could not write transcript cache entry for {video_id}: {e}")
 
-    youtube = get_youtube_service()
-    if not youtube: logging.error("Exiting: Could not initialize YouTube service."); sys.exit(1)
+def evict_transcript_cache():
+    evict_cache_dir(TRANSCRIPT_CACHE_DIR,
+                    max_bytes=TRANSCRIPT_CACHE_MAX_MB * 1024 * 1024,
+                    max_age_s=TRANSCRIPT_CACHE_MAX_AGE_DAYS * 24 * 3600)
 
-    temp_audio_dir = os.path.join(tempfile.gettempdir(), "ytaudio_flashcards")
-    # ... (temp dir creation remains the same) ...
 
-    # Load seen videos - This set will be updated ONLY with successfully processed videos
-    seen_video_ids = load_seen_videos(STATE_FILE)
-    logging.info(f"Loaded {len(seen_video_ids)} previously seen video IDs from {STATE_FILE}.")
+def _audio_cache_base(video_id):
+    return os.path.join(AUDIO_CACHE_DIR, f"{sanitize_filename(video_id)}_{AUDIO_CACHE_FORMAT}")
+
+def is_cached_audio(audio_file_path):
+    """True if the file lives in the audio cache (and must not be deleted after use)."""
+    return bool(audio_file_path) and os.path.dirname(os.path.abspath(audio_file_path)) == os.path.abspath(AUDIO_CACHE_DIR)
+
+def load_cached_audio(video_id):
+    """Returns the path of the cached audio of a video in the current format (marking it as recently used), or None."""
+    if not CACHE_ENABLED:
+        return None
+    for path in glob.glob(glob.escape(_audio_cache_base(video_id)) + ".*"):
+        if path.endswith('.part') or os.path.getsize(path) == 0:
+            continue
+        os.utime(path) # Bump mtime for LRU eviction
+        logging.info(f"Using cached audio for {video_id}: {path}")
+        RUN_METRICS.incr('cache_hits', cache='audio')
+        return path
+    return None
+
+def save_cached_audio(video_id, audio_file_path):
+    """Moves a file downloaded into AUDIO_CACHE_DIR to its cache key. Returns the path to use from now on."""
+    if not CACHE_ENABLED or not is_cached_audio(audio_file_path):
+        return audio_file_path
+    cached_path = _audio_cache_base(video_id) + os.path.splitext(audio_file_path)[1]
+    try:
+        os.replace(audio_file_path, cached_path)
+    except OSError as e:
+        logging.warning(f"Could not add audio for {video_id} to the cache: {e}")
+        return audio_file_path
+    evict_audio_cache()
+    return cached_path
+
+def evict_audio_cache():
+    evict_cache_dir(AUDIO_CACHE_DIR,
+                    max_bytes=AUDIO_CACHE_MAX_MB * 1024 * 1024,
+                    max_age_s=AUDIO_CACHE_MAX_AGE_DAYS * 24 * 3600)
+
+
+def _generation_cache_key(title, transcript_text, system_instruction_text):
+    """Hash of everything that determines Gemini's output for a video."""
+    digest = hashlib.sha256()
+    for part in (GEMINI_MODEL_ID, system_instruction_text, title or '', transcript_text):
+        digest.update(part.encode('utf-8'))
+        digest.update(b'\0') # Separator so parts can't run into each other
+    return digest.hexdigest()
+
+def load_cached_generation(cache_key):
+    """Returns the cached parsed flashcard result for a generation cache key, or None."""
+    if not CACHE_ENABLED:
+        return None
+    entry = _read_cache_entry(os.path.join(GENERATION_CACHE_DIR, f"{cache_key}.json"))
+    if not entry or not isinstance(entry.get('parsed'), dict):
+        return None
+    logging.info(f"Using cached Gemini response (model '{entry.get('model')}', {len(entry['parsed'].get('flashcards', []))} flashcards). No tokens spent.")
+    RUN_METRICS.incr('cache_hits', cache='generation')
+    return entry['parsed']
+
+def save_cached_generation(cache_key, model_name, generated_text, parsed_data):
+    """Stores Gemini's raw text and parsed result, evicting the least recently used entries beyond the limit."""
+    if not CACHE_ENABLED:
+        return
+    entry = {
+        'model': model_name,
+        'created_at': time.time(),
+        'raw_text': generated_text,
+        'parsed': parsed_data,
+    }
+    try:
+        _atomic_write_json(os.path.join(GENERATION_CACHE_DIR, f"{cache_key}.json"), entry)
+    except Exception as e:
+        logging.warning(f"Could not write Gemini response cache entry: {e}")
+        return
+    evict_cache_dir(GENERATION_CACHE_DIR, max_entries=GENERATION_CACHE_MAX_ENTRIES)
+
+
+# --- Pipeline Stages ---
+# Each stage takes a job dict and returns it (enriched) for the next stage, or None if
+# the video failed and should be dropped. A dropped video is NOT marked as seen.
+
+def _determine_anki_deck_name(sanitized_category):
+    """Maps a sanitized category onto a sub-deck of ANKI_DEFAULT_DECK_NAME."""
+    # Default to the full configured default deck name initially
+    anki_deck_name = ANKI_DEFAULT_DECK_NAME
+
+    # Check if the category is valid and not a generic placeholder
+    # Add any other generic/undesired category names Gemini might return here
+    undesired_categories = ["default_category", "unknown", "general", "misc"]
+    if sanitized_category and sanitized_category.lower() not in undesired_categories:
+        try:
+            # Extract the top-level deck name from the default setting (e.g., "Generated")
+            parent_deck_name = ANKI_DEFAULT_DECK_NAME.split('::', 1)[0]
+            # Construct the specific sub-deck name (e.g., "Generated::Specific_Category")
+            anki_deck_name = f"{parent_deck_name}::{sanitized_category}"
+        except IndexError:
+            # Fallback if ANKI_DEFAULT_DECK_NAME doesn't contain '::'
+            logging.warning(f"ANKI_DEFAULT_DECK_NAME ('{ANKI_DEFAULT_DECK_NAME}') does not follow 'Parent::Child' format. Using sanitized category as top-level deck: '{sanitized_category}'")
+            anki_deck_name = sanitized_category # Fallback to using category name directly
+
+    # If category was default/empty/invalid, anki_deck_name remains ANKI_DEFAULT_DECK_NAME
+    return anki_deck_name
+
+def _cleanup_job_audio(job):
+    """Removes the temp audio file of a job, if any. Cached audio is left to the cache eviction."""
+    audio_file_path = job.get('audio_file_path')
+    if audio_file_path and os.path.exists(audio_file_path) and not is_cached_audio(audio_file_path):
+        try:
+            os.remove(audio_file_path)
+            logging.info(f"Cleaned up temp audio: {audio_file_path}")
+        except OSError as e:
+            logging.error(f"Error removing temp audio {audio_file_path}: {e}")
+    job['audio_file_path'] = None
+
+def _job_duration_s(job):
+    """The video's duration from its metadata, else estimated from the audio file size (None if unknown)."""
+    duration_s = job['metadata'].get('duration_s')
+    if duration_s is None and job.get('audio_file_path') and os.path.exists(job['audio_file_path']):
+        duration_s = os.path.getsize(job['audio_file_path']) * 8 / (ESTIMATED_AUDIO_KBPS * 1000)
+    return duration_s
+
+def _job_transcription_engines(job):
+    """
+    The engines to transcribe a job with, chosen once (with the duration known at that point) and
+    kept on the job, so the transcript cache is read and written under the same engine.
+    """
+    if 'transcription_engines' not in job:
+        job['transcription_engines'] = select_transcription_engines(_job_duration_s(job))
+    return job['transcription_engines']
+
+def _transcript_cache_model_id(job):
+    """Transcripts are cached under the engine a video is routed to, whichever engine ends up producing them."""
+    engines = _job_transcription_engines(job)
+    return engines[0].model_id if engines else None
+
+def stage_download(job, temp_audio_dir):
+    """Pipeline stage 1: downloads the audio of the job's video."""
+    logging.info(f"--- Processing video: '{job['title']}' ({job['video_url']}) ---")
+    if job.get('audio_file_path') and not os.path.exists(job['audio_file_path']):
+        job['audio_file_path'] = None # Resumed, but the audio is gone (temp dir cleaned or evicted from the cache)
+    if job.get('generation_result') or job.get('transcript') or job.get('audio_file_path'):
+        return job # Resumed past this stage
+    if not TRANSCRIPT_CACHE_VERIFY_AUDIO:
+        cached_transcript = load_cached_transcript(job['video_id'], model_id=_transcript_cache_model_id(job))
+        if cached_transcript:
+            job['transcript'] = cached_transcript # Skip straight to flashcard generation
+            return job
+
+    # --- Caption Fast Path ---
+    metadata = job.get('metadata', {})
+    captions_possible = CAPTION_ALLOW_AUTO or metadata.get('has_captions', True) # Metadata only knows manual captions
+    if TRANSCRIPT_SOURCE in ('auto', 'captions') and captions_possible:
+        caption_transcript = get_transcript_from_captions(job['video_url'], metadata.get('duration_s'))
+        if caption_transcript:
+            job['transcript'] = caption_transcript # No download or Whisper needed
+            return job
+    if TRANSCRIPT_SOURCE == 'captions':
+        logging.warning(f"No usable captions for '{job['title']}' and TRANSCRIPT_SOURCE=captions. It will NOT be marked as seen.")
+        return None
+    cached_audio = load_cached_audio(job['video_id'])
+    if cached_audio:
+        job['audio_file_path'] = cached_audio
+        return job
+    # Age restriction is not pre-checked here: cookies may bypass it and
+    # download_audio logs if it fails due to restriction.
+    if CACHE_ENABLED:
+        os.makedirs(AUDIO_CACHE_DIR, exist_ok=True)
+    with RUN_METRICS.span('download'):
+        audio_file_path = download_audio(job['video_url'], AUDIO_CACHE_DIR if CACHE_ENABLED else temp_audio_dir)
+    if not audio_file_path:
+        logging.warning(f"Audio download failed for '{job['title']}'. Skipping further processing for this video. It will NOT be marked as seen.")
+        return None
+    job['audio_file_path'] = save_cached_audio(job['video_id'], audio_file_path)
+    return job
+
+def stage_transcribe(job):
+    """Pipeline stage 2: transcribes the downloaded audio (unless cached), then removes it."""
+    if job.get('transcript') or job.get('generation_result'):
+        return job # Transcript came from the cache or the journal
+    try:
+        cache_model_id = _transcript_cache_model_id(job)
+        transcript_content = load_cached_transcript(job['video_id'], job['audio_file_path'], model_id=cache_model_id)
+        if not transcript_content:
+            transcript_content = transcribe_audio(job['audio_file_path'], _job_transcription_engines(job))
+            save_cached_transcript(job['video_id'], transcript_content, job['audio_file_path'], model_id=cache_model_id)
+    finally:
+        _cleanup_job_audio(job) # Audio is not needed by any later stage (cached audio is kept for retries)
+    if not transcript_content:
+        logging.warning(f"Could not get transcript for '{job['title']}'. Skipping flashcard generation. It will NOT be marked as seen.")
+        return None
+    job['transcript'] = transcript_content
+    return job
+
+def stage_generate(job):
+    """Pipeline stage 3: generates flashcards from the transcript with Gemini."""
+    if job.get('generation_result'):
+        return job # Resumed from the journal
+    logging.info(f"Attempting to generate flashcards for '{job['title']}'...")
+    generation_result = generate_flashcards_from_transcript(job['transcript'], job['title'])
+    if generation_result is None:
+        logging.error(f"Flashcard generation failed for '{job['title']}'. It will NOT be marked as seen.")
+        return None
+    job['generation_result'] = generation_result
+    return job
+
+def stage_ingest(job, anki_available, run_stats, stats_lock, card_store, anki_outbox=None):
+    """
+    Pipeline stage 4: saves the cards to the card store and adds them to Anki
+    (or spools them to the Anki outbox if Anki is unavailable or ingestion is deferred).
+    Updates run_stats (under stats_lock) and returns the job if it should be marked as seen.
+    """
+    title = job['title']
+    generation_result = job['generation_result']
+
+    if isinstance(generation_result.get('flashcards'), list) and generation_result['flashcards']:
+        raw_category = generation_result.get('category', 'Default Category') # Use getter with default
+        new_cards = generation_result['flashcards']
+        sanitized_category = sanitize_filename(raw_category)
+        anki_deck_name = _determine_anki_deck_name(sanitized_category)
+
+        logging.info(f"Generated {len(new_cards)} cards for category '{raw_category}' (Sanitized: '{sanitized_category}', Target Anki Deck: '{anki_deck_name}').")
+
+        # --- 1. Save to the Card Store ---
+        # Cards are stored under the sanitized category (the name of its JSON export file)
+        try:
+            cards_saved = card_store.add_cards(sanitized_category, job['video_id'], title, new_cards)
+            with stats_lock:
+                run_stats['cards_generated'] += cards_saved
+                run_stats['updated_categories'].add(sanitized_category)
+            logging.info(f"Saved {cards_saved} new cards to category '{sanitized_category}' in {card_store.db_path}.")
+        except sqlite3.Error as e:
+            logging.error(f"Failed to save cards for video '{title}' to the card store: {e}")
+            # Continue processing; we still proceed to Anki and mark success.
+
+        # --- 2. Add to Anki (If available) ---
+        if anki_available and not ANKI_DEFERRED_INGEST:
+            logging.info(f"Attempting to add {len(new_cards)} cards to Anki deck '{anki_deck_name}'...")
+            # Pass the determined deck name and raw category for potential tagging
+            added, duplicates, failed = add_cards_to_anki(new_cards, anki_deck_name, title, raw_category,
+                                                          outbox=anki_outbox, video_id=job['video_id'])
+            with stats_lock:
+                run_stats['anki_added'] += added
+                run_stats['anki_duplicates'] += duplicates
+                run_stats['anki_failed'] += failed
+        elif anki_outbox is not None:
+            notes, _ = _build_anki_notes(new_cards, anki_deck_name, title, raw_category)
+            spooled = anki_outbox.enqueue(notes, video_id=job['video_id'])
+            with stats_lock:
+                run_stats['anki_spooled'] += spooled
+            logging.info(f"Spooled {spooled} notes for '{title}' to the Anki outbox (deck '{anki_deck_name}').")
+        else:
+            logging.info(f"Skipping Anki addition for '{title}' as AnkiConnect is not available.")
+
+    else: # Gemini ran but produced no cards
+        category = generation_result.get('category', 'unknown')
+        logging.warning(f"Gemini returned category '{category}' but no valid flashcards were generated/parsed for '{title}'.")
+        # Gemini succeeded but content wasn't useful: mark as seen so we don't retry Gemini.
+
+    return job
+
+
+class VideoPipeline:
+    """
+    Staged, concurrent video processing pipeline.
+
+    Stages (download -> transcribe -> generate -> ingest) each run their own pool of
+    worker threads and are connected by bounded queues, so throughput scales with stage
+    concurrency while a slow stage applies back-pressure to the ones before it.
+    """
+
+    _STOP = object() # Sentinel telling a worker its input queue is closed
+    _JOURNAL_STAGES = {'download': 'downloaded', 'transcribe': 'transcribed', 'generate': 'generated', 'ingest': 'ingested'}
+
+    def __init__(self, temp_audio_dir, anki_available, journal=None, card_store=None, anki_outbox=None,
+                 download_workers=DOWNLOAD_WORKERS, transcribe_workers=TRANSCRIBE_WORKERS,
+                 generate_workers=GENERATE_WORKERS, anki_workers=ANKI_WORKERS,
+                 queue_size=PIPELINE_QUEUE_SIZE):
+        self.journal = journal
+        self.card_store = card_store or CardStore(CARD_DB_FILE, legacy_json_dir=DATA_DIR)
+        self.anki_outbox = anki_outbox
+        self.anki_available = anki_available # May be updated between submissions (daemon mode)
+        self.stats_lock = threading.Lock()
+        self.stats = {
+            'attempted': 0,
+            'processed': 0,
+            'cards_generated': 0,
+            'anki_added': 0,
+            'anki_duplicates': 0,
+            'anki_failed': 0,
+            'anki_spooled': 0,
+            'updated_categories': set(),
+        }
+        self.in_flight = set() # IDs of submitted videos that haven't finished or failed yet (under stats_lock)
+        self.failed_at = {} # video ID -> time of its last failure (under stats_lock)
+        self._stages = [
+            ('download', lambda job: stage_download(job, temp_audio_dir), download_workers),
+            ('transcribe', stage_transcribe, transcribe_workers),
+            ('generate', stage_generate, generate_workers),
+            ('ingest', lambda job: stage_ingest(job, self.anki_available, self.stats, self.stats_lock, self.card_store, self.anki_outbox), anki_workers),
+        ]
+        self._queues = [queue.Queue(maxsize=max(1, queue_size)) for _ in self._stages]
+        self._threads = [[] for _ in self._stages]
+        self._started = False
+
+    def start(self):
+        """Starts the worker threads of every stage."""
+        for index, (stage_name, stage_func, worker_count) in enumerate(self._stages):
+            in_q = self._queues[index]
+            out_q = self._queues[index + 1] if index + 1 < len(self._queues) else None
+            for n in range(max(1, worker_count)):
+                thread = threading.Thread(target=self._worker, args=(stage_name, stage_func, in_q, out_q),
+                                          name=f"{stage_name}-{n + 1}", daemon=True)
+                thread.start()
+                self._threads[index].append(thread)
+        self._started = True
+        logging.info("Pipeline started with workers: " +
+                     ", ".join(f"{name}={len(threads)}" for (name, _, _), threads in zip(self._stages, self._threads)))
+
+    def submit(self, video_id, title, metadata=None):
+        """Queues a video for processing. Blocks while the download queue is full."""
+        job = {
+            'video_id': video_id,
+            'title': title,
+            'video_url': f"https://www.youtube.com/watch?v={video_id}",
+            'metadata': metadata or {}, # From fetch_video_metadata, may be empty
+        }
+        entry = self.journal.get(video_id) if self.journal else None
+        if entry and entry['stage'] != 'queued':
+            # Resume from the last completed stage instead of starting over
+            if entry['generation_result'] is not None:
+                job['generation_result'] = entry['generation_result']
+            if entry['transcript']:
+                job['transcript'] = entry['transcript']
+            if entry['audio_file_path'] and os.path.exists(entry['audio_file_path']):
+                job['audio_file_path'] = entry['audio_file_path']
+            logging.info(f"Resuming '{title}' after stage '{entry['stage']}'.")
+        with self.stats_lock:
+            self.stats['attempted'] += 1
+            self.in_flight.add(video_id)
+        if self.journal and not entry:
+            # Remember the video so it is retried even if the playlist looks unchanged next time
+            self.journal.record_stage(video_id, 'queued', title=title)
+        self._queues[0].put(job)
+
+    def close(self):
+        """Waits for all submitted videos to drain through every stage, then stops the workers."""
+        if not self._started:
+            return
+        # Close stages front to back: once every worker of a stage has exited,
+        # nothing more can arrive at the next stage's queue.
+        for index, threads in enumerate(self._threads):
+            for _ in threads:
+                self._queues[index].put(self._STOP)
+            for thread in threads:
+                thread.join()
+        self._started = False
+
+    def _worker(self, stage_name, stage_func, in_q, out_q):
+        while True:
+            job = in_q.get()
+            if job is self._STOP:
+                return
+            try:
+                with RUN_METRICS.span(f"stage_{stage_name}", video_id=job['video_id']):
+                    result = stage_func(job)
+            except Exception as e:
+                # Catch any unexpected error so one video can't take down the worker
+                logging.error(f"Unexpected error in {stage_name} stage for video '{job['title']}' ({job['video_id']}): {e}", exc_info=True)
+                result = None
+                error = f"{stage_name}: {type(e).__name__}: {e}"
+            else:
+                error = f"{stage_name} stage failed"
 
-    current_videos_dict = fetch_playlist_videos(youtube, PLAYLIST_ID)
+            if result is None:
+                _cleanup_job_audio(job)
+                logging.warning(f"Processing failed or was incomplete for '{job['title']}'. It will NOT be marked as seen and may be retried next run.")
+                if self.journal:
+                    try:
+                        self.journal.record_failure(job['video_id'], error, title=job['title'])
+                    except Exception as e:
+                        logging.error(f"Could not record the failure of '{job['title']}' in the state journal: {e}")
+                with self.stats_lock:
+                    self.in_flight.discard(job['video_id'])
+                    self.failed_at[job['video_id']] = time.time()
+            else:
+                self._record_stage(stage_name, result)
+                if out_q is not None:
+                    out_q.put(result)
+                else:
+                    self._mark_processed(result)
+
+    def _record_stage(self, stage_name, job):
+        if not self.journal:
+            return
+        try:
+            self.journal.record_stage(job['video_id'], self._JOURNAL_STAGES[stage_name], title=job['title'],
+                                      audio_file_path=job.get('audio_file_path'), transcript=job.get('transcript'),
+                                      generation_result=job.get('generation_result'))
+        except Exception as e:
+            logging.error(f"Could not record stage '{stage_name}' for '{job['title']}' in the state journal: {e}")
+
+    def _mark_processed(self, job):
+        logging.info(f"Successfully processed '{job['title']}'. Marking as seen.")
+        with self.stats_lock:
+            self.stats['processed'] += 1
+            self.in_flight.discard(job['video_id'])
+            self.failed_at.pop(job['video_id'], None)
+
+
+def _skip_reason(metadata):
+    """Returns why a skip rule excludes a video with this metadata, or None."""
+    if SKIP_AGE_RESTRICTED and metadata.get('age_restricted'):
+        return "age-restricted (SKIP_AGE_RESTRICTED)"
+    duration_s = metadata.get('duration_s')
+    if MAX_VIDEO_DURATION_MIN and duration_s and duration_s > MAX_VIDEO_DURATION_MIN * 60:
+        return f"{duration_s / 60:.0f} min exceeds MAX_VIDEO_DURATION_MIN={MAX_VIDEO_DURATION_MIN:g}"
+    return None
+
+def schedule_videos(videos_to_process, video_metadata, journal=None):
+    """
+    Applies the metadata-based skip rules and orders the videos longest first, so the
+    long transcriptions start early instead of being the tail of the run.
+    Returns a list of (video_id, title, metadata). Skipped videos are recorded in the journal
+    as given up on, so they don't stay pending forever.
+    """
+    scheduled = []
+    for video_id, title in videos_to_process.items():
+        metadata = video_metadata.get(video_id, {})
+        reason = _skip_reason(metadata)
+        if reason:
+            logging.warning(f"Skipping '{title}' ({video_id}): {reason}.")
+            if journal is not None:
+                journal.record_skip(video_id, reason, title=title)
+            continue
+        scheduled.append((video_id, title, metadata))
+    scheduled.sort(key=lambda entry: entry[2].get('duration_s') or 0, reverse=True)
+    return scheduled
+
+
+def log_run_summary(run_stats, anki_available):
+    """Logs the totals of a pipeline run."""
+    log_summary = (f"Finished processing loop. Attempted={run_stats['attempted']}, "
+                   f"Successfully Processed (marked as seen)={run_stats['processed']}.")
+
+    if run_stats['cards_generated'] > 0:
+        log_summary += f" Generated/Saved {run_stats['cards_generated']} cards to the card store across {len(run_stats['updated_categories'])} categories."
+    elif run_stats['processed'] > 0: # Processed some but generated 0 cards
+         log_summary += f" No new flashcards were generated or saved to the card store."
+
+    if anki_available and not ANKI_DEFERRED_INGEST:
+        log_summary += (f" Anki: Added={run_stats['anki_added']}, "
+                        f"Duplicates={run_stats['anki_duplicates']}, "
+                        f"Failed={run_stats['anki_failed']}.")
+    if run_stats['anki_spooled'] > 0:
+        log_summary += f" Spooled {run_stats['anki_spooled']} notes to the Anki outbox."
+    logging.info(log_summary)
+
+def write_run_reports(run_stats):
+    """Writes the JSON run report and the Prometheus textfile. Errors are logged, not raised."""
+    try:
+        report_path = RUN_METRICS.write_json_report(RUN_REPORT_DIR, run_stats)
+        if METRICS_TEXTFILE:
+            RUN_METRICS.write_prometheus_textfile(METRICS_TEXTFILE, run_stats)
+        return report_path
+    except OSError as e:
+        logging.warning(f"Could not write the run report or metrics textfile: {e}")
+        return None
+
+def check_anki_and_flush_outbox(anki_outbox):
+    """Checks AnkiConnect and, if it is reachable, sends the notes spooled by earlier runs. Returns whether it is available."""
+    anki_available = check_ankiconnect_connection()
+    if not anki_available:
+        logging.warning("AnkiConnect not available. Flashcards will be saved to the card store and spooled to the Anki outbox.")
+    elif anki_outbox.pending_count():
+        # Drain notes spooled by earlier runs before adding new ones
+        anki_outbox.flush()
+    return anki_available
+
+def check_playlist_once(youtube, journal, card_store, anki_outbox, temp_audio_dir):
+    """Processes every new or unfinished video of the playlist. Returns the run stats (None if there was nothing to do)."""
+    current_videos_dict = fetch_playlist_videos(youtube, PLAYLIST_ID, journal=journal)
     current_video_ids_from_playlist = set(current_videos_dict.keys()) # Rename for clarity
 
-    if not current_videos_dict and not seen_video_ids:
+    if not current_videos_dict and not journal.count():
          logging.warning("Could not fetch current videos and no previous state exists. Exiting run.")
          sys.exit(0)
 
-    # Calculate videos to process: those in playlist but not in our *successfully processed* list
-    new_video_ids_to_process = current_video_ids_from_playlist - seen_video_ids
+    # Calculate videos to process: those in playlist but not *successfully processed* yet,
+    # plus earlier videos that never finished. These resume from their last completed stage.
+    videos_to_process = journal.pending_videos()
+    for video_id in journal.filter_unprocessed(current_video_ids_from_playlist):
+        videos_to_process[video_id] = current_videos_dict[video_id]
+    new_video_ids_to_process = set(videos_to_process)
+    video_metadata = fetch_video_metadata(youtube, new_video_ids_to_process) if new_video_ids_to_process else {}
+
+    # AnkiConnect is only checked when there is something to add
+    anki_available = False
+    if new_video_ids_to_process or anki_outbox.pending_count():
+        anki_available = check_anki_and_flush_outbox(anki_outbox)
 
+    run_stats = None
     if new_video_ids_to_process: # Use the new variable name
         logging.info(f"Found {len(new_video_ids_to_process)} video(s) to process!")
-        processed_in_this_run_count = 0 # Renamed for clarity
-        cards_generated_in_run = 0
-        cards_added_to_anki_in_run = 0
-        cards_marked_duplicate_in_run = 0 # Added counter
-        cards_failed_to_add_anki_in_run = 0 # Added counter
-        updated_categories = set()
-        successfully_processed_ids_this_run = set() # Track IDs completed in *this* run
-
-        # Loop through the videos needing processing
-        for video_id in new_video_ids_to_process:
-            title = current_videos_dict.get(video_id, "Unknown Title")
-            video_url = f"https://www.youtube.com/watch?v={video_id}"
-            logging.info(f"--- Processing video: '{title}' ({video_url}) ---")
-            processed_successfully = False # Flag for this video
-
-            # Skip age restricted check (moved inside try block maybe?)
-            # if is_age_restricted(youtube, video_id):
-            #     logging.warning(f"Skipping potentially age-restricted video: '{title}' (Will re-check during download if needed)")
-            #     # Don't add to seen_video_ids here, let download handle it
-            #     continue
-
-            audio_file_path = None
-            transcript_content = None
-            try:
-                # --- Age Restricted Check (moved here as download handles it better) ---
-                # Optional: You can still pre-check, but cookies might bypass it anyway.
-                # The download function will log if it fails due to restriction.
-
-                # --- Audio Download ---
-                audio_file_path = download_audio(video_url, temp_audio_dir)
-                if not audio_file_path:
-                    logging.warning(f"Audio download failed for '{title}'. Skipping further processing for this video. It will NOT be marked as seen.")
-                    continue # Skip to next video
-
-                # --- Transcription ---
-                transcript_content = get_transcript_replicate(audio_file_path)
-                if not transcript_content:
-                    logging.warning(f"Could not get transcript for '{title}'. Skipping flashcard generation. It will NOT be marked as seen.")
-                    continue # Skip to next video
-
-                # --- Flashcard Generation (Gemini) ---
-                logging.info(f"Attempting to generate flashcards for '{title}'...")
-                generation_result = generate_flashcards_from_transcript(transcript_content, title)
-
-                if generation_result and isinstance(generation_result.get('flashcards'), list) and generation_result['flashcards']:
-                    # --- Determine Anki Deck Name (NEW LOGIC for Subdecks) ---
-                    raw_category = generation_result.get('category', 'Default Category') # Use getter with default
-                    new_cards = generation_result['flashcards']
-                    sanitized_category = sanitize_filename(raw_category)
-
-                    # Default to the full configured default deck name initially
-                    anki_deck_name = ANKI_DEFAULT_DECK_NAME
-
-                    # Check if the category is valid and not a generic placeholder
-                    # Add any other generic/undesired category names Gemini might return here
-                    undesired_categories = ["default_category", "unknown", "general", "misc"]
-                    if sanitized_category and sanitized_category.lower() not in undesired_categories:
-                        try:
-                            # Extract the top-level deck name from the default setting (e.g., "Generated")
-                            parent_deck_name = ANKI_DEFAULT_DECK_NAME.split('::', 1)[0]
-                            # Construct the specific sub-deck name (e.g., "Generated::Specific_Category")
-                            anki_deck_name = f"{parent_deck_name}::{sanitized_category}"
-                        except IndexError:
-                            # Fallback if ANKI_DEFAULT_DECK_NAME doesn't contain '::'
-                            logging.warning(f"ANKI_DEFAULT_DECK_NAME ('{ANKI_DEFAULT_DECK_NAME}') does not follow 'Parent::Child' format. Using sanitized category as top-level deck: '{sanitized_category}'")
-                            anki_deck_name = sanitized_category # Fallback to using category name directly
-
-                    # If category was default/empty/invalid, anki_deck_name remains ANKI_DEFAULT_DECK_NAME
-
-                    logging.info(f"Generated {len(new_cards)} cards for category '{raw_category}' (Sanitized: '{sanitized_category}', Target Anki Deck: '{anki_deck_name}').")
-
-                    # --- 1. Save to JSON ---
-                    # The JSON filename should still just use the sanitized category directly
-                    json_card_file = os.path.join(DATA_DIR, f"{JSON_FILENAME_PREFIX}{sanitized_category}.json")
-                    existing_cards = load_json_cards(json_card_file)
-                    initial_card_count_category = len(existing_cards)
-                    existing_cards.extend(new_cards)
-
-                    if save_json_cards(json_card_file, existing_cards):
-                        cards_added_this_video_json = len(existing_cards) - initial_card_count_category
-                        cards_generated_in_run += cards_added_this_video_json
-                        updated_categories.add(sanitized_category)
-                        logging.info(f"Successfully saved {len(existing_cards)} total cards to {json_card_file} ({cards_added_this_video_json} new).")
-                    else:
-                         logging.error(f"Failed to save updated cards to {json_card_file} for video '{title}'.")
-                         # Continue processing, but maybe don't mark as success? Your choice.
-                         # For now, we'll still proceed to Anki and mark success later.
-
-                    # --- 2. Add to Anki (If available) ---
-                    if anki_available:
-                        # Use the anki_deck_name determined above (which might be a subdeck)
-                        logging.info(f"Attempting to add {len(new_cards)} cards to Anki deck '{anki_deck_name}'...")
-                        # Pass the determined deck name and raw category for potential tagging
-                        added, duplicates, failed = add_cards_to_anki(new_cards, anki_deck_name, title, raw_category)
-                        cards_added_to_anki_in_run += added
-                        cards_marked_duplicate_in_run += duplicates # Accumulate counts
-                        cards_failed_to_add_anki_in_run += failed   # Accumulate counts
-                        # Logging is handled within add_cards_to_anki
-                    else:
-                        logging.info(f"Skipping Anki addition for '{title}' as AnkiConnect is not available.")
 
-                    # **** Mark as processed successfully ONLY if we got this far ****
-                    processed_successfully = True
+        pipeline = VideoPipeline(temp_audio_dir, anki_available, journal=journal, card_store=card_store, anki_outbox=anki_outbox)
+        pipeline.start()
+        try:
+            for video_id, title, metadata in schedule_videos(videos_to_process, video_metadata, journal=journal):
+                pipeline.submit(video_id, title, metadata)
+        finally:
+            pipeline.close()
+        run_stats = pipeline.stats
 
+        log_run_summary(run_stats, anki_available)
 
-                elif generation_result: # Gemini ran but produced no cards
-                     category = generation_result.get('category', 'unknown')
-                     logging.warning(f"Gemini returned category '{category}' but no valid flashcards were generated/parsed for '{title}'.")
-                     # Decide: Should this count as success? If Gemini succeeded but content wasn't useful,
-                     # maybe we *do* want to mark it as seen so we don't retry Gemini? Let's say yes for now.
-                     processed_successfully = True
-                else: # generation_result is None (Gemini error)
-                    logging.error(f"Flashcard generation failed for '{title}'. It will NOT be marked as seen.")
-                    # Do NOT set processed_successfully = True
+        if anki_available and ANKI_DEFERRED_INGEST and anki_outbox.pending_count():
+            anki_outbox.flush()
+        # State needs no final save: the journal committed every stage as it completed.
 
+    else: # No new_video_ids_to_process
+        logging.info("No new videos found in the playlist requiring processing.")
+    return run_stats
 
+def _videos_due(youtube, journal, pipeline):
+    """
+    {video_id: title} of the videos a daemon poll should dispatch: new playlist items and unfinished
+    journal entries, minus videos still in the pipeline and those that failed within DAEMON_RETRY_FAILED_S.
+    """
+    current_videos = fetch_playlist_videos(youtube, PLAYLIST_ID, journal=journal) # {} after a 304 (unchanged)
+    videos_due = journal.pending_videos()
+    for video_id in journal.filter_unprocessed(set(current_videos)):
+        videos_due[video_id] = current_videos[video_id]
+    now = time.time()
+    with pipeline.stats_lock:
+        for video_id, failed_time in list(pipeline.failed_at.items()):
+            if now - failed_time >= DAEMON_RETRY_FAILED_S:
+                del pipeline.failed_at[video_id] # Due again; keeps the dict from growing for the daemon's lifetime
+        in_flight = set(pipeline.in_flight)
+        failed_at = dict(pipeline.failed_at)
+    return {video_id: title for video_id, title in videos_due.items()
+            if video_id not in in_flight and now - failed_at.get(video_id, 0) >= DAEMON_RETRY_FAILED_S}
+
+def run_daemon(youtube, journal, card_store, anki_outbox, temp_audio_dir, poll_interval_s=None):
+    """
+    Polls the playlist every poll_interval_s (plus up to DAEMON_POLL_JITTER_S) and feeds new videos
+    into one long-lived pipeline, keeping the API clients, caches and state open between polls.
+    An unchanged playlist costs one conditional YouTube request per poll. SIGTERM/SIGINT stop
+    dispatching and wait for the videos already in the pipeline (a second signal exits at once).
+    Returns the stats of the whole daemon lifetime.
+    """
+    poll_interval_s = DAEMON_POLL_INTERVAL_S if poll_interval_s is None else poll_interval_s
+    stop_requested = threading.Event()
+
+    def request_stop(signum, frame):
+        logging.info(f"Received {signal.Signals(signum).name}: finishing the videos in progress, then exiting (send it again to exit immediately).")
+        stop_requested.set()
+        signal.signal(signum, signal.SIG_DFL)
+
+    previous_handlers = {signum: signal.signal(signum, request_stop) for signum in (signal.SIGTERM, signal.SIGINT)}
+    # AnkiConnect is checked on the first poll that has something for it
+    pipeline = VideoPipeline(temp_audio_dir, False, journal=journal, card_store=card_store, anki_outbox=anki_outbox)
+    pipeline.start()
+    logging.info(f"Daemon started: checking playlist {PLAYLIST_ID} every {poll_interval_s:g}s (+ up to {DAEMON_POLL_JITTER_S:g}s jitter).")
+    try:
+        while not stop_requested.is_set():
+            try:
+                with pipeline.stats_lock:
+                    pipeline_idle = not pipeline.in_flight
+                if pipeline_idle:
+                    refresh_anki_caches() # Decks and notes may have been changed in Anki since the last poll
+                videos_due = _videos_due(youtube, journal, pipeline)
+                if anki_outbox.pending_count() or (videos_due and not pipeline.anki_available):
+                    # AnkiConnect is only re-checked when something is waiting for it
+                    pipeline.anki_available = check_ankiconnect_connection()
+                    with pipeline.stats_lock:
+                        pipeline_idle = not pipeline.in_flight
+                    if pipeline.anki_available and pipeline_idle and anki_outbox.pending_count():
+                        anki_outbox.flush() # Never alongside the ingest workers
+                if videos_due:
+                    if CACHE_ENABLED:
+                        evict_transcript_cache()
+                        evict_audio_cache()
+                    video_metadata = fetch_video_metadata(youtube, set(videos_due))
+                    scheduled = schedule_videos(videos_due, video_metadata, journal=journal)
+                    logging.info(f"Dispatching {len(scheduled)} video(s) to the pipeline.")
+                    for video_id, title, metadata in scheduled:
+                        if stop_requested.is_set():
+                            break # The rest are queued in the journal (by the playlist fetch) and resume on the next start
+                        pipeline.submit(video_id, title, metadata) # Blocks while the pipeline is full
+                write_run_reports(pipeline.stats)
             except Exception as e:
-                # Catch any unexpected error during the processing of a single video
-                logging.error(f"Unexpected error processing video '{title}' ({video_id}): {e}", exc_info=True)
-                # Ensure it's not marked as processed
-                processed_successfully = False
-
-            finally:
-                # --- Cleanup Temp Audio ---
-                if audio_file_path and os.path.exists(audio_file_path):
-                    try:
-                        os.remove(audio_file_path)
-                        logging.info(f"Cleaned up temp audio: {audio_file_path}")
-                    except OSError as e:
-                        logging.error(f"Error removing temp audio {audio_file_path}: {e}")
-
-                # --- Add to seen set ONLY if successful ---
-                if processed_successfully:
-                    logging.info(f"Successfully processed '{title}'. Marking as seen.")
-                    seen_video_ids.add(video_id) # Add the ID to the master set
-                    successfully_processed_ids_this_run.add(video_id) # Add to the set for this run's summary
-                    processed_in_this_run_count += 1 # Increment counter for summary
-                else:
-                    logging.warning(f"Processing failed or was incomplete for '{title}'. It will NOT be marked as seen and may be retried next run.")
+                logging.error(f"Playlist check failed: {e}", exc_info=True)
+            stop_requested.wait(poll_interval_s + random.uniform(0, DAEMON_POLL_JITTER_S))
+    finally:
+        logging.info("Daemon stopping: waiting for the videos already in the pipeline...")
+        pipeline.close()
+        for signum, handler in previous_handlers.items():
+            signal.signal(signum, handler)
+    log_run_summary(pipeline.stats, pipeline.anki_available)
+    if pipeline.anki_available and anki_outbox.pending_count():
+        anki_outbox.flush()
+    return pipeline.stats
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Turns new videos of a YouTube playlist into Anki flashcards.")
+    parser.add_argument('--no-cache', action='store_true',
+                        help="Don't read or write the on-disk caches (same as CACHE_ENABLED=false).")
+    parser.add_argument('--export-json', metavar='DIR', nargs='?', const=DATA_DIR,
+                        help="Export the card store as one JSON file per category (default: DATA_DIR) and exit.")
+    parser.add_argument('--flush-spool', action='store_true',
+                        help="Send the notes spooled in the Anki outbox to AnkiConnect and exit.")
+    parser.add_argument('--daemon', action='store_true',
+                        help="Keep running and check the playlist periodically instead of once (stop with SIGTERM/Ctrl+C).")
+    parser.add_argument('--poll-interval', type=float, metavar='SECONDS',
+                        help="Seconds between playlist checks in --daemon mode (default: DAEMON_POLL_INTERVAL_S).")
+    return parser.parse_args(argv)
 
-            # Optional: time.sleep(1)
 
-        # --- Summary Logging (Improved) ---
-        total_attempted = len(new_video_ids_to_process)
-        log_summary = (f"Finished processing loop. Attempted={total_attempted}, "
-                       f"Successfully Processed (marked as seen)={processed_in_this_run_count}.")
+# --- Main Execution ---
+def main(argv=None):
+    """
+    One playlist check (or, with --daemon, periodic checks until stopped): fetches new videos and runs
+    them through the pipeline. Returns the run stats (None if nothing ran).
+    """
+    global CACHE_ENABLED
+    setup_logging()
+    args = parse_args(argv)
+    logging.info("Starting YouTube Playlist Check...")
+    script_start_time = time.time()
+    RUN_METRICS.reset()
+
+    card_store = CardStore(CARD_DB_FILE, legacy_json_dir=DATA_DIR)
+    if args.export_json:
+        card_store.export_json(args.export_json)
+        sys.exit(0)
+
+    anki_outbox = AnkiOutbox(ANKI_SPOOL_FILE)
+    if args.flush_spool:
+        pending_notes = anki_outbox.pending_count()
+        if not pending_notes:
+            logging.info("Anki outbox is empty, nothing to flush.")
+        elif not check_ankiconnect_connection():
+            logging.error(f"Exiting: AnkiConnect not available, {pending_notes} notes remain spooled.")
+            sys.exit(1)
+        else:
+            anki_outbox.flush()
+        sys.exit(0)
+
+    if args.no_cache:
+        CACHE_ENABLED = False
+    if CACHE_ENABLED:
+        evict_transcript_cache()
+        evict_audio_cache()
+    else:
+        logging.info("Caching disabled for this run.")
 
-        if cards_generated_in_run > 0:
-            log_summary += f" Generated/Saved {cards_generated_in_run} cards to JSON across {len(updated_categories)} categories."
-        elif processed_in_this_run_count > 0: # Processed some but generated 0 cards
-             log_summary += f" No new flashcards were generated or saved to JSON."
+    youtube = get_youtube_service()
+    if not youtube: logging.error("Exiting: Could not initialize YouTube service."); sys.exit(1)
 
-        if anki_available:
-            log_summary += (f" Anki: Added={cards_added_to_anki_in_run}, "
-                            f"Duplicates={cards_marked_duplicate_in_run}, "
-                            f"Failed={cards_failed_to_add_anki_in_run}.")
-        else:
-             if cards_generated_in_run > 0 : # Only mention skipping if cards were generated
-                  log_summary += f" Anki addition skipped (AnkiConnect unavailable)."
-        logging.info(log_summary)
-
-        # --- Update State File ---
-        # Save the updated set of seen video IDs (includes old ones + newly successful ones)
-        # Only save if there were attempts, even if none succeeded this run, to capture potential removals if playlist changed.
-        # However, the most robust is to save *only* if successful additions happened OR if videos were removed from playlist.
-        # Let's save if any were successfully processed in this run.
-        if successfully_processed_ids_this_run:
-             save_seen_videos(STATE_FILE, seen_video_ids)
-        else:
-             logging.info("No videos were successfully processed in this run. State file not updated.")
+    temp_audio_dir = os.path.join(tempfile.gettempdir(), "ytaudio_flashcards")
+    os.makedirs(temp_audio_dir, exist_ok=True)
 
+    # Open the state journal - videos are marked as seen ONLY once they are fully processed
+    journal = StateJournal(STATE_DB_FILE, legacy_state_file=STATE_FILE)
+    logging.info(f"Opened state journal {STATE_DB_FILE} ({journal.count()} videos recorded).")
 
-    else: # No new_video_ids_to_process
-        logging.info("No new videos found in the playlist requiring processing.")
-        # Optional: You might still want to save the state if videos could have been *removed*
-        # from the playlist compared to the last run, but `seen_video_ids` wouldn't reflect that.
-        # A more complex diff would be needed. For now, only saving on success is safer.
-        # save_seen_videos(STATE_FILE, seen_video_ids) # Uncomment if you want to save even if no new videos processed
+    if args.daemon:
+        run_stats = run_daemon(youtube, journal, card_store, anki_outbox, temp_audio_dir, poll_interval_s=args.poll_interval)
+    else:
+        run_stats = check_playlist_once(youtube, journal, card_store, anki_outbox, temp_audio_dir)
 
-    logging.info(f"Playlist check finished in {time.time() - script_start_time:.2f} seconds.")
\ No newline at end of file
+    if _REPLICATE_POLLER is not None:
+        _REPLICATE_POLLER.cancel_all() # Nothing should be left; don't pay for stragglers
+    close_transcription_engines()
+    journal.close()
+    card_store.close()
+    anki_outbox.close()
+    report_path = write_run_reports(run_stats)
+    if report_path:
+        logging.info(f"Run report written to {report_path}.")
+    logging.info(f"Playlist check finished in {time.time() - script_start_time:.2f} seconds.")
+    return run_stats
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,55 @@
+import main
+
+
+def _notes_info(*fronts):
+    """notesInfo results in the shape AnkiConnect returns them (Basic note type)."""
+    return [{
+        'noteId': 1502298033753 + i,
+        'profile': 'User 1',
+        'modelName': 'Basic',
+        'tags': ['Physics'],
+        'fields': {
+            'Back': {'value': 'back content', 'order': 1},
+            'Front': {'value': front, 'order': 0},
+        },
+        'mod': 1718377864,
+        'cards': [1498938915662 + i],
+    } for i, front in enumerate(fronts)]
+
+
+def _seeded_index(monkeypatch, *fronts):
+    notes_info = _notes_info(*fronts)
+
+    def fake_invoke(action, **params):
+        if action == 'findNotes':
+            return [note['noteId'] for note in notes_info]
+        if action == 'notesInfo':
+            return [note for note in notes_info if note['noteId'] in params['notes']]
+        raise AssertionError(f"unexpected action {action}")
+
+    monkeypatch.setattr(main, '_invoke_ankiconnect', fake_invoke)
+    index = main.AnkiDuplicateIndex()
+    assert index.ensure_seeded('Generated::Physics')
+    return index
+
+
+def test_html_and_entities_match_like_anki(monkeypatch):
+    index = _seeded_index(monkeypatch, '<b>What is</b> ATP?', 'Ohm&#x27;s law: V = I &amp; R?', 'What&nbsp;is entropy?',
+                          '<div>Which organ is this? <img src="heart.jpg"></div>')
+    assert index.contains('Generated::Physics', 'What is ATP?')
+    assert index.contains('Generated::Physics', "Ohm's law: V = I & R?")
+    assert index.contains('Generated::Physics', 'What is entropy?')
+    assert index.contains('Generated::Physics', 'Which organ is this?  heart.jpg')
+
+
+def test_only_outer_whitespace_is_ignored(monkeypatch):
+    index = _seeded_index(monkeypatch, '  What is a photon?\n', 'What is  a  quark?')
+    assert index.contains('Generated::Physics', 'What is a photon?')
+    assert not index.contains('Generated::Physics', 'What is a quark?') # Anki keeps inner whitespace
+    assert not index.contains('Generated::Physics', 'what is a photon?') # and case
+    assert not index.contains('Generated::Physics', 'What is a photon? <b>(SI)</b>')
+
+
+def test_unseeded_deck_contains_nothing(monkeypatch):
+    index = _seeded_index(monkeypatch, 'What is ATP?')
+    assert not index.contains('Generated::Biology', 'What is ATP?')
@@ -0,0 +1,73 @@
+import pytest
+
+import main
+
+
+class FakePrediction:
+    """Stands in for replicate's Prediction: each reload() advances to the next scripted status."""
+
+    def __init__(self, prediction_id, statuses, error=None):
+        self.id = prediction_id
+        self.status = 'starting'
+        self.error = None
+        self.output = None
+        self._statuses = list(statuses)
+        self._error = error
+
+    def reload(self):
+        if self._statuses:
+            self.status = self._statuses.pop(0)
+        if self.status == 'failed':
+            self.error = self._error
+        elif self.status == 'succeeded':
+            self.output = {'transcription': 'hello world'}
+
+    def cancel(self):
+        self.status = 'canceled'
+
+
+def _poller(monkeypatch, *predictions):
+    predictions = list(predictions)
+    monkeypatch.setattr(main, '_create_replicate_prediction', lambda model_name, model_input: predictions.pop(0))
+    return main.ReplicatePredictionPoller(poll_interval_s=0.01, timeout_s=5)
+
+
+def test_failed_prediction_fails_its_future(monkeypatch):
+    poller = _poller(monkeypatch, FakePrediction('p1', ['processing', 'failed'], error="CUDA out of memory"))
+    future = poller.submit('owner/model:abc', {})
+    with pytest.raises(main.ReplicatePredictionError, match="CUDA out of memory") as excinfo:
+        future.result(timeout=5)
+    assert excinfo.value.status == 'failed'
+    assert poller.in_flight() == 0
+
+
+def test_canceled_prediction_fails_its_future(monkeypatch):
+    poller = _poller(monkeypatch, FakePrediction('p2', ['processing', 'canceled']))
+    future = poller.submit('owner/model:abc', {})
+    with pytest.raises(main.ReplicatePredictionError) as excinfo:
+        future.result(timeout=5)
+    assert excinfo.value.status == 'canceled'
+
+
+class BrokenPrediction(FakePrediction):
+    """Reloads fine but then returns something the poller can't read."""
+
+    def reload(self):
+        pass
+
+    @property
+    def status(self):
+        raise RuntimeError("unexpected response shape")
+
+    @status.setter
+    def status(self, value):
+        pass
+
+
+def test_poll_error_fails_only_that_future(monkeypatch):
+    poller = _poller(monkeypatch, BrokenPrediction('p3', []), FakePrediction('p4', ['processing', 'succeeded']))
+    broken_future = poller.submit('owner/model:abc', {})
+    healthy_future = poller.submit('owner/model:abc', {})
+    with pytest.raises(RuntimeError, match="unexpected response shape"):
+        broken_future.result(timeout=5)
+    assert healthy_future.result(timeout=5) == {'transcription': 'hello world'}